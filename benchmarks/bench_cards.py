@@ -0,0 +1,92 @@
+"""
+Compares the card replies of the full and the compact format (see
+anki_integration._render_question) on the cards of a collection: bytes per
+card as sent, and after permessage-deflate (with context takeover, like a
+session's websocket), and the time to build and serialize a reply
+
+Pass a real world collection for meaningful numbers, it's copied so the
+original isn't touched. Run with e.g.:
+python3.6 -m benchmarks.bench_cards --collection ~/Anki/User\\ 1/collection.anki2
+"""
+import os
+import json
+import time
+import zlib
+import shutil
+import tempfile
+import argparse
+from anki.storage import Collection
+from anki.sched import Scheduler
+from rememberberry import anki_integration
+
+TEST_COLLECTION = os.path.join(
+    os.path.dirname(anki_integration.__file__), 'test', 'data', 'users',
+    '688787d8ff144c502c7f5cffaafe2cc588d86079f9de88304c26b0cb99ce91c6', 'collection.anki2')
+
+
+def _deflated_sizes(frames):
+    """Sizes of the frames compressed like permessage-deflate does"""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    sizes = []
+    for frame in frames:
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        sizes.append(len(data) - 4) # without the 00 00 ff ff tail
+    return sizes
+
+
+def _measure(scheduler, cards, compact, repeat):
+    # Warm the render cache, like a session showing its cards
+    for card in cards:
+        anki_integration._render_question(scheduler, card, compact)
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        frames = [json.dumps(anki_integration._render_question(scheduler, card, compact)[0])
+                  for card in cards]
+    elapsed = (time.perf_counter() - start) / (repeat * len(cards))
+
+    frames = [f.encode('utf-8') for f in frames]
+    return {
+        'bytes': sum(len(f) for f in frames) / len(frames),
+        'deflated_bytes': sum(_deflated_sizes(frames)) / len(frames),
+        'time': elapsed,
+    }
+
+
+def main(args):
+    work_path = tempfile.mkdtemp(prefix='rememberberry-cards-')
+    col_path = os.path.join(work_path, 'collection.anki2')
+    shutil.copyfile(args.collection, col_path)
+    col = Collection(col_path)
+    try:
+        scheduler = Scheduler(col)
+        cids = col.db.list('select id from cards order by id limit ?', args.cards)
+        if not cids:
+            print('no cards in %s' % args.collection)
+            return
+        cards = [col.getCard(cid) for cid in cids]
+        results = {name: _measure(scheduler, cards, compact, args.repeat)
+                   for name, compact in [('full', False), ('compact', True)]}
+    finally:
+        col.close(save=False)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    print('%i cards' % len(cards))
+    print('%-8s %12s %15s %14s' % ('format', 'bytes/card', 'deflated/card', 'time/card'))
+    for name in ['full', 'compact']:
+        r = results[name]
+        print('%-8s %12.0f %15.0f %12.1fus' % (
+            name, r['bytes'], r['deflated_bytes'], r['time'] * 1e6))
+    full, compact = results['full'], results['compact']
+    print('compact is %.0f%% of the bytes, %.0f%% deflated' % (
+        100.0 * compact['bytes'] / full['bytes'],
+        100.0 * compact['deflated_bytes'] / full['deflated_bytes']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the card reply formats')
+    parser.add_argument("--collection", help="the anki collection to take the cards from",
+                        type=str, default=TEST_COLLECTION)
+    parser.add_argument("--cards", help="max number of cards", type=int, default=1000)
+    parser.add_argument("--repeat", help="times to serialize each card", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,163 @@
+"""
+Load test of how --workers passes the connections on to the workers (see
+rememberberry.workers.Dispatcher), without the rest of the server
+
+Forks --workers processes serving a websocket app that answers every
+message after --work milliseconds of cpu (standing in for the anki work of
+a turn), and a main process that dispatches the connections to them. Then
+--clients concurrent clients connect --sessions times each, to
+/?account=<account hex> like logged in users, and send --messages messages
+per connection. With --direct the clients connect straight to a single
+worker instead, as a baseline.
+
+Reports the connections and messages per second, the p50/p95/p99 latency
+of the messages and the cpu time of the main process. Run with e.g.:
+python3.6 -m benchmarks.bench_dispatch --workers 4 --clients 200
+"""
+import os
+import time
+import socket
+import signal
+import asyncio
+import argparse
+import multiprocessing
+import aiohttp
+from aiohttp import web
+from rememberberry import auth, workers
+
+
+async def _handler(request):
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    work = request.app['work']
+    async for msg in ws:
+        deadline = time.process_time() + work
+        while time.process_time() < deadline:
+            pass
+        await ws.send_str(msg.data)
+    return ws
+
+
+def _app(work):
+    app = web.Application()
+    app['work'] = work
+    app.router.add_route('GET', '/', _handler)
+    return app
+
+
+def _run_worker(channel, work):
+    async def start(runner):
+        workers.receive_connections(channel, runner.server, socket.AF_INET)
+    workers._run(_app(work), start)
+
+
+def _run_direct(sock, work):
+    async def start(runner):
+        await web.SockSite(runner, sock).start()
+    workers._run(_app(work), start)
+
+
+def _run_main(sock, channels):
+    async def start(runner):
+        sock.setblocking(False)
+        workers.Dispatcher(sock, channels, runner.server).start()
+    workers._run(web.Application(), start)
+
+
+def _cpu_time(pid):
+    with open('/proc/%i/stat' % pid) as f:
+        fields = f.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def _client(index, url, args, latencies):
+    account = auth.account_hex('user%i' % index)
+    async with aiohttp.ClientSession() as session:
+        for i in range(args.sessions):
+            async with session.ws_connect('%s?account=%s' % (url, account)) as ws:
+                for j in range(args.messages):
+                    start = time.monotonic()
+                    await ws.send_str('message %i' % j)
+                    await ws.receive()
+                    latencies.append(time.monotonic() - start)
+
+
+async def _wait_for_server(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+def main(args):
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+    work = args.work / 1000
+
+    processes, channels = [], []
+    if args.direct:
+        processes.append(multiprocessing.Process(target=_run_direct, args=(sock, work)))
+    else:
+        for i in range(args.workers):
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            processes.append(multiprocessing.Process(
+                target=_run_worker, args=(worker_channel, work)))
+            channels.append(channel)
+        processes.append(multiprocessing.Process(target=_run_main, args=(sock, channels)))
+    for p in processes:
+        p.start()
+    sock.close()
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(_wait_for_server(port))
+        latencies = []
+        cpu_before = _cpu_time(processes[-1].pid)
+        start = time.monotonic()
+        loop.run_until_complete(asyncio.gather(*[
+            _client(i, 'http://127.0.0.1:%i/' % port, args, latencies)
+            for i in range(args.clients)]))
+        elapsed = time.monotonic() - start
+        main_cpu = _cpu_time(processes[-1].pid) - cpu_before
+    finally:
+        for p in processes:
+            os.kill(p.pid, signal.SIGTERM)
+        for p in processes:
+            p.join()
+
+    connections = args.clients * args.sessions
+    print('%s, %i clients, %i connections, %i messages' % (
+        'direct' if args.direct else '%i workers' % args.workers,
+        args.clients, connections, len(latencies)))
+    print('%.1f connections/s, %.1f messages/s' % (
+        connections / elapsed, len(latencies) / elapsed))
+    print('latency p50 %.1fms, p95 %.1fms, p99 %.1fms' % tuple(
+        _percentile(latencies, p) * 1000 for p in (0.5, 0.95, 0.99)))
+    print('%s process cpu: %.2fs' % ('server' if args.direct else 'main', main_cpu))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the dispatch to workers')
+    parser.add_argument("--workers", help="worker processes", type=int, default=2)
+    parser.add_argument("--clients", help="number of concurrent clients", type=int, default=100)
+    parser.add_argument("--sessions", help="connections per client", type=int, default=5)
+    parser.add_argument("--messages", help="messages per connection", type=int, default=20)
+    parser.add_argument("--work", help="milliseconds of cpu per message",
+                        type=float, default=0.5)
+    parser.add_argument("--direct", help="connect straight to a single worker",
+                        action="store_true")
+    main(parser.parse_args())
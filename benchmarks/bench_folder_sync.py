@@ -0,0 +1,80 @@
+"""
+Compares syncing a MutableFolderContext back to mfs by re-adding the whole
+folder against the incremental manifest based sync, on a synthetic media
+folder where only a few files changed
+
+Needs a running ipfs daemon with /ipfs/ mounted, run with e.g.:
+python3.6 -m benchmarks.bench_folder_sync --files 2000 --size 100000 --changed 5
+"""
+import os
+import time
+import shutil
+import tempfile
+import asyncio
+import argparse
+import rememberberry
+from rememberberry import ipfs
+
+MFS_PATH = '/bench/media'
+
+
+async def _make_folder(num_files, size):
+    fs_path = tempfile.mkdtemp()
+    for i in range(num_files):
+        with open(os.path.join(fs_path, '%i.jpg' % i), 'wb') as f:
+            f.write(os.urandom(size))
+    await ipfs.mfs_mkdirs(os.path.dirname(MFS_PATH))
+    await ipfs.cp_fs_to_mfs(fs_path, MFS_PATH, rm=True, r=True)
+    shutil.rmtree(fs_path)
+
+
+def _modify(fs_path, num_changed, size):
+    for i in range(num_changed):
+        with open(os.path.join(fs_path, '%i.jpg' % i), 'wb') as f:
+            f.write(os.urandom(size))
+    with open(os.path.join(fs_path, 'new.jpg'), 'wb') as f:
+        f.write(os.urandom(size))
+
+
+async def run(args):
+    await ipfs.init()
+    await _make_folder(args.files, args.size)
+
+    # Full re-add, the way the folder context used to sync
+    ctx = ipfs.MutableFolderContext(MFS_PATH)
+    await ctx.__aenter__()
+    _modify(ctx.fs_path, args.changed, args.size)
+    start = time.monotonic()
+    await ipfs.cp_fs_to_mfs(ctx.fs_path, MFS_PATH, rm=True, r=True)
+    full_time = time.monotonic() - start
+    full_bytes = sum(os.path.getsize(os.path.join(ctx.fs_path, name))
+                     for name in os.listdir(ctx.fs_path))
+    ctx.mfs_path = None
+    await ctx.__aexit__(None, None, None)
+
+    # Incremental sync
+    ctx = ipfs.MutableFolderContext(MFS_PATH)
+    await ctx.__aenter__()
+    _modify(ctx.fs_path, args.changed, args.size)
+    start = time.monotonic()
+    await ctx.sync()
+    incremental_time = time.monotonic() - start
+    ctx.mfs_path = None
+    await ctx.__aexit__(None, None, None)
+
+    await ipfs.mfs_rm(os.path.dirname(MFS_PATH), r=True)
+
+    print('%i files of %i bytes, %i changed and 1 added' % (
+        args.files, args.size, args.changed))
+    print('full:        %8.3fs %12i bytes added' % (full_time, full_bytes))
+    print('incremental: %8.3fs %12i bytes added (%i files, %i bytes unchanged)' % (
+        incremental_time, ctx.stats['bytes_added'], ctx.stats['files_added'],
+        ctx.stats['bytes_unchanged']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark MutableFolderContext syncing')
+    parser.add_argument("--files", help="number of media files", type=int, default=2000)
+    parser.add_argument("--size", help="size of each media file", type=int, default=100000)
+    parser.add_argument("--changed", help="number of modified files", type=int, default=5)
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
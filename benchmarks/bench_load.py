@@ -0,0 +1,472 @@
+"""
+Load test of the websocket server with simulated users
+
+Starts a FakeIPFS (see rememberberry.fakes) with its /ipfs/ mount in a
+temporary folder (or with --storage local, a LocalStore), seeds it with a
+synthetic anki collection for every user and runs server.py against it, so
+it needs neither a network nor an ipfs daemon. Then --clients concurrent websocket clients sign up, and run
+--sessions sessions each: logging in with their auth token, listing and
+selecting a deck, and studying up to --answers cards.
+
+The users answer "no" to syncing with ankiweb. With --sync they say yes,
+and the server syncs with a fake ankiweb instead (server.py --fake-ankiweb,
+see rememberberry.fakes.fake_ankiweb), so the users start out without a
+collection and download the synthetic one in the sign up's sync turn.
+
+Reports the p50/p95/p99 latency of the turns (from sending a message to
+the last reply it was waiting for) by kind of turn, the throughput and the
+peak rss of the server processes, and the websocket frames per turn
+(with --batch the clients negotiate batched replies, with --compact also
+compact cards). With --json the results are appended to
+a file as a json line, along with the commit, to track them over time.
+Run with e.g.:
+python3.6 -m benchmarks.bench_load --clients 200 --sessions 3 --answers 20
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import aiohttp
+from aiohttp import web
+from anki.storage import Collection
+import rememberberry
+from rememberberry import ipfs, outbound, auth
+from rememberberry.anki_integration import anki_col_path
+from rememberberry.fakes import FakeIPFS
+
+PASSWORD = 'loadtest-password'
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _run_fake_ipfs(port, mount_path):
+    web.run_app(FakeIPFS(mount_path).app, host='127.0.0.1', port=port, print=None)
+
+
+def _make_collection(path, num_decks, num_cards):
+    col = Collection(path)
+    model = col.models.byName('Basic')
+    for i in range(num_cards):
+        model['did'] = col.decks.id('Deck %i' % (i % num_decks))
+        note = col.newNote()
+        note['Front'] = 'Question %i <b>%s</b>' % (i, 'lorem ipsum ' * (i % 10))
+        note['Back'] = 'Answer %i' % i
+        col.addNote(note)
+    col.close()
+
+
+def _username(i):
+    return 'loaduser%i' % i
+
+
+async def _seed(args, template):
+    """Gives every user the same synthetic collection"""
+    ipfs_hash = await ipfs.add_files(template)
+    for i in range(args.clients):
+        col_path = anki_col_path(_username(i))
+        await ipfs.mfs_mkdirs(os.path.dirname(col_path))
+        await ipfs.cp_ipfs_to_mfs('/ipfs/%s' % ipfs_hash, col_path)
+
+
+def _children(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # The ppid is the second field after the parenthesized name
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(name))
+    return children
+
+
+def _rss(pid):
+    """The rss in bytes of pid and its child processes"""
+    total = 0
+    for p in [pid] + _children(pid):
+        try:
+            with open('/proc/%i/status' % p) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+async def _sample_rss(pid, samples, interval=0.5):
+    while True:
+        samples.append(_rss(pid))
+        await asyncio.sleep(interval)
+
+
+def _parse(data):
+    try:
+        reply = json.loads(data)
+    except ValueError:
+        reply = None
+    return reply if isinstance(reply, dict) else {'content': data}
+
+
+def _text(reply):
+    content = reply.get('content')
+    return content if isinstance(content, str) else ''
+
+
+def _contains(marker):
+    return lambda reply: marker in _text(reply)
+
+
+def _study_done(reply):
+    content = reply.get('content')
+    return ((isinstance(content, dict) and content.get('type') == 'card') or
+            'scheduled cards are done' in _text(reply) or
+            'no cards in your collection' in _text(reply))
+
+
+def _sync_done(reply):
+    return ('What would you like to do?' in _text(reply) or
+            'try again' in _text(reply))
+
+
+class TurnError(Exception):
+    pass
+
+
+class _Client:
+    def __init__(self, index, url, args, latencies):
+        self.index = index
+        self.url = url
+        self.args = args
+        self.latencies = latencies
+        self.random = random.Random(index)
+        self.auth_token = None
+        self.ws = None
+        self.frames = 0
+        self._buffer = []
+
+    async def turn(self, kind, text, done):
+        """Sends text and waits for the reply that done() accepts, returns
+        the replies up to and including it"""
+        if self.args.think:
+            await asyncio.sleep(self.random.uniform(0, 2 * self.args.think))
+        start = time.monotonic()
+        await self.ws.send_str(text)
+        replies = []
+        while True:
+            if not self._buffer:
+                try:
+                    msg = await asyncio.wait_for(self.ws.receive(), self.args.timeout)
+                except asyncio.TimeoutError:
+                    raise TurnError('%s timed out' % kind)
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    raise TurnError('connection closed during %s' % kind)
+                self.frames += 1
+                if outbound.batched(self.ws.protocol):
+                    self._buffer = json.loads(msg.data)
+                else:
+                    self._buffer = [msg.data]
+            reply = _parse(self._buffer.pop(0))
+            replies.append(reply)
+            if done(reply):
+                break
+        self.latencies.setdefault(kind, []).append(time.monotonic() - start)
+        return replies
+
+    def _connect(self, session):
+        self._buffer = []
+        if self.args.compact:
+            protocols = [outbound.COMPACT_PROTOCOL]
+        elif self.args.batch:
+            protocols = [outbound.BATCH_PROTOCOL]
+        else:
+            protocols = []
+        url = self.url
+        account = self.auth_token and auth.token_account(self.auth_token)
+        if account is not None:
+            # Lets the server route the connection to the worker with the collection
+            url = '%s?account=%s' % (url, account)
+        return session.ws_connect(url, protocols=protocols)
+
+    async def sign_up(self, session):
+        async with self._connect(session) as self.ws:
+            await self.turn('sign_up', '', _contains('Have we met before?'))
+            await self.turn('sign_up', 'no', _contains('What\'s your name?'))
+            await self.turn('sign_up', 'Load %i' % self.index, _contains('username'))
+            await self.turn('sign_up', _username(self.index), _contains('password'))
+            await self.turn('sign_up', PASSWORD, _contains('password again'))
+            replies = await self.turn('sign_up', PASSWORD, _contains('Anki account'))
+            for reply in replies:
+                if _text(reply).startswith('auth_token='):
+                    self.auth_token = _text(reply)[len('auth_token='):]
+            if self.auth_token is None:
+                raise TurnError('no auth token after signing up')
+            if not self.args.sync:
+                await self.turn('sign_up', 'no', _contains('What would you like to do?'))
+                return
+            await self.turn('sign_up', 'yes', _contains('Anki username'))
+            await self.turn('sign_up', _username(self.index), _contains('password'))
+            replies = await self.turn('sync', PASSWORD, _sync_done)
+            if not _contains('What would you like to do?')(replies[-1]):
+                raise TurnError('syncing failed: %s' % ' '.join(_text(r) for r in replies))
+
+    async def session(self, session):
+        async with self._connect(session) as self.ws:
+            await self.turn('login', 'auth_token=%s' % self.auth_token,
+                            _contains('What would you like to do?'))
+
+            replies = await self.turn('decks', 'decks', _contains('Here are your decks'))
+            num_decks = len(replies[-1].get('replies') or []) or 1
+            await self.turn('select_deck', str(self.random.randint(1, num_decks)),
+                            _contains('Selected deck'))
+
+            replies = await self.turn('study', 'study', _study_done)
+            for i in range(self.args.answers):
+                buttons = replies[-1].get('replies')
+                if not isinstance(replies[-1].get('content'), dict) or not buttons:
+                    break
+                # Mostly good, sometimes again or easy
+                ease = self.random.choice([1] + [min(3, len(buttons))] * 3 + [len(buttons)])
+                replies = await self.turn('answer', str(ease), _study_done)
+
+
+async def _run_client(client, session, errors):
+    try:
+        for i in range(client.args.sessions):
+            await client.session(session)
+    except (TurnError, aiohttp.ClientError) as e:
+        errors.append('client %i: %s' % (client.index, e))
+
+
+async def _sign_up(client, session, errors, semaphore):
+    async with semaphore:
+        try:
+            await client.sign_up(session)
+        except (TurnError, aiohttp.ClientError) as e:
+            errors.append('client %i: %s' % (client.index, e))
+
+
+async def _wait_for_server(port, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('the server exited with %i' % process.returncode)
+            try:
+                async with session.get('http://127.0.0.1:%i/metrics' % port) as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('the server didn\'t start in %is' % timeout)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100.0), len(values) - 1)]
+
+
+def _summary(latencies):
+    return {
+        'turns': len(latencies),
+        'p50': _percentile(latencies, 50),
+        'p95': _percentile(latencies, 95),
+        'p99': _percentile(latencies, 99),
+        'max': max(latencies),
+    }
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _load(args, port, server):
+    url = 'http://127.0.0.1:%i/' % port
+    latencies = {}
+    errors = []
+    clients = [_Client(i, url, args, latencies) for i in range(args.clients)]
+    rss_samples = []
+    sampler = asyncio.ensure_future(_sample_rss(server.pid, rss_samples))
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        semaphore = asyncio.Semaphore(args.signup_concurrency)
+        start = time.monotonic()
+        await asyncio.gather(*[_sign_up(c, session, errors, semaphore) for c in clients])
+        signup_time = time.monotonic() - start
+        idle_rss = _rss(server.pid)
+
+        start = time.monotonic()
+        await asyncio.gather(*[_run_client(c, session, errors) for c in clients
+                               if c.auth_token is not None])
+        session_time = time.monotonic() - start
+    sampler.cancel()
+
+    session_turns = sum(len(v) for k, v in latencies.items() if k != 'sign_up')
+    all_latencies = [l for v in latencies.values() for l in v]
+    return {
+        'commit': _commit(),
+        'time': time.time(),
+        'args': vars(args),
+        'errors': len(errors),
+        'error_samples': errors[:10],
+        'signup_time': signup_time,
+        'session_time': session_time,
+        'turns_per_second': session_turns / session_time if session_time else 0.0,
+        'frames_per_turn': (sum(c.frames for c in clients) /
+                            sum(len(v) for v in latencies.values()) if latencies else 0.0),
+        'rss_after_signup': idle_rss,
+        'rss_peak': max(rss_samples + [idle_rss]),
+        'latency': _summary(all_latencies) if all_latencies else None,
+        'latency_by_kind': {kind: _summary(v) for kind, v in sorted(latencies.items())},
+    }
+
+
+def _report(results):
+    print('%i clients, %i sessions each, %i errors' % (
+        results['args']['clients'], results['args']['sessions'], results['errors']))
+    for error in results['error_samples']:
+        print('  %s' % error)
+    print('sign up:  %8.2fs' % results['signup_time'])
+    print('sessions: %8.2fs, %.1f turns/s' % (
+        results['session_time'], results['turns_per_second']))
+    print('%.2f frames per turn' % results['frames_per_turn'])
+    print('server rss: %.1f MB after sign up, %.1f MB peak' % (
+        results['rss_after_signup'] / 1e6, results['rss_peak'] / 1e6))
+    print('%-12s %8s %9s %9s %9s %9s' % ('turn', 'count', 'p50', 'p95', 'p99', 'max'))
+    rows = sorted(results['latency_by_kind'].items())
+    if results['latency'] is not None:
+        rows.append(('all', results['latency']))
+    for kind, s in rows:
+        print('%-12s %8i %8.1fms %8.1fms %8.1fms %8.1fms' % (
+            kind, s['turns'], s['p50'] * 1000, s['p95'] * 1000, s['p99'] * 1000,
+            s['max'] * 1000))
+
+
+async def _start_ipfs(timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return await ipfs.init()
+        except Exception:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def run(args, storage_args, work_path):
+    await _start_ipfs()
+    template = os.path.join(work_path, 'template.anki2')
+    _make_collection(template, args.decks, args.cards)
+    if args.sync:
+        storage_args = storage_args + ['--fake-ankiweb', template]
+    else:
+        await _seed(args, template)
+    await ipfs.flush_root_hash()
+    await ipfs.API.close()
+
+    port = args.port or _free_port()
+    cmd = [sys.executable, '-m', 'rememberberry.server', '--port', str(port),
+           '--loglvl', 'WARNING', '--workers', str(args.workers)]
+    server = subprocess.Popen(
+        cmd + storage_args + args.server_args,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(rememberberry.__file__))))
+    try:
+        await _wait_for_server(port, server)
+        results = await _load(args, port, server)
+    finally:
+        if server.poll() is None:
+            # Lets it write back the collections, like a normal shutdown
+            server.send_signal(signal.SIGINT)
+            try:
+                server.wait(60)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    _report(results)
+    if args.json:
+        with open(args.json, 'a') as f:
+            f.write(json.dumps(results, sort_keys=True) + '\n')
+
+
+def main(args):
+    work_path = tempfile.mkdtemp(prefix='rememberberry-load-')
+    fake = None
+    if args.storage == 'local':
+        ipfs.BACKEND = 'local'
+        ipfs.LOCAL_PATH = os.path.join(work_path, 'store')
+        storage_args = ['--storage', 'local', '--storage-path', ipfs.LOCAL_PATH]
+    else:
+        mount_path = os.path.join(work_path, 'ipfs')
+        os.mkdir(mount_path)
+        ipfs.API_HOST, ipfs.API_PORT = '127.0.0.1', _free_port()
+        storage_args = ['--ipfs-host', ipfs.API_HOST, '--ipfs-port', str(ipfs.API_PORT),
+                        '--ipfs-mount', mount_path]
+        # Forked before there's an event loop, so the fake gets its own
+        fake = multiprocessing.Process(
+            target=_run_fake_ipfs, args=(ipfs.API_PORT, mount_path))
+        fake.start()
+    try:
+        asyncio.get_event_loop().run_until_complete(run(args, storage_args, work_path))
+    finally:
+        if fake is not None:
+            fake.terminate()
+            fake.join()
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the websocket server')
+    parser.add_argument("--clients", help="number of concurrent users", type=int, default=200)
+    parser.add_argument("--sessions", help="sessions per user after signing up",
+                        type=int, default=3)
+    parser.add_argument("--answers", help="max cards answered per session",
+                        type=int, default=20)
+    parser.add_argument("--cards", help="cards in each user's collection",
+                        type=int, default=200)
+    parser.add_argument("--decks", help="decks in each user's collection", type=int, default=4)
+    parser.add_argument("--think", help="mean seconds that users wait before each message",
+                        type=float, default=0.0)
+    parser.add_argument("--signup-concurrency", help="max users signing up at once",
+                        type=int, default=50)
+    parser.add_argument("--timeout", help="seconds to wait for a reply", type=float,
+                        default=60.0)
+    parser.add_argument("--workers", help="server worker processes", type=int, default=0)
+    parser.add_argument("--storage", help="run against a fake ipfs daemon, or a local store",
+                        type=str, choices=ipfs.BACKENDS, default='ipfs')
+    parser.add_argument("--port", help="server port, a free one by default", type=int)
+    parser.add_argument("--sync", help="sign up with a fake ankiweb account, and sync it",
+                        action="store_true")
+    parser.add_argument("--batch", help="negotiate batched replies", action="store_true")
+    parser.add_argument("--compact", help="negotiate batched replies and compact cards",
+                        action="store_true")
+    parser.add_argument("--json", help="file to append the results to", type=str)
+    parser.add_argument("server_args", nargs=argparse.REMAINDER,
+                        help="extra arguments for server.py, after --")
+    args = parser.parse_args()
+    if args.server_args[:1] == ['--']:
+        args.server_args = args.server_args[1:]
+    main(args)
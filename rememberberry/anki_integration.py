@@ -1,5 +1,9 @@
 import os
+import sys
 import json
+import time
+import socket
+import logging
 import asyncio
 import traceback
 from string import Template
@@ -8,10 +12,12 @@ import anki
 import anki.storage
 from anki.storage import Collection
 from anki.sched import Scheduler
-from anki.sync import FullSyncer, RemoteServer, MediaSyncer, RemoteMediaServer
+from anki.sync import Syncer, FullSyncer, RemoteServer, MediaSyncer, RemoteMediaServer
 import rememberberry
 from rememberberry.auth import account_hex
-from rememberberry import ipfs
+from rememberberry import ipfs, executors, render_cache, metrics, resync, jobs, media
+from rememberberry.collection_pool import POOL
+from rememberberry.media_sync import ParallelMediaSyncer
 
 PROGRESS_TMPL = Template(
 """<div>
@@ -20,17 +26,20 @@ PROGRESS_TMPL = Template(
     <span style="color: red; ${red_ul}">${red}</span>
 </div>""")
 
+# Min seconds between media download progress messages
+PROGRESS_INTERVAL = 2.0
+
 def _get_hkey(anki_username, anki_password):
     try:
-        return RemoteServer(None).hostKey(anki_username, anki_password)
+        return ANKIWEB.host_key(anki_username, anki_password)
     except:
         logging.info('anki auth with: %s %s didn\'t work' % (anki_username, anki_password))
         return None
 
 
 async def get_anki_hkey(anki_username, anki_password):
-    return await asyncio.get_event_loop().run_in_executor(
-        None, partial(_get_hkey, anki_username, anki_password))
+    async with jobs.JOBS.job('auth', anki_username):
+        return await executors.run_in('anki', _get_hkey, anki_username, anki_password)
 
 
 def get_user_dir(username):
@@ -41,58 +50,205 @@ def anki_col_path(username):
     return os.path.join(get_user_dir(username), 'collection.anki2')
 
 
+def anki_media_path(username):
+    # Anki keeps the media next to the collection
+    return os.path.join(get_user_dir(username), 'collection.media')
+
+
 async def get_anki_col(username):
-    ipfs_ctx = ipfs.MutableFileContext(
-        ext='anki2', mfs_path=anki_col_path(username))
-    await ipfs_ctx.__aenter__()
-    col = Collection(ipfs_ctx.fs_path)
-
-    # Set a sync hook that exits the ipfs file context when the storage is
-    # synced
-    async def sync_hook():
-        logging.info('running sync_hook')
-        await ipfs_ctx.__aexit__()
-    col.__sync_hook__ = sync_hook
+    """Returns the user's collection from the collection pool, it has to be
+    given back with release_anki_col() when the session is done with it"""
+    col = await POOL.acquire(username, anki_col_path(username))
+    if not hasattr(col, '__media_hashes__'):
+        await media.load_hashes(col, anki_media_path(username))
     return col
 
 
-def _sync_anki(col_path, anki_hkey):
+async def release_anki_col(col):
+    await POOL.release(col)
+
+
+def _format_progress(files_done, files_total, bytes_done):
+    return 'Downloaded %i of %i media files (%.1f MB)' % (
+        files_done, files_total, bytes_done / 1e6)
+
+
+class AnkiWeb:
+    """The ankiweb servers, for the user with anki_hkey"""
+    def __init__(self, anki_hkey):
+        self.anki_hkey = anki_hkey
+        self.server = RemoteServer(anki_hkey)
+
+    @staticmethod
+    def host_key(anki_username, anki_password):
+        """Logs in to ankiweb, and returns the hkey of the user"""
+        return RemoteServer(None).hostKey(anki_username, anki_password)
+
+    def sync_server(self):
+        return self.server
+
+    def download(self, col):
+        """Replaces the collection col with the one on ankiweb, closing col"""
+        FullSyncer(col, self.anki_hkey, self.server.client).download()
+
+    def media_server(self, col):
+        return RemoteMediaServer(col, self.anki_hkey, self.server.client)
+
+
+# Called with the hkey to connect to ankiweb, and has host_key() to log in,
+# tests and load tests use fakes.FakeAnkiWeb
+ANKIWEB = AnkiWeb
+
+
+def _sync_collection(col_path, web, incremental):
+    """Syncs the collection at col_path, and returns it (reopened if it was
+    replaced) along with 'noChanges', 'incremental' or 'full'. Incremental
+    syncs fall back to a full download when ankiweb asks for a full sync"""
+    col = Collection(col_path)
+    if incremental:
+        ret = Syncer(col, web.sync_server()).sync()
+        if ret in ['noChanges', 'success']:
+            return col, 'noChanges' if ret == 'noChanges' else 'incremental'
+        if ret != 'fullSync':
+            col.close()
+            raise RuntimeError('anki sync failed: %s' % ret)
+        logging.info('ankiweb asked for a full sync, downloading the collection')
+    web.download(col)
+    return Collection(col_path), 'full' # reload collection
+
+
+def _failed_status(exc):
+    """The status label of a sync that raised exc"""
+    if isinstance(exc, (socket.timeout, TimeoutError)) or 'Timeout' in type(exc).__name__:
+        return 'timeout'
+    return 'failed'
+
+
+def _sync_anki(col_path, anki_hkey, progress=None, incremental=False, media=True):
+    """Syncs the collection at col_path with ankiweb, and its media unless
+    media=False. Returns (status, traceback) where status is None if the
+    sync failed, see _sync_collection"""
+    start = time.monotonic()
+    label = 'failed'
     try:
-        col = Collection(col_path)
+        web = ANKIWEB(anki_hkey)
+        col, status = _sync_collection(col_path, web, incremental)
+        if media:
+            media_client = ParallelMediaSyncer(col, web.media_server(col), progress=progress)
+            media_client.sync()
+        col.close(save=True)
+        label = status
+    except:
+        label = _failed_status(sys.exc_info()[1])
+        return None, traceback.format_exc()
+    finally:
+        metrics.ANKI_SYNC.observe(time.monotonic() - start, label)
+    return status, None
 
-        server = RemoteServer(anki_hkey)
-        client = FullSyncer(col, anki_hkey, server.client)
-        client.download()
-        col = Collection(col_path) # reload collection
 
-        media_server = RemoteMediaServer(col, anki_hkey, server.client)
-        media_client = MediaSyncer(col, media_server)
-        media_client.sync()
+def _sync_anki_media(col_path, anki_hkey):
+    """Syncs only the media of the collection at col_path"""
+    try:
+        col = Collection(col_path)
+        web = ANKIWEB(anki_hkey)
+        ParallelMediaSyncer(col, web.media_server(col)).sync()
         col.close(save=True)
     except:
         return traceback.format_exc()
 
 
+async def sync_anki(username, anki_hkey):
+    """Syncs the collection of a user who synced before. Only the collection
+    file is checked out for the delta sync, the media folder only if the
+    collection changed. The pooled collection is written back and closed
+    first, and sessions get it back once the sync is done.
+
+    Returns (status, traceback) like _sync_anki, where both are None if the
+    collection was in use and so not synced"""
+    if not await POOL.suspend(username):
+        return None, None
+    try:
+        col_path = anki_col_path(username)
+        ctx = ipfs.MutableFileContext(ext='anki2', mfs_path=col_path)
+        await ctx.__aenter__()
+        try:
+            status, err = await executors.run_in(
+                'anki', _sync_anki, ctx.fs_path, anki_hkey, incremental=True, media=False)
+            if err is None and status != 'noChanges':
+                await ctx.sync()
+        finally:
+            await ctx.remove()
+        if err is not None or status == 'noChanges':
+            return status, err
+
+        # Anki keeps the media next to the collection
+        folder_ctx = ipfs.MutableFolderContext(os.path.dirname(col_path))
+        async with folder_ctx:
+            err = await executors.run_in(
+                'anki', _sync_anki_media,
+                os.path.join(folder_ctx.fs_path, os.path.basename(col_path)), anki_hkey)
+        return (None, err) if err is not None else (status, None)
+    finally:
+        POOL.resume(username)
+
+
 async def initial_anki_sync(username, anki_hkey, storage):
     """Downloads a users's anki database and media files to rememberberry"""
 
     yield 'Syncing anki database and media (this may take a while if you have lots of media)'
-    # Make user dir if not exists
-    await ipfs.mfs_mkdirs(get_user_dir(username))
-
-    # Need to set up a folder context for anki syncing
-    # Since anki writes media files in the same folder as the collection
-    col_path = anki_col_path(username)
-    col_dir = os.path.dirname(col_path)
-    ctx = ipfs.MutableFolderContext(col_dir)
-    async with ctx:
-        fs_col_path = os.path.join(ctx.fs_path, os.path.basename(col_path))
-        err = await asyncio.get_event_loop().run_in_executor(
-            None, partial(_sync_anki, fs_col_path, anki_hkey))
-        logging.info('sync done')
-        if err is not None:
-            yield err
-
+    # Syncs are heavy, only a few run at once
+    job = jobs.JOBS.job('sync', username)
+    try:
+        async for position in job.positions():
+            yield 'Waiting for other syncs to finish, you are number %i in line' % position
+        # Make user dir if not exists
+        await ipfs.mfs_mkdirs(get_user_dir(username))
+
+        col_path = anki_col_path(username)
+        if await ipfs.mfs_hash(col_path):
+            # They have a collection already, a delta sync is enough
+            status, err = await sync_anki(username, anki_hkey)
+            if status is None and err is None:
+                err = 'Your collection is in use, try again after studying'
+        elif not await POOL.suspend(username):
+            err = 'Your collection is in use, try again after studying'
+        else:
+            try:
+                # Need to set up a folder context for anki syncing
+                # Since anki writes media files in the same folder as the collection
+                col_dir = os.path.dirname(col_path)
+                ctx = ipfs.MutableFolderContext(col_dir)
+                async with ctx:
+                    fs_col_path = os.path.join(ctx.fs_path, os.path.basename(col_path))
+
+                    # The media syncer reports its progress from the executor thread
+                    loop = asyncio.get_event_loop()
+                    updates = asyncio.Queue()
+                    def progress(*args):
+                        loop.call_soon_threadsafe(updates.put_nowait, args)
+
+                    sync = asyncio.ensure_future(
+                        executors.run_in('anki', _sync_anki, fs_col_path, anki_hkey, progress))
+                    last_report = time.monotonic()
+                    while not sync.done():
+                        update = asyncio.ensure_future(updates.get())
+                        await asyncio.wait([sync, update], return_when=asyncio.FIRST_COMPLETED)
+                        if not update.done():
+                            update.cancel()
+                            continue
+                        latest = update.result()
+                        while not updates.empty():
+                            latest = updates.get_nowait()
+                        if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                            last_report = time.monotonic()
+                            yield _format_progress(*latest)
+
+                    status, err = sync.result()
+                    logging.info('sync done')
+            finally:
+                POOL.resume(username)
+    finally:
+        job.done()
 
     if err is not None:
         storage['anki_sync_successful'] = False
@@ -106,6 +262,15 @@ async def initial_anki_sync(username, anki_hkey, storage):
     storage['anki_sync_successful'] = True
 
 
+async def _resync_anki(username, anki_hkey):
+    async with jobs.JOBS.job('resync', username):
+        return await sync_anki(username, anki_hkey)
+
+
+# Re-syncs the collections of active users in the background
+RESYNC = resync.Resyncer(_resync_anki)
+
+
 def _remaining_counts(scheduler, card):
     if not scheduler.col.conf['dueCounts']:
         return None, None
@@ -131,10 +296,22 @@ def _get_timing(scheduler, card, ease):
     return scheduler.nextIvlStr(card, ease, True)
 
 
-def format_anki_question(scheduler, card, storage):
-    question = card.q()
+def _compact_back(front, back):
+    """The back as the length of its common prefix with the front, in utf-16
+    code units like javascript's string indices, and the rest. With anki's
+    default templates the back starts with the whole front"""
+    if back.startswith(front):
+        prefix = front
+    else:
+        prefix = os.path.commonprefix([front, back])
+    return len(prefix.encode('utf-16-le')) // 2, back[len(prefix):]
+
+
+def _render_question(scheduler, card, compact=False):
+    """Returns the card reply and its number of answer buttons. In the
+    compact format the back is sent as a delta against the front, and the
+    progress as counts rather than html, see _compact_back()"""
     num_answer_buttons = scheduler.answerButtons(card)
-    storage['_num_answer_buttons'] = num_answer_buttons
     buttons = []
     color_map = {
         'Again': 'red',
@@ -150,8 +327,27 @@ def format_anki_question(scheduler, card, storage):
             'color': color_map[label]
         })
 
+    front, back = render_cache.for_collection(scheduler.col).render(card)
+    front, back = media.rewrite(scheduler.col, front), media.rewrite(scheduler.col, back)
     counts, idx = _remaining_counts(scheduler, card)
+    if compact:
+        back_prefix, back_rest = _compact_back(front, back)
+        return {
+            'content': {
+                'type': 'card',
+                'front': front,
+                'back_prefix': back_prefix,
+                'back': back_rest,
+                'progress': None if counts is None else {
+                    'new': counts[0], 'learning': counts[1], 'review': counts[2],
+                    'current': idx},
+            },
+            'replies': buttons
+        }, num_answer_buttons
+
     def prepend_progress(html):
+        if counts is None:
+            return html
         ulstr = "text-decoration: underline"
         return (PROGRESS_TMPL.substitute(
             blue=counts[0], red=counts[1], green=counts[2],
@@ -161,11 +357,23 @@ def format_anki_question(scheduler, card, storage):
     return {
         'content': {
             'type': 'card',
-            'front': prepend_progress(card.q()),
-            'back': prepend_progress(card.a())
+            'front': prepend_progress(front),
+            'back': prepend_progress(back)
         },
         'replies': buttons
-    }
+    }, num_answer_buttons
+
+
+def _compact_cards(storage):
+    """Whether the session's client takes the compact card format, the
+    server sets it when it's negotiated"""
+    return getattr(storage, 'compact_cards', False)
+
+
+def format_anki_question(scheduler, card, storage):
+    reply, num_answer_buttons = _render_question(scheduler, card, _compact_cards(storage))
+    storage['_num_answer_buttons'] = num_answer_buttons
+    return reply
 
 
 def answer_card(scheduler, card, msg):
@@ -173,6 +381,88 @@ def answer_card(scheduler, card, msg):
     scheduler.answerCard(card, ease=ease)
 
 
+# Counters for all CardLookaheads
+LOOKAHEAD_STATS = {'hits': 0, 'misses': 0, 'discarded': 0}
+
+
+class CardLookahead:
+    """Fetches and renders the next card while the user is still answering
+    the current one, so that it's ready as soon as they answer.
+
+    Anki collections can only be used from the thread that opened them, so
+    the lookahead runs on the event loop, but after the current card was
+    sent (see outbound.Writer.after_turn) rather than between the answer and
+    the next card. Getting a card
+    takes it off the scheduler's queues, so if answering the current card
+    changes the queues (e.g. it goes back into learning, or its siblings are
+    buried) the prefetched card is thrown away and the queues rebuilt"""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self._next = None # (card, reply, num answer buttons, counts after get)
+        self._handle = None
+        self._compact = False # format of the session, as of the last card
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _discard(self):
+        self._next = None
+        LOOKAHEAD_STATS['discarded'] += 1
+        self.scheduler.reset()
+
+    def _prefetch(self):
+        self._handle = None
+        card = self.scheduler.getCard()
+        if card is None:
+            return
+        reply, num_answer_buttons = _render_question(self.scheduler, card, self._compact)
+        self._next = (card, reply, num_answer_buttons, self.scheduler.counts(), self._compact)
+
+    def get_card(self):
+        """Returns the next card, like scheduler.getCard()"""
+        self._cancel()
+        if self._next is not None:
+            card = self._next[0]
+            # The time taken to answer counts from when it's shown
+            card.startTimer()
+            LOOKAHEAD_STATS['hits'] += 1
+            return card
+        LOOKAHEAD_STATS['misses'] += 1
+        return self.scheduler.getCard()
+
+    def format_question(self, card, storage):
+        """Like format_anki_question(), and starts prefetching the card
+        after this one"""
+        self._compact = _compact_cards(storage)
+        if (self._next is not None and self._next[0] is card and
+            self._next[4] == self._compact):
+            card, reply, num_answer_buttons, counts, compact = self._next
+            self._next = None
+        else:
+            reply, num_answer_buttons = _render_question(self.scheduler, card, self._compact)
+        storage['_num_answer_buttons'] = num_answer_buttons
+
+        self._cancel()
+        out = getattr(storage, 'outbound', None)
+        if out is not None:
+            self._handle = out.after_turn(self._prefetch)
+        else:
+            self._handle = asyncio.get_event_loop().call_soon(self._prefetch)
+        return reply
+
+    def answer(self, card, msg):
+        """Like answer_card()"""
+        self._cancel()
+        answer_card(self.scheduler, card, msg)
+        if self._next is None:
+            return
+        next_card, reply, num_answer_buttons, counts, compact = self._next
+        if next_card.nid == card.nid or self.scheduler.counts() != counts:
+            self._discard()
+
+
 def format_deck_replies(decks):
     def make_reply_button(name, did, rev, lrn, new, idx):
         return {
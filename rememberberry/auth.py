@@ -5,9 +5,14 @@ from secrets import token_hex
 import aiofiles
 import rememberberry
 from rememberberry import ipfs
+from rememberberry.tokens import TokenStore
 
-# Store auth tokens -> (username, password) map in memory for login with tokens
-ACTIVE_AUTH_TOKENS = {}
+# Store auth tokens -> (account, password hex) map for login with tokens
+ACTIVE_AUTH_TOKENS = TokenStore()
+
+# Index of this server process and the number of them, see workers.py
+WORKER = None
+NUM_WORKERS = 0
 
 def account_hex(username):
     return hashlib.sha256(bytes(username, 'utf-8')).hexdigest()
@@ -17,33 +22,75 @@ def account_password_hex(username, password):
     return hashlib.sha256(bytes(username+password, 'utf-8')).hexdigest()
 
 
-def data_file(username):
-    file_path = '%s/data.pickle' % account_hex(username)
-    return os.path.join(ipfs.DATA_ROOT, 'users', file_path)
+def tokens_file(worker=None):
+    if worker is None:
+        return os.path.join(ipfs.DATA_ROOT, 'auth_tokens.json')
+    return os.path.join(ipfs.DATA_ROOT, 'auth_tokens.%i.json' % worker)
 
 
-def auth_file(username, password):
-    file_path = '%s/%s.auth' % (account_hex(username),
-                                account_password_hex(username, password))
-    return os.path.join(ipfs.DATA_ROOT, 'users', file_path)
+def token_account(auth_token):
+    """Returns the account hex that the token was generated for, or None
+    for tokens without one"""
+    account, sep, rest = auth_token.partition('.')
+    return account if sep and len(account) == 64 else None
 
 
-async def login(username, password, storage):
-    if (not await ipfs.mfs_hash(data_file(username)) or
-        not await ipfs.mfs_hash(auth_file(username, password))):
+def _data_file(account):
+    return os.path.join(ipfs.DATA_ROOT, 'users', '%s/data.pickle' % account)
+
+
+def _auth_file(account, password_hex):
+    return os.path.join(ipfs.DATA_ROOT, 'users', '%s/%s.auth' % (account, password_hex))
+
+
+def data_file(username):
+    return _data_file(account_hex(username))
+
+
+def auth_file(username, password):
+    return _auth_file(account_hex(username), account_password_hex(username, password))
+
+
+async def init():
+    """Loads the persisted auth tokens, needs ipfs to be initialized"""
+    if ACTIVE_AUTH_TOKENS.path is None:
+        if WORKER is None:
+            await ACTIVE_AUTH_TOKENS.load(tokens_file())
+        else:
+            # Tokens from the other workers, and from before there were any
+            peers = [tokens_file(i) for i in range(NUM_WORKERS) if i != WORKER]
+            await ACTIVE_AUTH_TOKENS.load(tokens_file(WORKER), peers + [tokens_file()])
+        ACTIVE_AUTH_TOKENS.start()
+
+
+async def _login(account, password_hex, storage):
+    if WORKER is not None:
+        # Another worker might have changed the account since it was cached
+        ipfs.HASH_CACHE.invalidate(os.path.dirname(_data_file(account)))
+    if (not await ipfs.mfs_hash(_data_file(account)) or
+        not await ipfs.mfs_hash(_auth_file(account, password_hex))):
         return False
 
-    storage.filename = data_file(username)
+    storage.filename = _data_file(account)
     await storage.load()
     return True
 
 
+async def login(username, password, storage):
+    return await _login(
+        account_hex(username), account_password_hex(username, password), storage)
+
+
 async def login_with_token(auth_token, storage):
-    logging.info('logging in with token %s' % auth_token)
-    if auth_token not in ACTIVE_AUTH_TOKENS:
+    logging.info('logging in with token')
+    credentials = ACTIVE_AUTH_TOKENS.get(auth_token)
+    if credentials is None and await ACTIVE_AUTH_TOKENS.refresh():
+        # It might have been generated by another worker
+        credentials = ACTIVE_AUTH_TOKENS.get(auth_token)
+    if credentials is None:
         logging.info('token not active')
         return False
-    return await login(*ACTIVE_AUTH_TOKENS[auth_token], storage)
+    return await _login(*credentials, storage)
 
 
 async def create_account(username, password, storage):
@@ -56,15 +103,18 @@ async def create_account(username, password, storage):
 
 
 def generate_auth_token(username, password):
-    token = token_hex(16)
-    ACTIVE_AUTH_TOKENS[token] = (username, password)
+    # Prefixed with the account so that it can be routed to its worker
+    token = '%s.%s' % (account_hex(username), token_hex(16))
+    ACTIVE_AUTH_TOKENS.add(
+        token, account_hex(username), account_password_hex(username, password))
     return token
 
 
 async def validate_username(username):
     if len(username) == 0:
         return "The username has to contain, you know... something"
-    if await ipfs.mfs_hash(data_file(username)):
+    # Not cached, another worker might have created it
+    if await ipfs.mfs_hash(data_file(username), cached=False):
         return "Sorry, that username is taken by someone else"
     return None
 
@@ -0,0 +1,394 @@
+"""
+A bounded pool of open anki collections, keyed by username
+
+Checking out a collection means copying the whole collection.anki2 out of
+ipfs, and writing it back means re-adding all of it, so instead of doing
+that for every study session the collections are kept open between
+sessions. Changes are written back to mfs when the collection is dirty,
+at most once per writeback_delay, and when it's evicted from the pool or
+the server shuts down
+
+The collections can only be used from the thread that opened them, which
+is the event loop's, so writing one back only saves it on the loop. The
+copy that's written back is taken in the anki executor with a connection
+of its own (anki keeps collections in wal mode, so it doesn't get in the
+way of the sessions using the collection meanwhile)
+"""
+import os
+import shutil
+import sqlite3
+import asyncio
+import logging
+from collections import OrderedDict
+from anki.storage import Collection
+from rememberberry import ipfs, executors, metrics, jobs
+
+
+class _Entry:
+    def __init__(self, username, ctx, col):
+        self.username = username
+        self.ctx = ctx
+        self.col = col
+        self.refs = 0
+        self.written_mod = col.mod
+        self.flush_handle = None
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+        self.mfs_hash = None # as last read or written, when using leases
+
+    def is_dirty(self):
+        return self.col.db.mod or self.col.mod != self.written_mod
+
+
+def _media_paths(fs_path):
+    """Anki keeps the media folder and database next to the collection"""
+    base = os.path.splitext(fs_path)[0]
+    return base + '.media', base + '.media.db2'
+
+
+def _checkpoint(fs_path):
+    """Moves what was committed to the wal into the collection file, as far
+    as the readers allow"""
+    db = sqlite3.connect(fs_path)
+    try:
+        db.execute('pragma wal_checkpoint(passive)')
+    finally:
+        db.close()
+
+
+def _snapshot(fs_path, snapshot):
+    """Copies the committed state of the collection at fs_path to snapshot,
+    as a single file"""
+    _checkpoint(fs_path)
+    db = sqlite3.connect(fs_path, isolation_level=None)
+    try:
+        # While the read transaction is open, nothing is checkpointed into
+        # the file, and the wal isn't started over unless the file is
+        # already up to date
+        db.execute('begin')
+        db.execute('select count(*) from sqlite_master').fetchone()
+        shutil.copy(fs_path, snapshot)
+        if os.path.exists(fs_path + '-wal'):
+            shutil.copy(fs_path + '-wal', snapshot + '-wal')
+    finally:
+        db.close()
+
+    # Opening the copy recovers the committed transactions from its wal,
+    # leaving out anything torn at the end
+    db = sqlite3.connect(snapshot)
+    try:
+        db.execute('pragma journal_mode = delete')
+    finally:
+        db.close()
+
+
+def _remove_checkout(fs_path):
+    media_dir, media_db = _media_paths(fs_path)
+    shutil.rmtree(media_dir, ignore_errors=True)
+    for path in [fs_path, media_db]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class CollectionPool:
+    def __init__(self, max_size=32, writeback_delay=30.0):
+        self.max_size = max_size
+        self.writeback_delay = writeback_delay
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_failures = 0
+
+        self._entries = OrderedDict()
+        self._opening = {}
+        self._closing = {} # username -> future of writing back and closing
+        self._suspended = {} # username -> event set on resume
+        # Per-user leases when several processes share the collections,
+        # see workers.LeaseManager
+        self.leases = None
+
+    def _find(self, col):
+        for entry in self._entries.values():
+            if entry.col is col:
+                return entry
+        return None
+
+    async def _open(self, username, mfs_path):
+        async with jobs.JOBS.job('study', username):
+            with metrics.COLLECTION.time('open'):
+                ctx = ipfs.MutableFileContext(ext='anki2', mfs_path=mfs_path)
+                await ctx.__aenter__()
+                col = Collection(ctx.fs_path)
+        entry = _Entry(username, ctx, col)
+        if self.leases is not None:
+            entry.mfs_hash = await ipfs.mfs_hash(mfs_path)
+
+        # Storage syncs (e.g. at the end of a session) schedule a write back
+        # if the collection was modified
+        async def sync_hook():
+            self.schedule_flush(col)
+        col.__sync_hook__ = sync_hook
+        return entry
+
+    async def acquire(self, username, mfs_path):
+        """Returns the open collection for username, checking it out from
+        mfs_path if it isn't in the pool. Needs a matching release()"""
+        while username in self._suspended or username in self._closing:
+            if username in self._suspended:
+                await self._suspended[username].wait()
+            else:
+                await self._wait_closing(username)
+        if self.leases is not None:
+            await self.leases.acquire(
+                username, on_acquire=lambda: self._revalidate(username, mfs_path))
+            # Something evicted meanwhile is written back before checking it out
+            await self._wait_closing(username)
+
+        entry = self._entries.get(username)
+        if entry is None and username in self._opening:
+            # Someone else is already checking out this collection
+            entry = await asyncio.shield(self._opening[username])
+
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            fut = asyncio.ensure_future(self._open(username, mfs_path))
+            self._opening[username] = fut
+            try:
+                entry = await asyncio.shield(fut)
+            finally:
+                del self._opening[username]
+
+        self._entries[username] = entry
+        self._entries.move_to_end(username)
+        entry.refs += 1
+        await self._evict()
+        return entry.col
+
+    async def _revalidate(self, username, mfs_path):
+        """Drops the pooled collection of username if another process wrote
+        it back while this one didn't hold the lease"""
+        ipfs.HASH_CACHE.invalidate(mfs_path)
+        entry = self._entries.get(username)
+        if entry is None or entry.refs > 0:
+            return
+        if await ipfs.mfs_hash(mfs_path) != entry.mfs_hash:
+            logging.info('anki collection for %s changed elsewhere' % username)
+            async def discard(entry):
+                # It isn't dirty, the lease is only let go once it's written back
+                await self._flush(entry, close=True)
+                await executors.run_in('fs', _remove_checkout, entry.ctx.fs_path)
+            await self._remove(entry, discard)
+
+    async def _remove(self, entry, close):
+        """Takes entry out of the pool and awaits close(entry). Meanwhile
+        acquire() waits for it, rather than checking out the collection from
+        mfs before it's written back"""
+        if self._entries.get(entry.username) is not entry:
+            # Taken out already (e.g. evicted), and being closed
+            await self._wait_closing(entry.username)
+            return
+        del self._entries[entry.username]
+        fut = asyncio.ensure_future(close(entry))
+        self._closing[entry.username] = fut
+        try:
+            await asyncio.shield(fut)
+        finally:
+            if self._closing.get(entry.username) is fut:
+                del self._closing[entry.username]
+
+    async def _wait_closing(self, username):
+        fut = self._closing.get(username)
+        if fut is None:
+            return
+        try:
+            await asyncio.shield(fut)
+        except Exception:
+            # Whoever is closing it reports that
+            pass
+
+    def _release_lease(self, entry):
+        """Lets other processes have the collection once it's unused and
+        written back"""
+        if self.leases is not None and entry.refs == 0 and not entry.is_dirty():
+            self.leases.release(entry.username)
+
+    async def release(self, col):
+        """Gives back a collection returned by acquire(), and schedules a
+        write back if it was modified"""
+        entry = self._find(col)
+        if entry is None:
+            return
+        entry.refs = max(entry.refs - 1, 0)
+        if entry.is_dirty():
+            if (self.leases is not None and entry.refs == 0 and
+                (not self.leases.is_owner(entry.username) or
+                 self.leases.wanted(entry.username))):
+                # The worker that owns this user will want it next, or
+                # another one is waiting for it already
+                await self._flush(entry)
+            else:
+                self._schedule_flush(entry)
+        self._release_lease(entry)
+        await self._evict()
+
+    async def on_lease_request(self, username):
+        """Another process waits for the lease of username: writes the
+        collection back now rather than after writeback_delay, unless it's
+        in use (then it's written back on release)"""
+        entry = self._entries.get(username)
+        if entry is None or entry.refs > 0:
+            return
+        try:
+            await self._flush(entry)
+        except Exception:
+            self.flush_failures += 1
+            logging.exception('writing back anki collection for %s failed' % username)
+            self._schedule_flush(entry)
+            return
+        self._release_lease(entry)
+
+    def schedule_flush(self, col):
+        """Schedules a write back of col if it was modified"""
+        entry = self._find(col)
+        if entry is not None and entry.is_dirty():
+            self._schedule_flush(entry)
+
+    def _schedule_flush(self, entry):
+        if entry.flush_handle is not None:
+            return
+        def _flush():
+            entry.flush_handle = None
+            entry.flush_task = asyncio.ensure_future(self._scheduled_flush(entry))
+        entry.flush_handle = asyncio.get_event_loop().call_later(
+            self.writeback_delay, _flush)
+
+    async def _scheduled_flush(self, entry):
+        try:
+            await self._flush(entry)
+        except Exception:
+            self.flush_failures += 1
+            logging.exception('writing back anki collection for %s failed, retrying in %.0fs' % (
+                entry.username, self.writeback_delay))
+            if self._entries.get(entry.username) is entry:
+                self._schedule_flush(entry)
+        finally:
+            entry.flush_task = None
+
+    async def _flush(self, entry, close=False):
+        if entry.flush_handle is not None:
+            entry.flush_handle.cancel()
+            entry.flush_handle = None
+
+        async with entry.lock:
+            dirty = entry.is_dirty()
+            if not dirty and not close:
+                return
+
+            col, snapshot = entry.col, None
+            col.save()
+            written_mod, entry.written_mod = entry.written_mod, col.mod
+            if close:
+                # Closing leaves a consistent file on disk (no wal), and
+                # after a checkpoint there's little left for it to do
+                await executors.run_in('anki', _checkpoint, entry.ctx.fs_path)
+                col.close(save=True)
+            else:
+                snapshot = entry.ctx.fs_path + '.writeback'
+
+            if dirty:
+                logging.info('writing back anki collection for %s' % entry.username)
+                try:
+                    with metrics.COLLECTION.time('writeback'):
+                        if snapshot is not None:
+                            await executors.run_in(
+                                'anki', _snapshot, entry.ctx.fs_path, snapshot)
+                        await entry.ctx.sync(snapshot)
+                except:
+                    # Still to be written back
+                    entry.written_mod = written_mod
+                    raise
+                self.flushes += 1
+                if self.leases is not None:
+                    entry.mfs_hash = await ipfs.mfs_hash(entry.ctx.mfs_path)
+            if snapshot is not None:
+                await executors.run_in('fs', os.remove, snapshot)
+        if not close:
+            self._release_lease(entry)
+
+    async def _close(self, entry):
+        with metrics.COLLECTION.time('close'):
+            await self._flush(entry, close=True)
+            await executors.run_in('fs', _remove_checkout, entry.ctx.fs_path)
+        if self.leases is not None and entry.refs == 0:
+            self.leases.release(entry.username)
+
+    async def _evict(self):
+        while len(self._entries) > self.max_size:
+            victim = next((e for e in self._entries.values() if e.refs == 0), None)
+            if victim is None:
+                # Every collection is in use, let the pool grow for now
+                return
+            self.evictions += 1
+            await self._remove(victim, self._close)
+
+    async def suspend(self, username):
+        """Writes back and closes the collection of username, so that it
+        can be changed in mfs (e.g. synced), and makes acquire() wait until
+        resume(username). Returns False if the collection is in use"""
+        entry = self._entries.get(username)
+        if ((entry is not None and entry.refs > 0) or username in self._opening or
+            username in self._suspended):
+            return False
+        self._suspended[username] = asyncio.Event()
+        try:
+            if entry is not None:
+                await self._remove(entry, self._close)
+            # An eviction may still be writing it back
+            await self._wait_closing(username)
+            if self.leases is not None:
+                await self.leases.acquire(username)
+        except:
+            self.resume(username)
+            raise
+        return True
+
+    def resume(self, username):
+        if self.leases is not None:
+            self.leases.release(username)
+        event = self._suspended.pop(username, None)
+        if event is not None:
+            event.set()
+
+    async def flush(self, username):
+        """Writes back the collection of username now, if it's dirty"""
+        entry = self._entries.get(username)
+        if entry is not None:
+            await self._flush(entry)
+
+    async def close_all(self):
+        """Writes back and closes every collection, e.g. at shutdown"""
+        for entry in list(self._entries.values()):
+            await self._remove(entry, self._close)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'in_use': sum(1 for e in self._entries.values() if e.refs > 0),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+            'flush_failures': self.flush_failures,
+        }
+
+
+POOL = CollectionPool()
@@ -0,0 +1,120 @@
+"""
+Named thread pools for blocking work
+
+Everything blocking used to share the default executor, so a long anki sync
+or a big folder copy could take all the workers and stall everyone else.
+Each kind of work now has its own bounded pool:
+
+'anki': anki syncing and authentication with ankiweb
+'ipfs': reads from the /ipfs/ fuse mount
+'fs': local file system work, like removing and diffing temporary files
+"""
+import time
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_SIZES = {'anki': 4, 'ipfs': 8, 'fs': 4}
+
+
+class NamedExecutor:
+    """A ThreadPoolExecutor that keeps track of its queue depth, how many
+    workers are busy and how long jobs wait for a worker"""
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='%s-executor' % name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.wait_listeners = []
+
+    def _wrap(self, func, submitted):
+        wait_time = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+        for listener in self.wait_listeners:
+            listener(self.name, wait_time)
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """Runs func(*args, **kwargs) in the pool and returns the result"""
+        with self._lock:
+            self.queued += 1
+        call = partial(self._wrap, partial(func, *args, **kwargs), time.monotonic())
+        try:
+            future = self._executor.submit(call)
+        except:
+            self._dequeue()
+            raise
+        future.add_done_callback(self._done)
+        return await asyncio.wrap_future(future)
+
+    def _done(self, future):
+        # Jobs cancelled before they started never get to _wrap
+        if future.cancelled():
+            self._dequeue()
+
+    def _dequeue(self):
+        with self._lock:
+            self.queued -= 1
+
+    @property
+    def executor(self):
+        """The underlying executor, for apis that take one (e.g. aiofiles)"""
+        return self._executor
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            started = self.completed + self.active
+            return {
+                'workers': self.max_workers,
+                'queue_depth': self.queued,
+                'active': self.active,
+                'completed': self.completed,
+                'wait_time_avg': self.wait_time_total / started if started else 0.0,
+                'wait_time_max': self.wait_time_max,
+            }
+
+
+EXECUTORS = {name: NamedExecutor(name, size) for name, size in DEFAULT_SIZES.items()}
+
+
+def configure(**sizes):
+    """Resizes the named pools, e.g. configure(anki=2, fs=8)"""
+    for name, size in sizes.items():
+        if size is None or size == EXECUTORS[name].max_workers:
+            continue
+        old = EXECUTORS[name]
+        EXECUTORS[name] = NamedExecutor(name, size)
+        EXECUTORS[name].wait_listeners = old.wait_listeners
+        old.shutdown(wait=False)
+
+
+def get(name):
+    return EXECUTORS[name]
+
+
+async def run_in(name, func, *args, **kwargs):
+    """Runs the blocking func(*args, **kwargs) in the named pool"""
+    return await EXECUTORS[name].run(func, *args, **kwargs)
+
+
+def stats():
+    return {name: executor.stats() for name, executor in EXECUTORS.items()}
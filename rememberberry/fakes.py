@@ -0,0 +1,335 @@
+"""
+Local stand-ins for the external services, for tests and benchmarks that
+should run without a network or an ipfs daemon
+
+FakeIPFS implements the subset of the ipfs http api used by ipfsapi_asyncio
+on top of an in-memory mfs tree. Its hashes are stable but are not real
+ipfs multihashes. Given a mount_path, every node that gets a hash is also
+written to mount_path/<hash>, standing in for the daemon's /ipfs/ mount
+
+FakeMediaServer stands in for anki's RemoteMediaServer (i.e. ankiweb's media
+sync), serving media files from memory
+
+FakeAnkiWeb stands in for anki_integration.AnkiWeb, syncing with a local
+collection instead of ankiweb. fake_ankiweb() gives every account a copy of
+a collection to sync with, for load tests
+"""
+import io
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import zipfile
+from urllib.parse import unquote
+from aiohttp import web
+
+
+def _hash_file(data):
+    return 'Qm' + hashlib.sha256(b'file\0' + data).hexdigest()[:44]
+
+
+def _hash_dir(entries):
+    h = hashlib.sha256(b'dir\0')
+    for name in sorted(entries):
+        h.update(('%s\0%s\0' % (name, entries[name])).encode('utf-8'))
+    return 'Qm' + h.hexdigest()[:44]
+
+
+def _error(message, status=500):
+    return web.Response(
+        status=status, content_type='application/json',
+        text=json.dumps({'Message': message, 'Code': 0, 'Type': 'error'}))
+
+
+class FakeIPFS:
+    """The mfs tree is made of nested dicts with bytes for files, and every
+    node that gets a hash is also stored by hash in self.objects"""
+    def __init__(self, mount_path=None):
+        self.root = {}
+        self.objects = {}
+        self.mount_path = mount_path
+        # name/publish takes publish_delay seconds, and the next
+        # publish_failures publishes fail
+        self.published = []
+        self.publish_delay = 0.0
+        self.publish_failures = 0
+        self.calls = {}
+        self.app = web.Application()
+        self.app.router.add_route('POST', '/api/v0/{cmd:.*}', self.handle)
+
+    # Tree helpers
+    def store(self, node):
+        if isinstance(node, dict):
+            ipfs_hash = _hash_dir({name: self.store(child) for name, child in node.items()})
+        else:
+            ipfs_hash = _hash_file(node)
+        self.objects[ipfs_hash] = node
+        if self.mount_path is not None:
+            self._materialize(ipfs_hash, node)
+        return ipfs_hash
+
+    def _materialize(self, ipfs_hash, node):
+        path = os.path.join(self.mount_path, ipfs_hash)
+        if os.path.exists(path):
+            return
+        # Written next to it and renamed, so readers never see a partial node
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        self._write_node(tmp, node)
+        os.rename(tmp, path)
+
+    def _write_node(self, path, node):
+        if isinstance(node, dict):
+            os.mkdir(path)
+            for name, child in node.items():
+                self._write_node(os.path.join(path, name), child)
+        else:
+            with open(path, 'wb') as f:
+                f.write(node)
+
+    def _split(self, path):
+        return [p for p in path.split('/') if p]
+
+    def lookup(self, path):
+        parts = self._split(path)
+        if parts and parts[0] == 'ipfs':
+            node = self.objects[parts[1]]
+            parts = parts[2:]
+        else:
+            node = self.root
+        for part in parts:
+            node = node[part]
+        return node
+
+    def _parent(self, path, create=False):
+        node = self.root
+        parts = self._split(path)
+        for part in parts[:-1]:
+            if part not in node and create:
+                node[part] = {}
+            node = node[part]
+            if not isinstance(node, dict):
+                raise KeyError(part)
+        return node, parts[-1]
+
+    def _copy(self, node):
+        if isinstance(node, dict):
+            return {name: self._copy(child) for name, child in node.items()}
+        return node
+
+    # Api commands
+    async def handle(self, request):
+        cmd = request.match_info['cmd'].replace('/', '_')
+        self.calls[cmd] = self.calls.get(cmd, 0) + 1
+        args = request.query.getall('arg', [])
+        try:
+            return await getattr(self, 'cmd_' + cmd)(request, args)
+        except (KeyError, IndexError, TypeError) as e:
+            return _error('file does not exist: %s' % e)
+
+    async def cmd_version(self, request, args):
+        return web.json_response({'Version': '0.0.0-fake'})
+
+    async def cmd_files_stat(self, request, args):
+        node = self.lookup(args[0])
+        return web.json_response({
+            'Hash': self.store(node),
+            'Size': len(node) if isinstance(node, bytes) else 0,
+            'Type': 'directory' if isinstance(node, dict) else 'file',
+        })
+
+    async def cmd_files_ls(self, request, args):
+        node = self.lookup(args[0])
+        entries = [{'Name': name,
+                    'Type': 1 if isinstance(child, dict) else 0,
+                    'Size': 0 if isinstance(child, dict) else len(child),
+                    'Hash': self.store(child)}
+                   for name, child in sorted(node.items())]
+        return web.json_response({'Entries': entries})
+
+    async def cmd_files_mkdir(self, request, args):
+        parent, name = self._parent(args[0], create=request.query.get('parents') == 'true')
+        if name in parent and not isinstance(parent[name], dict):
+            return _error('file already exists')
+        parent.setdefault(name, {})
+        return web.Response()
+
+    async def cmd_files_rm(self, request, args):
+        parent, name = self._parent(args[0])
+        if isinstance(parent[name], dict) and request.query.get('recursive') != 'true':
+            return _error('%s is a directory, use -r to remove directories' % name)
+        del parent[name]
+        return web.Response()
+
+    async def cmd_files_cp(self, request, args):
+        node = self._copy(self.lookup(args[0]))
+        parent, name = self._parent(args[1])
+        if name in parent:
+            return _error('directory already has entry by that name')
+        parent[name] = node
+        return web.Response()
+
+    async def cmd_files_mv(self, request, args):
+        src_parent, src_name = self._parent(args[0])
+        parent, name = self._parent(args[1])
+        parent[name] = src_parent.pop(src_name)
+        return web.Response()
+
+    async def cmd_files_read(self, request, args):
+        if self._split(args[0])[:1] == ['ipfs']:
+            # Like the daemon, files/read only resolves mfs paths
+            return _error('paths must be in mfs: %s' % args[0])
+        data = self.lookup(args[0])
+        offset = int(request.query.get('offset', 0))
+        count = request.query.get('count')
+        data = data[offset:] if count is None else data[offset:offset+int(count)]
+        return web.Response(body=data)
+
+    async def cmd_files_write(self, request, args):
+        reader = await request.multipart()
+        part = await reader.next()
+        data = await part.read()
+
+        parent, name = self._parent(args[0])
+        if name not in parent:
+            if request.query.get('create') != 'true':
+                return _error('file does not exist')
+            parent[name] = b''
+        old = parent[name]
+        if request.query.get('truncate') == 'true':
+            old = b''
+        offset = int(request.query.get('offset', 0))
+        parent[name] = old[:offset] + data + old[offset+len(data):]
+        return web.Response()
+
+    async def cmd_add(self, request, args):
+        reader = await request.multipart()
+        tree, entries = {}, []
+        while True:
+            part = await reader.next()
+            if part is None:
+                break
+            # ipfs expects url encoded file names
+            parts = self._split(unquote(part.filename))
+            node = tree
+            for p in parts[:-1]:
+                node = node.setdefault(p, {})
+            if part.headers.get('Content-Type') == 'application/x-directory':
+                node.setdefault(parts[-1], {})
+            else:
+                node[parts[-1]] = await part.read()
+            entries.append('/'.join(parts))
+
+        lines = []
+        # Directories are reported after their contents, like ipfs does
+        for path in sorted(entries, key=lambda p: (-p.count('/'), p)):
+            node = self.lookup_in(tree, path)
+            lines.append(json.dumps({'Name': path, 'Hash': self.store(node)}))
+        if request.query.get('quieter') == 'true':
+            lines = lines[-1:]
+        return web.Response(text='\n'.join(lines) + '\n')
+
+    def lookup_in(self, tree, path):
+        node = tree
+        for part in self._split(path):
+            node = node[part]
+        return node
+
+    async def cmd_cat(self, request, args):
+        path = args[0] if args[0].startswith('/ipfs/') else '/ipfs/' + args[0]
+        data = self.lookup(path)
+        offset = int(request.query.get('offset', 0))
+        length = request.query.get('length')
+        data = data[offset:] if length is None else data[offset:offset+int(length)]
+        return web.Response(body=data)
+
+    async def cmd_name_publish(self, request, args):
+        await asyncio.sleep(self.publish_delay)
+        if self.publish_failures > 0:
+            self.publish_failures -= 1
+            return _error('failed to publish entry: fake failure')
+        self.lookup(args[0])
+        key = request.query.get('key', 'self')
+        self.published.append((key, args[0]))
+        return web.json_response({'Name': 'Qm%s' % key, 'Value': args[0]})
+
+
+class FakeMediaServer:
+    """Serves files, a {name: data} dict, the way ankiweb's media sync does.
+    With fail_after set, downloadFiles raises ConnectionError after that many
+    downloads, like a dropped connection"""
+    def __init__(self, files, page_size=100, fail_after=None):
+        self.changes = [(name, usn+1, hashlib.sha1(data).hexdigest())
+                        for usn, (name, data) in enumerate(sorted(files.items()))]
+        self.files = files
+        self.page_size = page_size
+        self.fail_after = fail_after
+        self.downloads = 0
+        self.requested = []
+
+    def begin(self):
+        return {'usn': len(self.changes), 'sk': 'fake'}
+
+    def mediaChanges(self, lastUsn):
+        return [c for c in self.changes if c[1] > lastUsn][:self.page_size]
+
+    def downloadFiles(self, files):
+        if self.fail_after is not None and self.downloads >= self.fail_after:
+            raise ConnectionError('fake connection dropped')
+        self.downloads += 1
+        self.requested.extend(files)
+
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w') as z:
+            meta = {}
+            for i, name in enumerate(files):
+                z.writestr(str(i), self.files[name])
+                meta[str(i)] = name
+            z.writestr('_meta', json.dumps(meta))
+        return buf.getvalue()
+
+
+class FakeAnkiWeb:
+    """Syncs with the collection server_col, and serves media_files through a
+    FakeMediaServer. Set anki_integration.ANKIWEB to a function returning it"""
+    def __init__(self, server_col, media_files=None):
+        self.server_col = server_col
+        self.media = FakeMediaServer(media_files or {})
+        self.downloads = 0
+
+    @staticmethod
+    def host_key(anki_username, anki_password):
+        """Any password works"""
+        return hashlib.sha1(bytes(anki_username, 'utf-8')).hexdigest()
+
+    def sync_server(self):
+        from anki.sync import LocalServer
+        return LocalServer(self.server_col)
+
+    def download(self, col):
+        path = col.path
+        col.close()
+        self.server_col.close()
+        shutil.copyfile(self.server_col.path, path)
+        self.server_col.reopen()
+        self.downloads += 1
+
+    def media_server(self, col):
+        return self.media
+
+
+def fake_ankiweb(template_path, media_files=None):
+    """Returns a stand-in for anki_integration.ANKIWEB where every account
+    syncs with its own copy of the collection at template_path, kept next
+    to it. Connect in the thread that syncs, the collections can only be
+    used from the thread that opened them"""
+    users_path = template_path + '.users'
+    os.makedirs(users_path, exist_ok=True)
+    def connect(anki_hkey):
+        from anki.storage import Collection
+        path = os.path.join(users_path, '%s.anki2' % anki_hkey)
+        if not os.path.exists(path):
+            shutil.copyfile(template_path, path)
+        return FakeAnkiWeb(Collection(path), media_files)
+    connect.host_key = FakeAnkiWeb.host_key
+    return connect
@@ -2,8 +2,13 @@
 Helper functions that abstract away modifying files in the IPFS store
 
 This module keeps track of the data root hash and updates it whenever
-any data in it updates, and in a separate thread continuously publishes
-the new ipns link
+any data in it updates (coalescing bursts of updates, see RootHashTracker),
+and publishes the new hash through ipns in the background (see ipns)
+
+By default the data lives in a go-ipfs daemon, reached through its http api
+and its /ipfs/ mount. With BACKEND = 'local' it's kept in a LocalStore at
+LOCAL_PATH instead (see local_store), which needs no daemon but whose root
+hash can't be published through ipns. Either way API is the backend
 
 Note that paths are referred to by the prefixes:
 'fs': normal file system
@@ -12,21 +17,52 @@ Note that paths are referred to by the prefixes:
 """
 import os
 import io
+import time
 import uuid
 import shutil
+import hashlib
 import asyncio
 import logging
 from functools import partial
-from subprocess import Popen, PIPE, STDOUT
+from collections import OrderedDict
 import aiofiles
-from rememberscript import FileStorage
-from rememberberry import ipfsapi_asyncio
+from rememberberry import ipfsapi_asyncio, executors, tracing, local_store, ipns
 
 DATA_ROOT = '/data'
 # The hash of the root at DATA_ROOT folder with all the user data
 # This needs to be published through IPNS whenever there's a change
 DATA_ROOT_HASH = None
 API = None # ipfs api
+API_HOST = ipfsapi_asyncio.DEFAULT_HOST
+API_PORT = ipfsapi_asyncio.DEFAULT_PORT
+# Where the daemon mounts the readonly /ipfs/ tree
+IPFS_MOUNT = '/ipfs'
+# The key that the root hash is published under
+IPNS_KEY = 'self'
+BACKENDS = ['ipfs', 'local']
+BACKEND = 'ipfs'
+LOCAL_PATH = '/var/lib/rememberberry'
+# Past this many changed files, a folder context re-adds the whole folder
+# in one go rather than copying the files one by one
+MAX_FOLDER_CHANGES = 100
+
+
+def _checkout_file(ipfs_hash, fs_path):
+    checkout = getattr(API, 'checkout_file', None)
+    if checkout is not None:
+        return checkout(ipfs_hash, fs_path)
+    # Copy from the readonly mount point at /ipfs/
+    shutil.copy(os.path.join(IPFS_MOUNT, ipfs_hash), fs_path)
+
+
+def _checkout_folder(ipfs_hash, fs_path):
+    """Copies the folder ipfs_hash to fs_path and returns its manifest, see
+    _copy_with_manifest"""
+    checkout = getattr(API, 'checkout_folder', None)
+    if checkout is not None:
+        return checkout(ipfs_hash, fs_path)
+    return _copy_with_manifest(os.path.join(IPFS_MOUNT, ipfs_hash), fs_path)
+
 
 class MutableFileContext:
     """Provides a temporary file with the contents of mfs_path,
@@ -46,78 +82,435 @@ class MutableFileContext:
             # Get the hash of mfs_path
             ipfs_hash = await mfs_hash(self.mfs_path)
 
-            # Copy from the readonly mount point at /ipfs/ to the tmp file
-            _cp = partial(shutil.copy, '/ipfs/%s' % ipfs_hash, self.fs_path)
-            await asyncio.get_event_loop().run_in_executor(None, _cp)
+            if ipfs_hash:
+                await executors.run_in('ipfs', _checkout_file, ipfs_hash, self.fs_path)
 
     async def __aexit__(self, exc_type=None, exc=None, tb=None):
         if exc is None:
-            # Copy the file to mfs
-            await cp_fs_to_mfs(self.fs_path, self.mfs_path, rm=True)
-
-        # Remove the temporary file
-        _rm = partial(os.remove, self.fs_path)
-        await asyncio.get_event_loop().run_in_executor(None, _rm)
+            await self.sync()
+        await self.remove()
+
+    async def sync(self, fs_path=None):
+        """Copies the temporary file (or fs_path, e.g. a snapshot of it)
+        to mfs, without leaving the context"""
+        await cp_fs_to_mfs(fs_path or self.fs_path, self.mfs_path, rm=True)
+
+    async def remove(self):
+        """Removes the temporary file"""
+        await executors.run_in('fs', os.remove, self.fs_path)
+
+
+def _copy_with_manifest(src, dst, chunk_size=1024*1024):
+    """Copies the folder src to dst like shutil.copytree, and returns a
+    manifest of the copy as {relative path: (size, mtime_ns, sha256)}.
+    The content hashes are computed while copying, so no extra reads"""
+    manifest = {}
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        os.makedirs(os.path.join(dst, rel_root), exist_ok=True)
+        for name in files:
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            dst_file = os.path.join(dst, rel)
+            h = hashlib.sha256()
+            with open(os.path.join(root, name), 'rb') as fin, open(dst_file, 'wb') as fout:
+                for chunk in iter(partial(fin.read, chunk_size), b''):
+                    h.update(chunk)
+                    fout.write(chunk)
+            st = os.stat(dst_file)
+            manifest[rel] = (st.st_size, st.st_mtime_ns, h.hexdigest())
+    return manifest
+
+
+def _file_digest(path, chunk_size=1024*1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(partial(f.read, chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _diff_manifest(fs_path, manifest):
+    """Compares the folder fs_path with the manifest it was checked out
+    with, and returns (changed, removed) lists of relative paths, where
+    changed has new and modified files. Hidden files are ignored, like
+    ipfs add does. Files are only hashed when their size or mtime changed.
+    Also returns the total size of the unchanged files"""
+    changed, present, unchanged_bytes = [], set(), 0
+    for root, dirs, files in os.walk(fs_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        rel_root = os.path.relpath(root, fs_path)
+        for name in sorted(files):
+            if name.startswith('.'):
+                continue
+            rel = os.path.normpath(os.path.join(rel_root, name))
+            present.add(rel)
+            st = os.stat(os.path.join(root, name))
+            old = manifest.get(rel)
+            if old is not None and (old[:2] == (st.st_size, st.st_mtime_ns) or (
+                    old[0] == st.st_size and
+                    old[2] == _file_digest(os.path.join(root, name)))):
+                unchanged_bytes += st.st_size
+                continue
+            changed.append(rel)
+
+    removed = set()
+    for rel in manifest:
+        parts = rel.split(os.sep)
+        if rel in present or any(p.startswith('.') for p in parts):
+            continue
+        # Remove whole folders that are gone rather than each file in them
+        for i in range(1, len(parts) + 1):
+            if not os.path.exists(os.path.join(fs_path, *parts[:i])):
+                removed.add(os.path.join(*parts[:i]))
+                break
+    return changed, sorted(removed), unchanged_bytes
+
+
+def _update_manifest(fs_path, manifest, changed, removed):
+    """Updates manifest after changed and removed were synced"""
+    for rel in removed:
+        for key in [k for k in manifest if k == rel or k.startswith(rel + os.sep)]:
+            del manifest[key]
+    for rel in changed:
+        path = os.path.join(fs_path, rel)
+        st = os.stat(path)
+        manifest[rel] = (st.st_size, st.st_mtime_ns, _file_digest(path))
 
 
 class MutableFolderContext:
     """Provides a temporary mutable folder with the contents of mfs_path,
-    which is then synced with ipfs when the context is exited"""
+    which is then synced with ipfs when the context is exited.
+
+    A manifest of the checked out files is kept, so that on exit only the
+    new and modified files are added to mfs and the deleted ones removed,
+    instead of re-adding the whole folder"""
     def __init__(self, mfs_path=None):
         self.mfs_path = mfs_path
+        self.manifest = None
+        self.stats = {'files_added': 0, 'files_removed': 0,
+                      'bytes_added': 0, 'bytes_unchanged': 0}
 
         # Get a random folder in /tmp
         self.fs_path = '/tmp/%s/' % str(uuid.uuid4())
 
     async def __aenter__(self):
-        _mkdirs = partial(os.makedirs, self.fs_path)
         if self.mfs_path is not None:
             # Get the hash of mfs_path
             ipfs_folder_hash = await mfs_hash(self.mfs_path)
 
             if ipfs_folder_hash:
-                # Copy from the readonly mount point at /ipfs/ to the tmp folder
-                _cp = partial(shutil.copytree, '/ipfs/%s' % ipfs_folder_hash, self.fs_path)
-                await asyncio.get_event_loop().run_in_executor(None, _cp)
+                self.manifest = await executors.run_in(
+                    'ipfs', _checkout_folder, ipfs_folder_hash, self.fs_path)
             else:
-                await asyncio.get_event_loop().run_in_executor(None, _mkdirs)
+                await executors.run_in('fs', os.makedirs, self.fs_path)
         else:
-            await asyncio.get_event_loop().run_in_executor(None, _mkdirs)
+            await executors.run_in('fs', os.makedirs, self.fs_path)
 
     async def __aexit__(self, exc_type, exc, tb):
         if exc is None:
             # Copy the files to mfs
             logging.debug('exiting folder context')
-            await cp_fs_to_mfs(self.fs_path, self.mfs_path, rm=True, r=True)
+            await self.sync()
         else:
             import traceback
             traceback.print_exception(exc_type, exc, tb)
 
         # Remove the temporary folder
-        _rmtree = partial(shutil.rmtree, self.fs_path)
-        await asyncio.get_event_loop().run_in_executor(None, _rmtree)
-
-
-async def _update_root_hash():
-    global DATA_ROOT_HASH
-    DATA_ROOT_HASH = await mfs_hash(DATA_ROOT)
-
+        await executors.run_in('fs', shutil.rmtree, self.fs_path)
 
+    async def sync(self):
+        if self.mfs_path is None:
+            return
+        if self.manifest is None:
+            # Nothing to diff against, add the whole folder
+            await cp_fs_to_mfs(self.fs_path, self.mfs_path, rm=True, r=True)
+            self.stats['bytes_added'] += sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, dirs, files in os.walk(self.fs_path) for name in files)
+            return
+
+        changed, removed, unchanged_bytes = await executors.run_in(
+            'fs', _diff_manifest, self.fs_path, self.manifest)
+
+        whole = len(changed) + len(removed) > MAX_FOLDER_CHANGES
+        if whole:
+            # One add of the whole folder is cheaper than a copy per file,
+            # and the unchanged files are stored only once anyway
+            await cp_fs_to_mfs(self.fs_path, self.mfs_path, rm=True, r=True,
+                               update_root=False)
+
+        for rel in removed:
+            if not whole:
+                await mfs_rm(os.path.join(self.mfs_path, rel), r=True, update_root=False)
+            self.stats['files_removed'] += 1
+
+        made_dirs = set()
+        for rel in changed:
+            fs_file = os.path.join(self.fs_path, rel)
+            if not whole:
+                mfs_file = os.path.join(self.mfs_path, rel)
+                mfs_dir = os.path.dirname(mfs_file)
+                if os.path.dirname(rel) and mfs_dir not in made_dirs:
+                    await mfs_mkdirs(mfs_dir, update_root=False)
+                    made_dirs.add(mfs_dir)
+                await cp_fs_to_mfs(fs_file, mfs_file, rm=rel in self.manifest,
+                                   update_root=False)
+            self.stats['files_added'] += 1
+            self.stats['bytes_added'] += os.path.getsize(fs_file)
+
+        self.stats['bytes_unchanged'] += unchanged_bytes
+        if changed or removed:
+            _update_root_hash()
+
+        # Further syncs diff against what's now in mfs
+        await executors.run_in(
+            'fs', _update_manifest, self.fs_path, self.manifest, changed, removed)
+
+
+class RootHashTracker:
+    """Keeps DATA_ROOT_HASH up to date without a files_stat after every
+    mutation. Mutations mark the root as dirty, and the hash is recomputed
+    at most once per interval seconds, or as soon as batch_size mutations
+    have piled up. Use flush() when the fresh hash is needed right away.
+
+    When the mutations happen in other processes, disable tracking in them
+    and watch() the root from one process instead"""
+    def __init__(self, interval=1.0, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.enabled = True
+        self.pending = 0
+        self.updates = 0
+        self.failures = 0
+        self._handle = None
+        self._lock = None
+
+    def mark_dirty(self):
+        if not self.enabled:
+            return
+        self.pending += 1
+        loop = asyncio.get_event_loop()
+        if self.pending >= self.batch_size:
+            self._cancel()
+            self._handle = loop.call_soon(self._flush_soon)
+        elif self._handle is None:
+            self._handle = loop.call_later(self.interval, self._flush_soon)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _flush_soon(self):
+        self._handle = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Recomputes the root hash if there are pending mutations and
+        returns it"""
+        global DATA_ROOT_HASH
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self.pending == 0:
+                return DATA_ROOT_HASH
+            self._cancel()
+            # Mutations that happen during the stat will mark it dirty again
+            pending, self.pending = self.pending, 0
+            root_hash = await mfs_hash(DATA_ROOT, cached=False)
+            if root_hash is None:
+                # The root exists, so the stat failed. Keeps the last hash
+                # rather than publishing none, and tries again later
+                logging.warning('reading the root hash failed, retrying')
+                self.failures += 1
+                self.pending += pending
+                if self._handle is None:
+                    self._handle = asyncio.get_event_loop().call_later(
+                        self.interval, self._flush_soon)
+                return DATA_ROOT_HASH
+            DATA_ROOT_HASH = root_hash
+            self.updates += 1
+            PUBLISHER.notify(DATA_ROOT_HASH)
+            return DATA_ROOT_HASH
+
+    async def poll(self):
+        """Reads the root hash, whoever changed it, and returns it"""
+        global DATA_ROOT_HASH
+        root_hash = await mfs_hash(DATA_ROOT, cached=False)
+        if root_hash is None:
+            # Failed, the next poll tries again
+            self.failures += 1
+            return DATA_ROOT_HASH
+        if root_hash != DATA_ROOT_HASH:
+            DATA_ROOT_HASH = root_hash
+            self.updates += 1
+            PUBLISHER.notify(DATA_ROOT_HASH)
+        return root_hash
+
+    async def watch(self):
+        """Polls the root hash every interval seconds"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.poll()
+            except:
+                logging.exception('polling the root hash failed')
+
+    def stats(self):
+        return {'pending': self.pending, 'updates': self.updates, 'failures': self.failures}
+
+
+ROOT = RootHashTracker()
+
+
+def _update_root_hash():
+    ROOT.mark_dirty()
+
+
+async def flush_root_hash():
+    """Returns the up to date root hash"""
+    return await ROOT.flush()
+
+
+async def _publish_root(root_hash):
+    await API.name_publish('/ipfs/%s' % root_hash, key=IPNS_KEY)
+
+
+# Only publishes once enabled, the local backend has nothing to publish to
+PUBLISHER = ipns.Publisher(_publish_root)
+
+
+class HashCache:
+    """Caches the results of mfs_hash, both hashes of existing paths and
+    paths that don't exist, for up to ttl seconds and max_size paths.
+
+    The mfs helpers in this module invalidate the paths they change, along
+    with their parent folders (whose hashes change too) and anything below
+    them. Concurrent lookups of the same path share one files_stat"""
+    def __init__(self, ttl=30.0, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._generation = 0
+
+    def get(self, path):
+        """Returns (found, hash)"""
+        entry = self._entries.get(path)
+        if entry is None:
+            return False, None
+        ipfs_hash, expires = entry
+        if time.monotonic() > expires:
+            del self._entries[path]
+            return False, None
+        self._entries.move_to_end(path)
+        return True, ipfs_hash
+
+    def put(self, path, ipfs_hash, generation):
+        if generation != self._generation:
+            # Something changed while the stat was in flight
+            return
+        self._entries[path] = (ipfs_hash, time.monotonic() + self.ttl)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, path):
+        path = os.path.normpath(path)
+        self._generation += 1
+        self.invalidations += 1
+        # Lookups from now on shouldn't join stats that started before
+        self._pending.clear()
+
+        parent = path
+        while True:
+            self._entries.pop(parent, None)
+            if parent in ['/', '']:
+                break
+            parent = os.path.dirname(parent)
+
+        prefix = path.rstrip('/') + '/'
+        for key in [k for k in self._entries if k.startswith(prefix)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._generation += 1
+        self._pending.clear()
+        self._entries.clear()
+
+    async def lookup(self, path, stat):
+        """Returns the cached hash of path, or calls stat(path) to get it"""
+        path = os.path.normpath(path)
+        found, ipfs_hash = self.get(path)
+        if found:
+            self.hits += 1
+            return ipfs_hash
+        self.misses += 1
+
+        if path not in self._pending:
+            fut = asyncio.ensure_future(self._stat(path, stat, self._generation))
+            self._pending[path] = fut
+            def _done(f):
+                if self._pending.get(path) is f:
+                    del self._pending[path]
+            fut.add_done_callback(_done)
+        return await asyncio.shield(self._pending[path])
+
+    async def _stat(self, path, stat, generation):
+        exists, ipfs_hash = await stat(path)
+        self.put(path, ipfs_hash, generation)
+        return ipfs_hash
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': len(self._entries), 'hits': self.hits,
+                'misses': self.misses, 'invalidations': self.invalidations}
+
+
+HASH_CACHE = HashCache()
+
+
+@tracing.traced
 async def mfs_write(mfs_path, data, mode='', update_root=True):
     assert mode in ['', 'b']
     global DATA_ROOT_HASH
     data = bytes(data, 'utf-8') if mode == '' else data
     try:
-        await API.files_write(mfs_path, io.BytesIO(data), create=True)
+        await API.files_write(mfs_path, io.BytesIO(data), create=True, truncate=True)
     except:
         logging.info('mfs_write failed with path %s' % mfs_path)
         raise
+    finally:
+        HASH_CACHE.invalidate(mfs_path)
 
     # Update the root
     if update_root:
-        await _update_root_hash()
+        _update_root_hash()
+
+
+@tracing.traced
+async def mfs_append(mfs_path, data, offset, update_root=True):
+    """Writes the bytes data at offset in mfs_path, without truncating it,
+    e.g. to append to a file of length offset"""
+    try:
+        await API.files_write(mfs_path, io.BytesIO(data), offset=offset, create=True)
+    except:
+        logging.info('mfs_append failed with path %s' % mfs_path)
+        raise
+    finally:
+        HASH_CACHE.invalidate(mfs_path)
+
+    if update_root:
+        _update_root_hash()
 
 
+@tracing.traced
 async def mfs_read(mfs_path, mode=''):
     assert mode in ['', 'b']
 
@@ -132,42 +525,71 @@ async def mfs_read(mfs_path, mode=''):
         return str(ret, 'utf-8')
 
 
-async def mfs_hash(mfs_path):
-    """Returns the ipfs hash if the mfs_path exists, otherwise None"""
+async def _files_stat_hash(mfs_path):
+    """Returns (exists, hash), raises if the stat failed for any other
+    reason than mfs_path not existing"""
     try:
         ret = await API.files_stat(mfs_path)
-        logging.debug('_files_stat returning %s' % str(ret))
+    except ipfsapi_asyncio.Error as e:
+        if 'does not exist' in str(e):
+            return False, None
+        raise
+    return True, ret['Hash']
+
+
+@tracing.traced
+async def mfs_hash(mfs_path, cached=True):
+    """Returns the ipfs hash if the mfs_path exists, otherwise None"""
+    try:
+        if cached:
+            return await HASH_CACHE.lookup(mfs_path, _files_stat_hash)
+        exists, ipfs_hash = await _files_stat_hash(mfs_path)
+        return ipfs_hash
     except:
         return None
 
-    return ret['Hash']
+
+@tracing.traced
+async def mfs_ls(mfs_path):
+    """Returns {name: ipfs hash} of the files in the folder mfs_path, empty
+    if it doesn't exist"""
+    try:
+        ret = await API.files_ls(mfs_path, l=True)
+    except:
+        return {}
+    return {e['Name']: e['Hash'] for e in ret.get('Entries') or [] if e['Type'] == 0}
 
 
+@tracing.traced
 async def mfs_mkdirs(mfs_path, update_root=True):
     global DATA_ROOT_HASH
     try:
         await API.files_mkdir(mfs_path, parents=True)
+        HASH_CACHE.invalidate(mfs_path)
     except:
         logging.debug('mfs_mkdirs at %s failed' % mfs_path)
         return None
 
     if update_root:
-        await _update_root_hash()
+        _update_root_hash()
 
 
+@tracing.traced
 async def mfs_rm(mfs_path, r=False, update_root=True):
     global DATA_ROOT_HASH
 
     try:
         await API.files_rm(mfs_path, recursive=r)
+        HASH_CACHE.invalidate(mfs_path)
     except:
         logging.info('mfs_rm at %s failed' % mfs_path)
         return None
 
     if update_root:
-        await _update_root_hash()
+        _update_root_hash()
 
 
+@tracing.traced
 async def cp_ipfs_to_mfs(ipfs_path, mfs_path, rm=False, r=False, update_root=True):
     global DATA_ROOT_HASH
     if rm:
@@ -175,55 +597,32 @@ async def cp_ipfs_to_mfs(ipfs_path, mfs_path, rm=False, r=False, update_root=Tru
 
     try:
         await API.files_cp(ipfs_path, mfs_path)
+        HASH_CACHE.invalidate(mfs_path)
     except:
         logging.info('cp_ipfs_to_mfs from %s to %s failed' % (ipfs_path, mfs_path))
         return None
 
     if update_root:
-        await _update_root_hash()
+        _update_root_hash()
 
 
-async def add_files_ipfsapi(fs_path, r=False):
+@tracing.traced
+async def add_files(fs_path, r=False):
+    """Adds a file (or folder if r) to ipfs and returns its hash, the same
+    as `ipfs add -r -Q` would"""
     try:
-        ret = await API.add(fs_path, recursive=r)
+        ret = await API.add(fs_path, recursive=r, quieter=True)
     except:
-        logging.info('add_files_ipfsapi at %s failed' % fs_path)
-        return None
+        logging.info('add_files at %s failed' % fs_path)
+        raise
 
     last = ret[-1] if isinstance(ret, list) else ret
-    ipfs_hash = last['Hash']
-    return ipfs_hash
-
-
-def _run_commands(*commands):
-    """Runs command(s) and returns their stdout and stderr
-    Commands are lists of command parts"""
-    results = []
-    for command in commands:
-        p = Popen(command, stdout=PIPE, stderr=PIPE)
-        results.append(p.communicate())
-    return results if len(results) > 1 else results[0]
-
-
-async def add_files_goipfs(fs_path, r=False):
-    # -Q flag to force only final hash output
-    args = ['ipfs', 'add', '-r', '-Q', fs_path] if r else ['ipfs', 'add', '-Q', fs_path]
-    out, err = await asyncio.get_event_loop().run_in_executor(
-        None, partial(_run_commands, args))
-
-    err = err.decode('utf-8')
-    if err != '':
-        logging.info('add_files_goipfs at %s failed: %s' % (fs_path, err))
-        raise RuntimeError
-
-    return out.decode('utf-8').strip()
+    return last['Hash']
 
 
+@tracing.traced
 async def cp_fs_to_mfs(fs_path, mfs_path, rm=False, r=False, update_root=True):
-    # Use goipfs for now, since ipfsapi runs out of memory when adding
-    # big folders: https://github.com/ipfs/py-ipfs-api/issues/104
-    #ipfs_hash = await add_files_ipfsapi(fs_path, r=r)
-    ipfs_hash = await add_files_goipfs(fs_path, r=r)
+    ipfs_hash = await add_files(fs_path, r=r)
 
     await cp_ipfs_to_mfs(
         '/ipfs/%s' % ipfs_hash, mfs_path, rm=rm, r=r, update_root=update_root)
@@ -234,17 +633,25 @@ async def init():
     if DATA_ROOT_HASH is not None:
         return
 
-    try:
-        API = await ipfsapi_asyncio.connect()
-    except:
-        logging.critical("Couldn't connect to ipfs, is it running?")
-        raise
-
-    DATA_ROOT_HASH = await mfs_hash(DATA_ROOT)
+    if BACKEND == 'local':
+        API = local_store.LocalStore(LOCAL_PATH)
+        API.start_gc()
+    else:
+        try:
+            API = await ipfsapi_asyncio.connect(
+                API_HOST, API_PORT, executor=executors.get('fs').executor)
+        except:
+            logging.critical("Couldn't connect to ipfs, is it running?")
+            raise
+
+    DATA_ROOT_HASH = await mfs_hash(DATA_ROOT, cached=False)
     if not DATA_ROOT_HASH:
         await mfs_mkdirs(DATA_ROOT, update_root=True)
+        await ROOT.flush()
+    PUBLISHER.notify(DATA_ROOT_HASH)
+    PUBLISHER.start()
 
 
 def get_ipfs_storage(filename=None):
-    return FileStorage(
-        filename, load_func=mfs_read, dump_func=mfs_write)
+    from rememberberry.journal import JournaledStorage
+    return JournaledStorage(filename)
@@ -1,29 +1,228 @@
 """
-An monkeypatched version of ipfsapi which provides async methods
+A native asyncio client for the parts of the ipfs http api that we use
+
+It mirrors the call signatures of ipfsapi.Client for those methods, but runs
+all the requests over one shared aiohttp session with keep-alive instead of
+a thread and a blocking request per call. Request bodies are streamed from
+the given file objects and responses can be streamed with the *_iter methods
 """
+import io
+import os
+import json
+import time
+import uuid
 import logging
-from functools import partial
-from types import MethodType
-import asyncio
-import ipfsapi
-
-async def connect(*args, **kwargs):
-    """Mirrors the ipfsapi.connect(), but returns a monkey-patched
-    ipfsapi.Client object"""
-    connect = partial(ipfsapi.connect, *args, **kwargs)
-    api = await asyncio.get_event_loop().run_in_executor(None, connect)
-
-    methods = [attr for attr in dir(api) if (not attr.startswith('_') and
-               isinstance(getattr(api, attr), MethodType))]
-    
-    async def _monkey_patch(method, *args, **kwargs):
-        logging.debug('_monkey_patch call %s %s %s' % (method, str(args), str(kwargs)))
-        ret = await asyncio.get_event_loop().run_in_executor(
-            None, partial(method, *args, **kwargs))
-        logging.debug('_monkey_patch returning %s' % str(ret))
-        return ret
-
-    for attr in methods:
-        setattr(api, attr, partial(_monkey_patch, getattr(api, attr)))
-
-    return api
+from urllib.parse import quote
+import aiofiles
+import aiohttp
+from rememberberry import metrics
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 5001
+DEFAULT_BASE = 'api/v0'
+CHUNK_SIZE = 64*1024
+
+
+class Error(Exception):
+    """An error returned by the ipfs api"""
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+def _bool(value):
+    return 'true' if value else 'false'
+
+
+def _walk(path, name):
+    """Lazily yields (name, fs_path, content_type) for path and everything
+    below it, parents before children and skipping hidden files"""
+    if os.path.islink(path):
+        yield name, path, 'application/symlink'
+    elif os.path.isdir(path):
+        yield name, path, 'application/x-directory'
+        with os.scandir(path) as it:
+            entries = sorted((e.name for e in it if not e.name.startswith('.')))
+        for entry in entries:
+            yield from _walk(os.path.join(path, entry), '%s/%s' % (name, entry))
+    else:
+        yield name, path, 'application/octet-stream'
+
+
+async def _multipart_body(path, boundary, chunk_size, executor=None):
+    """Yields a multipart/form-data body for adding path, the way the ipfs
+    cli would send it"""
+    path = os.path.normpath(path)
+    for name, fs_path, content_type in _walk(path, os.path.basename(path)):
+        yield ('--%s\r\n'
+               'Content-Disposition: form-data; name="file"; filename="%s"\r\n'
+               'Content-Type: %s\r\n\r\n' % (
+                   boundary, quote(name, safe=''), content_type)).encode('utf-8')
+        if content_type == 'application/symlink':
+            yield os.readlink(fs_path).encode('utf-8')
+        elif content_type == 'application/octet-stream':
+            async with aiofiles.open(fs_path, 'rb', executor=executor) as f:
+                while True:
+                    chunk = await f.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        yield b'\r\n'
+    yield ('--%s--\r\n' % boundary).encode('utf-8')
+
+
+class Client:
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, base=DEFAULT_BASE,
+                 limit=16, limit_per_host=0, keepalive_timeout=60,
+                 chunk_size=CHUNK_SIZE, session=None, executor=None):
+        self.url = 'http://%s:%i/%s/' % (host, port, base.strip('/'))
+        self.chunk_size = chunk_size
+        # Executor for reading local files, None for the default one
+        self.executor = executor
+        if session is None:
+            connector = aiohttp.TCPConnector(
+                limit=limit, limit_per_host=limit_per_host,
+                keepalive_timeout=keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector)
+        self.session = session
+
+    async def close(self):
+        await self.session.close()
+
+    def _params(self, args, opts):
+        params = [('arg', arg) for arg in args]
+        for key, value in (opts or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = _bool(value)
+            params.append((key, str(value)))
+        return params
+
+    async def _raise_for_status(self, resp):
+        if resp.status == 200:
+            return
+        text = await resp.text()
+        try:
+            err = json.loads(text)
+            raise Error(err.get('Message', text), err.get('Code'))
+        except ValueError:
+            raise Error(text or resp.reason)
+
+    async def _request(self, path, args=(), opts=None, data=None, headers=None,
+                       decoder='json'):
+        """Makes a request and returns the decoded response body, decoder is
+        'json', 'ndjson' or None for the raw bytes"""
+        start = time.monotonic()
+        async with self.session.post(
+                self.url + path, params=self._params(args, opts), data=data,
+                headers=headers) as resp:
+            await self._raise_for_status(resp)
+            body = await resp.read()
+        elapsed = time.monotonic() - start
+        metrics.IPFS_REQUEST.observe(elapsed, path)
+        logging.debug('ipfs %s took %.3fs' % (path, elapsed))
+
+        if decoder == 'json':
+            return json.loads(body.decode('utf-8')) if body else None
+        elif decoder == 'ndjson':
+            lines = [json.loads(l) for l in body.decode('utf-8').splitlines() if l]
+            return lines[0] if len(lines) == 1 else lines
+        return body
+
+    async def _request_iter(self, path, args=(), opts=None):
+        """Makes a request and yields the response body in chunks"""
+        start = time.monotonic()
+        async with self.session.post(
+                self.url + path, params=self._params(args, opts)) as resp:
+            await self._raise_for_status(resp)
+            async for chunk in resp.content.iter_chunked(self.chunk_size):
+                yield chunk
+        metrics.IPFS_REQUEST.observe(time.monotonic() - start, path)
+
+    def _file_part(self, writer, name, fileobj, content_type='application/octet-stream'):
+        if isinstance(fileobj, (bytes, bytearray)):
+            fileobj = io.BytesIO(fileobj)
+        part = writer.append(fileobj, {'Content-Type': content_type})
+        part.set_content_disposition('form-data', name='file', filename=name)
+
+    async def version(self):
+        return await self._request('version')
+
+    async def files_stat(self, path):
+        return await self._request('files/stat', (path,))
+
+    async def files_ls(self, path, l=False):
+        return await self._request('files/ls', (path,), {'l': l})
+
+    async def files_mkdir(self, path, parents=False):
+        return await self._request('files/mkdir', (path,), {'parents': parents})
+
+    async def files_rm(self, path, recursive=False):
+        return await self._request('files/rm', (path,), {'recursive': recursive})
+
+    async def files_cp(self, source, dest):
+        return await self._request('files/cp', (source, dest))
+
+    async def files_mv(self, source, dest):
+        return await self._request('files/mv', (source, dest))
+
+    async def files_read(self, path, offset=0, count=None):
+        return await self._request(
+            'files/read', (path,), {'offset': offset, 'count': count}, decoder=None)
+
+    def files_read_iter(self, path, offset=0, count=None):
+        return self._request_iter(
+            'files/read', (path,), {'offset': offset, 'count': count})
+
+    async def files_write(self, path, file, offset=0, create=False, truncate=False,
+                          count=None):
+        """Writes the file object (or bytes) to path, the body is streamed
+        from file in chunks"""
+        writer = aiohttp.MultipartWriter('form-data')
+        self._file_part(writer, 'data', file)
+        opts = {'offset': offset, 'create': create, 'truncate': truncate,
+                'count': count}
+        return await self._request('files/write', (path,), opts, data=writer)
+
+    async def add(self, files, recursive=False, **opts):
+        """Adds a file or folder from the file system, returns a dict
+        for a single file and a list of dicts otherwise, with the root last.
+
+        The multipart body is generated lazily while the request is sent, one
+        file and one chunk at a time, so memory use doesn't depend on the
+        size of the folder. Like `ipfs add`, hidden files are skipped"""
+        if os.path.isdir(files) and not recursive:
+            raise Error('%s is a directory, use recursive=True' % files)
+        boundary = uuid.uuid4().hex
+        headers = {'Content-Type': 'multipart/form-data; boundary=%s' % boundary}
+        opts['recursive'] = recursive
+        data = _multipart_body(files, boundary, self.chunk_size, self.executor)
+        return await self._request(
+            'add', (), opts, data=data, headers=headers, decoder='ndjson')
+
+    async def cat(self, multihash, offset=0, length=None):
+        return await self._request(
+            'cat', (multihash,), {'offset': offset, 'length': length}, decoder=None)
+
+    def cat_iter(self, multihash, offset=0, length=None):
+        return self._request_iter(
+            'cat', (multihash,), {'offset': offset, 'length': length})
+
+    async def name_publish(self, ipfs_path, key=None, lifetime=None, ttl=None,
+                           resolve=None):
+        return await self._request(
+            'name/publish', (ipfs_path,),
+            {'key': key, 'lifetime': lifetime, 'ttl': ttl, 'resolve': resolve})
+
+
+async def connect(host=DEFAULT_HOST, port=DEFAULT_PORT, base=DEFAULT_BASE, **kwargs):
+    """Mirrors the ipfsapi.connect(), but returns a native async Client,
+    raises if the daemon isn't reachable"""
+    client = Client(host, port, base, **kwargs)
+    try:
+        await client.version()
+    except:
+        await client.close()
+        raise
+    return client
@@ -0,0 +1,139 @@
+"""
+Publishing the data root hash through ipns
+
+An ipns publish takes seconds, and the root hash changes with every write,
+so the Publisher publishes the latest root hash at most once every window
+seconds. Hashes that were superseded before their turn came are skipped,
+since the latest one includes their changes. Failed publishes are retried
+with the latest hash, backing off exponentially.
+
+At shutdown, close() publishes the latest root hash right away, for at
+most FINAL_TIMEOUT seconds, so the last changes aren't left unpublished
+until the next start.
+
+The publish lag, the time from the oldest unpublished change of the root
+to its publication, is observed in metrics.IPNS_PUBLISH_LAG
+"""
+import time
+import asyncio
+import logging
+from rememberberry import metrics
+
+# Min seconds between publishes
+WINDOW = 60.0
+MIN_BACKOFF = 5.0
+MAX_BACKOFF = 300.0
+# Max seconds for the last publish at shutdown
+FINAL_TIMEOUT = 10.0
+
+
+class Publisher:
+    """Publishes the root hashes passed to notify() with the coroutine
+    function publish(root_hash), once start()ed"""
+    def __init__(self, publish, window=WINDOW, min_backoff=MIN_BACKOFF,
+                 max_backoff=MAX_BACKOFF):
+        self.publish = publish
+        self.window = window
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.enabled = False
+        self.latest = None
+        self.published = None
+        self.changed_at = None # of the oldest unpublished change
+        self.last_publish = None
+        self.publishes = 0
+        self.skipped = 0
+        self.failures = 0
+        self._publishing = None
+        self._wakeup = None
+        self._task = None
+
+    def notify(self, root_hash):
+        """Call whenever the root hash changes"""
+        if root_hash is None or root_hash == self.latest:
+            return
+        if self.latest not in (None, self.published, self._publishing):
+            self.skipped += 1
+        self.latest = root_hash
+        if root_hash == self.published and self._publishing is None:
+            # Changed back to what's published, nothing to do
+            self.changed_at = None
+        elif self.changed_at is None:
+            self.changed_at = time.monotonic()
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._wakeup = None
+
+    async def close(self, timeout=FINAL_TIMEOUT):
+        """Stops, and publishes the latest root hash if it isn't yet,
+        giving up after timeout seconds"""
+        self.stop()
+        if not self.enabled or self.latest in (None, self.published):
+            return
+        root_hash, changed_at = self.latest, self.changed_at
+        try:
+            await asyncio.wait_for(self.publish(root_hash), timeout)
+        except Exception:
+            logging.exception('publishing %s to ipns at shutdown failed' % root_hash)
+            self.failures += 1
+            return
+        self._published(root_hash, changed_at)
+
+    def _published(self, root_hash, changed_at):
+        self.last_publish = time.monotonic()
+        self.published = root_hash
+        self.publishes += 1
+        if changed_at is not None:
+            metrics.IPNS_PUBLISH_LAG.observe(self.last_publish - changed_at)
+        logging.info('published %s to ipns' % root_hash)
+
+    async def _run(self):
+        backoff = self.min_backoff
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.latest != self.published:
+                if self.last_publish is not None:
+                    await asyncio.sleep(
+                        max(self.last_publish + self.window - time.monotonic(), 0))
+
+                # Changes from here on are pending for the next publish
+                root_hash, changed_at = self.latest, self.changed_at
+                self._publishing, self.changed_at = root_hash, None
+                try:
+                    await self.publish(root_hash)
+                except Exception:
+                    logging.exception('publishing %s to ipns failed, retrying in %.0fs' % (
+                        root_hash, backoff))
+                    self.failures += 1
+                    self.changed_at = changed_at
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                finally:
+                    self._publishing = None
+
+                backoff = self.min_backoff
+                self._published(root_hash, changed_at)
+
+    def stats(self):
+        return {
+            'publishes': self.publishes,
+            'skipped': self.skipped,
+            'failures': self.failures,
+            'pending': int(self.latest != self.published),
+            'unpublished_age': (time.monotonic() - self.changed_at
+                                if self.changed_at is not None else 0.0),
+        }
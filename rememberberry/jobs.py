@@ -0,0 +1,168 @@
+"""
+Admission control for heavy operations
+
+Syncs with ankiweb, ankiweb logins and collection checkouts used to start
+right away in whichever turn asked for them, so a few first time syncs at
+once could saturate the disk and the ipfs daemon for everyone. They now
+run as jobs of a class, see CLASSES, which are admitted by the JobQueue:
+
+- at most max_active jobs run at once, and at most the limit of their class
+- jobs of more urgent classes (lower priority) are admitted first, and
+  only 'study' jobs may take the last reserved slots, so study turns don't
+  wait behind bulk syncs
+- within a priority, users with fewer running jobs go first, then it's
+  first come first served
+
+Jobs are used as async context managers, or, to tell the user where they
+are in the queue, through Job.positions() and Job.done()
+"""
+import time
+import asyncio
+import logging
+from rememberberry import metrics
+
+# class -> (priority, max running jobs of the class)
+CLASSES = {
+    'study': (0, 8), # checking out collections for study sessions
+    'auth': (1, 4), # logging in to ankiweb
+    'sync': (2, 2), # syncing with ankiweb, on the user's request
+    'resync': (3, 2), # syncing with ankiweb in the background, see resync.CONCURRENCY
+}
+MAX_ACTIVE = 8
+RESERVED = 2 # slots only 'study' jobs can take
+POSITION_INTERVAL = 2.0
+
+
+class Job:
+    def __init__(self, queue, kind, username, seq):
+        self.queue = queue
+        self.kind = kind
+        self.username = username
+        self.priority = queue.classes[kind][0]
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.admitted = asyncio.Future()
+
+    def position(self):
+        """1 for the next job to be admitted, 0 once admitted"""
+        return self.queue.position(self)
+
+    async def wait(self):
+        await asyncio.shield(self.admitted)
+
+    async def positions(self, interval=POSITION_INTERVAL):
+        """Yields the position of the job while it waits, when it changes
+        but at most every interval seconds, and returns once admitted"""
+        last = None
+        while not self.admitted.done():
+            position = self.position()
+            if position != last:
+                last = position
+                yield position
+            try:
+                await asyncio.wait_for(asyncio.shield(self.admitted), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def done(self):
+        """Gives back the job's slot, or leaves the queue if still waiting"""
+        self.queue._finish(self)
+
+    async def __aenter__(self):
+        try:
+            await self.wait()
+        except:
+            self.done()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.done()
+
+
+class JobQueue:
+    def __init__(self, classes=CLASSES, max_active=MAX_ACTIVE, reserved=RESERVED):
+        self.classes = classes
+        self.max_active = max_active
+        self.reserved = reserved
+        self._waiting = []
+        self._active = set()
+        self._seq = 0
+        self.counts = {kind: {'admitted': 0, 'cancelled': 0} for kind in classes}
+
+    def set_limit(self, kind, limit):
+        self.classes = dict(self.classes)
+        self.classes[kind] = (self.classes[kind][0], limit)
+        self._admit()
+
+    def job(self, kind, username):
+        """Queues a job of class kind for username, it has to be done()"""
+        self._seq += 1
+        job = Job(self, kind, username, self._seq)
+        self._waiting.append(job)
+        self._admit()
+        return job
+
+    def _running(self, kind=None, username=None):
+        return sum(1 for j in self._active
+                   if (kind is None or j.kind == kind) and
+                   (username is None or j.username == username))
+
+    def _order(self):
+        return sorted(self._waiting, key=lambda j: (
+            j.priority, self._running(username=j.username), j.seq))
+
+    def _can_run(self, job):
+        limit = self.max_active if job.kind == 'study' else self.max_active - self.reserved
+        return (len(self._active) < limit and
+                self._running(kind=job.kind) < self.classes[job.kind][1])
+
+    def _admit(self):
+        while True:
+            blocked = None # priority that has to be served first
+            for job in self._order():
+                if blocked is not None and job.priority > blocked:
+                    return
+                if self._can_run(job):
+                    break
+                if len(self._active) >= self.max_active - self.reserved:
+                    # Out of shared slots, don't let less urgent jobs pass
+                    blocked = job.priority
+            else:
+                return
+            self._waiting.remove(job)
+            self._active.add(job)
+            self.counts[job.kind]['admitted'] += 1
+            wait_time = time.monotonic() - job.enqueued
+            metrics.JOB_WAIT.observe(wait_time, job.kind)
+            if wait_time > POSITION_INTERVAL:
+                logging.info('%s job for %s waited %.1fs' % (job.kind, job.username, wait_time))
+            job.admitted.set_result(None)
+
+    def _finish(self, job):
+        if job in self._active:
+            self._active.remove(job)
+        elif job in self._waiting:
+            self._waiting.remove(job)
+            self.counts[job.kind]['cancelled'] += 1
+            job.admitted.cancel()
+        else:
+            return
+        self._admit()
+
+    def position(self, job):
+        if job not in self._waiting:
+            return 0
+        return self._order().index(job) + 1
+
+    def stats(self):
+        stats = {'active': len(self._active), 'waiting': len(self._waiting)}
+        for kind, counts in self.counts.items():
+            stats['%s_active' % kind] = self._running(kind=kind)
+            stats['%s_waiting' % kind] = sum(1 for j in self._waiting if j.kind == kind)
+            stats['%s_admitted' % kind] = counts['admitted']
+            stats['%s_cancelled' % kind] = counts['cancelled']
+        return stats
+
+
+JOBS = JobQueue()
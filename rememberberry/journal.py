@@ -0,0 +1,288 @@
+"""
+Session storage that persists changes as a journal
+
+FileStorage pickles the whole storage and writes it to mfs on every sync,
+so the cost of persisting a turn grows with everything the user has ever
+stored. JournaledStorage keeps track of the keys that were set or deleted
+since the last write, and a sync only pickles those and appends them to a
+journal next to the file (data.pickle.journal). Values that can be
+changed in place (lists, dicts, ...) and were looked up are compared with
+what was last written, by a digest of their pickle, so only the ones that
+actually changed are written. Once the journal grows past compact_bytes or compact_records, the full
+state is written in the background as a new snapshot and the journal is
+removed.
+
+Loading replays the journal on top of the snapshot. Replaying a journal
+that was already compacted into the snapshot gives the same state, so a
+crash between writing the snapshot and removing the journal is harmless
+"""
+import io
+import pickle
+import hashlib
+import asyncio
+import logging
+import weakref
+from rememberscript import FileStorage
+from rememberberry import ipfs
+
+# Values that can't change without being set again
+_IMMUTABLE = (str, bytes, int, float, bool, tuple, frozenset, type(None))
+
+
+def _fingerprint(value):
+    """A digest of the pickle of value, or None if it can't be pickled"""
+    try:
+        return hashlib.sha1(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).digest()
+    except Exception:
+        return None
+
+
+def _replay(state, journal):
+    """Applies the (set, deleted) records in journal to state, and returns
+    (number of records, offset after the last good one). A torn record at
+    the end is ignored"""
+    f = io.BytesIO(journal)
+    records = size = 0
+    while size < len(journal):
+        try:
+            changed, deleted = pickle.load(f)
+        except Exception:
+            logging.warning('ignoring a torn journal record')
+            break
+        state.update(changed)
+        for key in deleted:
+            state.pop(key, None)
+        records += 1
+        size = f.tell()
+    return records, size
+
+
+class _Journal:
+    """The journal of one file, shared by the storages using it so that
+    their records don't overwrite each other"""
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.records = 0
+        self.lock = asyncio.Lock()
+
+
+_JOURNALS = weakref.WeakValueDictionary()
+
+
+def _journal(path):
+    journal = _JOURNALS.get(path)
+    if journal is None:
+        journal = _JOURNALS[path] = _Journal(path + '.journal')
+    return journal
+
+
+class JournaledStorage(FileStorage):
+    def __init__(self, filename=None, compact_bytes=256*1024, compact_records=500):
+        self._dirty = set() # keys set or deleted since the last write
+        self._unpicklable = {} # key -> value that couldn't be pickled
+        self._looked_up = set() # keys of mutable values looked up since the last write
+        self._fingerprints = {} # key -> _fingerprint() of the mutable value as written
+        super().__init__(filename)
+        self.compact_bytes = compact_bytes
+        self.compact_records = compact_records
+        self.bytes_written = 0
+        self.snapshots = 0
+        self._journal = None # that the persisted state is in
+        self._compaction = None
+
+    # Change tracking
+    def _set_dirty(self, key):
+        self._dirty.add(key)
+        self._unpicklable.pop(key, None)
+        self._fingerprints.pop(key, None)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._set_dirty(key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._set_dirty(key)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if not isinstance(value, _IMMUTABLE):
+            if key not in self._fingerprints and key not in self._dirty:
+                # Not changed since it was written (or loaded) yet
+                self._fingerprints[key] = _fingerprint(value)
+            self._looked_up.add(key)
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        self._set_dirty(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._set_dirty(key)
+        return key, value
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        self._dirty.update(self.keys())
+        self._unpicklable.clear()
+        self._fingerprints.clear()
+        super().clear()
+
+    def _changed_in_place(self):
+        """The keys of the looked up values that changed since they were
+        written. Values that can't be pickled (e.g. modules) never are"""
+        looked_up, self._looked_up = self._looked_up, set()
+        changed = set()
+        for key in looked_up - self._dirty:
+            if key not in self:
+                continue
+            value = dict.__getitem__(self, key)
+            if self._unpicklable.get(key, self) is value:
+                continue
+            fingerprint = self._fingerprints.get(key)
+            if fingerprint is None:
+                continue
+            if _fingerprint(value) != fingerprint:
+                changed.add(key)
+        return changed
+
+    def _fingerprints_of(self, items):
+        return {key: _fingerprint(value) for key, value in items.items()
+                if not isinstance(value, _IMMUTABLE)}
+
+    def _dumps(self, items, deleted=None):
+        """Pickles the dict items, or (items, deleted) for a journal record,
+        leaving out the values that can't be pickled (e.g. anki collections)"""
+        items = {key: value for key, value in items.items()
+                 if self._unpicklable.get(key, self) is not value}
+        try:
+            return pickle.dumps(items if deleted is None else (items, deleted),
+                                pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            pass
+        for key, value in list(items.items()):
+            try:
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                logging.info('not persisting %s, it can\'t be pickled' % key)
+                self._unpicklable[key] = value
+                del items[key]
+        return pickle.dumps(items if deleted is None else (items, deleted),
+                            pickle.HIGHEST_PROTOCOL)
+
+    # Persistence
+    async def _read(self, path):
+        """Returns the persisted state at path, with the journal replayed"""
+        journal = _journal(path)
+        async with journal.lock:
+            data = await ipfs.mfs_read(path, 'b')
+            try:
+                records_data = await ipfs.mfs_read(journal.path, 'b')
+            except FileNotFoundError:
+                records_data = b''
+
+            state = pickle.loads(data)
+            journal.records, journal.size = _replay(state, records_data)
+            if journal.size < len(records_data):
+                # New records go after the last good one, or they'd never
+                # be replayed
+                await ipfs.mfs_write(journal.path, records_data[:journal.size], 'b')
+            self._journal = journal
+        return state
+
+    async def load(self):
+        state = await self._read(self.filename)
+        dirty = self._dirty
+        self.update(state)
+        # What was loaded is persisted already, changes from before aren't
+        self._dirty = dirty
+
+    async def sync(self):
+        """Runs the sync hooks of the values (e.g. anki collections), and
+        appends the changed keys to the journal"""
+        for value in list(self.values()):
+            hook = getattr(value, '__sync_hook__', None)
+            if hook is not None:
+                await hook()
+        if self.filename is None:
+            return
+
+        journal = _journal(self.filename)
+        async with journal.lock:
+            if self._journal is not journal:
+                # Nothing persisted to add to, write it all
+                await self._write_snapshot(journal)
+                return
+            self._dirty |= self._changed_in_place()
+            if not self._dirty:
+                return
+
+            dirty, self._dirty = self._dirty, set()
+            changed = {key: dict.__getitem__(self, key) for key in dirty if key in self}
+            deleted = [key for key in dirty if key not in self]
+            try:
+                record = self._dumps(changed, deleted)
+                fingerprints = self._fingerprints_of(changed)
+                await ipfs.mfs_append(journal.path, record, journal.size)
+            except:
+                self._dirty |= dirty
+                raise
+            self._fingerprints.update(fingerprints)
+            journal.size += len(record)
+            journal.records += 1
+            self.bytes_written += len(record)
+
+        if ((journal.size > self.compact_bytes or journal.records > self.compact_records)
+            and self._compaction is None):
+            self._compaction = asyncio.ensure_future(self._compact(journal, journal.size))
+
+    async def _write_snapshot(self, journal):
+        dirty, self._dirty = self._dirty, set()
+        looked_up, self._looked_up = self._looked_up, set()
+        try:
+            items = dict(self.items())
+            raw = self._dumps(items)
+            fingerprints = self._fingerprints_of(items)
+            await ipfs.mfs_write(journal.path[:-len('.journal')], raw, 'b')
+            if journal.size or self._journal is not journal:
+                await ipfs.mfs_rm(journal.path)
+        except:
+            self._dirty |= dirty
+            self._looked_up |= looked_up
+            raise
+        self._fingerprints.update(fingerprints)
+        journal.size = 0
+        journal.records = 0
+        self._journal = journal
+        self.bytes_written += len(raw)
+        self.snapshots += 1
+
+    async def _compact(self, journal, size):
+        try:
+            async with journal.lock:
+                if journal.size == size:
+                    # No other storage appended since, so this one has the
+                    # whole state
+                    await self._write_snapshot(journal)
+        except:
+            logging.exception('compacting %s failed' % journal.path)
+        finally:
+            self._compaction = None
+
+    async def wait_compaction(self):
+        """Waits for a running compaction, e.g. before shutting down"""
+        if self._compaction is not None:
+            await asyncio.shield(self._compaction)
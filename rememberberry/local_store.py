@@ -0,0 +1,565 @@
+"""
+A content addressed store on the local disk, for running without an ipfs
+daemon
+
+LocalStore implements the part of the ipfs api that the helpers in
+rememberberry.ipfs use (files_stat, files_ls, files_read, files_write,
+files_mkdir, files_rm, files_cp, add, cat, cat_iter) as methods of the same names, so it can stand in
+for ipfsapi_asyncio's Client as ipfs.API. Instead of the daemon's /ipfs/
+mount, the file and folder contexts check out hashes with checkout_file()
+and checkout_folder().
+
+Files are stored once by the sha256 of their contents in objects/, and the
+mutable tree (mfs) is a real folder, mfs/, whose files are hardlinks to the
+objects. Writing a whole file stores a new object and links it over the old
+one, so an object's contents never change. Writes at an offset (e.g. the
+appends of journal.py) modify the file in place instead, after unlinking it
+from its object with a private copy. A private file is only stored as an
+object once its hash is resolved (see _object()).
+Folders are hashed over the hashes of their entries, and a manifest of each
+folder hash is kept in dirs/ so that it can be checked out later. Checkouts
+are reflinks of the objects where the filesystem supports them (btrfs, xfs),
+and copies otherwise.
+
+Folder hashes are cached by path and the folder's mtime. Every change in
+mfs/ drops the cached hashes of the folders above it and touches them, so
+hashing the data root only rescans the folders on the changed paths, also
+when the change was made by another process.
+
+Objects that aren't linked from mfs/ anymore and manifests are removed by
+collect_garbage() after grace seconds, which leaves checkouts of recently
+stat'ed hashes plenty of time. Objects are touched when they're stored or
+looked up, under the same lock as the gc, so an object can't be collected
+between being found and linked. The store is used from several executor
+threads, the lock also guards its caches. The hashes are not ipfs multihashes, so a
+data root hash from this store can't be resolved through ipfs
+"""
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import shutil
+import asyncio
+import hashlib
+import logging
+import threading
+from functools import partial
+from rememberberry import executors
+from rememberberry.ipfsapi_asyncio import Error
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+GC_GRACE = 3600.0
+GC_INTERVAL = 600.0
+# Folder hashes are only cached once the folder's mtime is this old, so that
+# a change in the same mtime tick can't be missed
+MTIME_SLACK = 1.0
+# Size of the reads of cat_iter()
+CHUNK_SIZE = 256 * 1024
+
+
+def _not_found(path):
+    return Error('file does not exist: %s' % path)
+
+
+def _key(st):
+    # Also by mtime and size, in case an inode gets reused after the gc
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class LocalStore:
+    def __init__(self, path, executor='fs'):
+        self.path = path
+        self.executor = executor
+        self.stats = {'reflinks': 0, 'copies': 0, 'hashed': 0, 'collected': 0}
+        self._hashes = {} # _key() of an object -> its hash
+        self._private = {} # hash -> (fs path, _key()) of files not in objects/
+        self._dir_hashes = {} # fs path -> (mtime, hash, time the manifest was used)
+        self._gc_task = None
+        self._lock = threading.RLock() # for the above, and the gc
+        for name in ['objects', 'dirs', 'mfs', 'tmp']:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        self._reflinks = self._probe_reflinks()
+
+    # Paths
+    def _object_path(self, ipfs_hash):
+        return os.path.join(self.path, 'objects', ipfs_hash[:2], ipfs_hash)
+
+    def _dir_path(self, ipfs_hash):
+        return os.path.join(self.path, 'dirs', ipfs_hash[:2], ipfs_hash)
+
+    def _tmp_path(self):
+        return os.path.join(self.path, 'tmp', str(uuid.uuid4()))
+
+    def _fs_path(self, mfs_path):
+        """The path in the store of an mfs path or /ipfs/<hash> path,
+        returns (fs path, hash) where only one of them is set"""
+        parts = [p for p in mfs_path.split('/') if p]
+        if '..' in parts:
+            raise Error('invalid path: %s' % mfs_path)
+        if parts[:1] == ['ipfs']:
+            if len(parts) != 2:
+                raise Error('paths inside /ipfs/ hashes are not supported')
+            return None, parts[1]
+        return os.path.join(self.path, 'mfs', *parts), None
+
+    def _probe_reflinks(self):
+        src, dst = self._tmp_path(), self._tmp_path()
+        try:
+            with open(src, 'wb') as f:
+                f.write(b'probe')
+            with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return True
+        except OSError:
+            return False
+        finally:
+            for p in [src, dst]:
+                if os.path.exists(p):
+                    os.remove(p)
+
+    # Objects
+    def _store_object(self, tmp, ipfs_hash):
+        """Moves the file tmp into the store as ipfs_hash"""
+        path = self._object_path(ipfs_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            if os.path.exists(path):
+                os.remove(tmp)
+                # Still in use, don't let the gc take it
+                os.utime(path)
+            else:
+                os.chmod(tmp, 0o444)
+                os.rename(tmp, path)
+            st = os.stat(path)
+            self._hashes[_key(st)] = ipfs_hash
+        return path
+
+    def _store_bytes(self, data):
+        ipfs_hash = hashlib.sha256(data).hexdigest()
+        tmp = self._tmp_path()
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        return self._store_object(tmp, ipfs_hash)
+
+    def _store_file(self, fs_path):
+        tmp = self._tmp_path()
+        self._copy(fs_path, tmp)
+        h = hashlib.sha256()
+        with open(tmp, 'rb') as f:
+            for chunk in iter(partial(f.read, 1024*1024), b''):
+                h.update(chunk)
+        self._store_object(tmp, h.hexdigest())
+        return h.hexdigest()
+
+    def _copy(self, src, dst):
+        if self._reflinks:
+            try:
+                with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+                    fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                self.stats['reflinks'] += 1
+                return
+            except OSError:
+                pass
+        shutil.copyfile(src, dst)
+        self.stats['copies'] += 1
+
+    def _link(self, obj_path, fs_path):
+        """Links the object at obj_path to fs_path, replacing what's there"""
+        tmp = self._tmp_path()
+        try:
+            os.link(obj_path, tmp)
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            # Too many links to one object, fall back to a copy
+            shutil.copyfile(obj_path, tmp)
+        os.rename(tmp, fs_path)
+
+    def _file_hash(self, fs_path):
+        st = os.stat(fs_path)
+        with self._lock:
+            ipfs_hash = self._hashes.get(_key(st))
+        if ipfs_hash is None:
+            h = hashlib.sha256()
+            with open(fs_path, 'rb') as f:
+                for chunk in iter(partial(f.read, 1024*1024), b''):
+                    h.update(chunk)
+            ipfs_hash = h.hexdigest()
+            self.stats['hashed'] += 1
+            if st.st_nlink > 1:
+                with self._lock:
+                    self._hashes[_key(st)] = ipfs_hash
+        if st.st_nlink == 1 and fs_path.startswith(os.path.join(self.path, 'mfs', '')):
+            with self._lock:
+                self._private[ipfs_hash] = (fs_path, _key(st))
+        return ipfs_hash
+
+    def _object(self, ipfs_hash):
+        """The object path of the file ipfs_hash, storing it from the
+        private file in mfs/ that it was the hash of if needed. None if
+        there's no such file"""
+        path = self._object_path(ipfs_hash)
+        with self._lock:
+            if os.path.exists(path):
+                # About to be used, don't let the gc take it
+                os.utime(path)
+                return path
+            fs_path, key = self._private.pop(ipfs_hash, (None, None))
+        try:
+            if fs_path is None or _key(os.stat(fs_path)) != key:
+                return None
+        except FileNotFoundError:
+            return None
+        self._store_file(fs_path)
+        return path
+
+    def _changed(self, fs_path):
+        """Drops the cached hashes of the folders above fs_path, and touches
+        them for the caches of other processes"""
+        root = os.path.join(self.path, 'mfs')
+        path = os.path.dirname(fs_path)
+        while path.startswith(root):
+            with self._lock:
+                self._dir_hashes.pop(path, None)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            path = os.path.dirname(path)
+
+    def _dir_hash(self, fs_path):
+        now = time.time()
+        st = os.stat(fs_path)
+        with self._lock:
+            cached = self._dir_hashes.get(fs_path)
+        if (cached is not None and cached[0] == st.st_mtime_ns and
+            now - cached[2] < GC_GRACE / 2):
+            return cached[1]
+
+        entries = {}
+        for entry in os.scandir(fs_path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    entries[entry.name] = ['dir', self._dir_hash(entry.path)]
+                else:
+                    entries[entry.name] = ['file', self._file_hash(entry.path)]
+            except FileNotFoundError:
+                # Removed meanwhile, the folder's mtime changed with it so
+                # this hash isn't used again
+                pass
+        manifest = json.dumps(entries, sort_keys=True).encode('utf-8')
+        ipfs_hash = hashlib.sha256(b'dir\0' + manifest).hexdigest()
+
+        path = self._dir_path(ipfs_hash)
+        with self._lock:
+            if os.path.exists(path):
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = self._tmp_path()
+                with open(tmp, 'wb') as f:
+                    f.write(manifest)
+                os.rename(tmp, path)
+        if (fs_path.startswith(os.path.join(self.path, 'mfs')) and
+            now - st.st_mtime > MTIME_SLACK):
+            with self._lock:
+                self._dir_hashes[fs_path] = (st.st_mtime_ns, ipfs_hash, now)
+        return ipfs_hash
+
+    def _manifest(self, ipfs_hash):
+        try:
+            with open(self._dir_path(ipfs_hash), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except FileNotFoundError:
+            return None
+
+    def _resolve(self, path):
+        """Returns ('file', object path) or ('dir', manifest) of an
+        /ipfs/<hash> path"""
+        fs_path, ipfs_hash = self._fs_path(path)
+        obj = self._object(ipfs_hash)
+        if obj is not None:
+            return 'file', obj
+        manifest = self._manifest(ipfs_hash)
+        if manifest is None:
+            raise _not_found(path)
+        return 'dir', manifest
+
+    def _materialize(self, manifest, fs_path):
+        os.mkdir(fs_path)
+        for name, (kind, ipfs_hash) in manifest.items():
+            if kind == 'dir':
+                self._materialize(self._manifest(ipfs_hash), os.path.join(fs_path, name))
+            else:
+                self._link(self._object(ipfs_hash), os.path.join(fs_path, name))
+
+    # Blocking versions of the api
+    def _stat(self, path):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if fs_path is None:
+            kind, obj = self._resolve(path)
+            size = os.path.getsize(obj) if kind == 'file' else 0
+            return {'Hash': ipfs_hash, 'Size': size,
+                    'Type': 'file' if kind == 'file' else 'directory'}
+        if os.path.isdir(fs_path):
+            return {'Hash': self._dir_hash(fs_path), 'Size': 0, 'Type': 'directory'}
+        if os.path.isfile(fs_path):
+            return {'Hash': self._file_hash(fs_path), 'Size': os.path.getsize(fs_path),
+                    'Type': 'file'}
+        raise _not_found(path)
+
+    def _ls(self, path, l=False):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if fs_path is None:
+            raise Error('listing /ipfs/ paths is not supported')
+        if not os.path.isdir(fs_path):
+            raise _not_found(path)
+        entries = []
+        for entry in sorted(os.scandir(fs_path), key=lambda e: e.name):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not l:
+                entries.append({'Name': entry.name, 'Type': 0, 'Size': 0, 'Hash': ''})
+            elif is_dir:
+                entries.append({'Name': entry.name, 'Type': 1, 'Size': 0,
+                                'Hash': self._dir_hash(entry.path)})
+            else:
+                entries.append({'Name': entry.name, 'Type': 0,
+                                'Size': entry.stat().st_size,
+                                'Hash': self._file_hash(entry.path)})
+        return {'Entries': entries}
+
+    def _read(self, path, offset=0, count=None):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if fs_path is None:
+            kind, fs_path = self._resolve(path)
+            if kind != 'file':
+                raise Error('%s is a directory' % path)
+        try:
+            with open(fs_path, 'rb') as f:
+                f.seek(offset)
+                return f.read() if count is None else f.read(count)
+        except (FileNotFoundError, IsADirectoryError):
+            raise _not_found(path)
+
+    def _write(self, path, data, offset=0, create=False, truncate=False):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if fs_path is None:
+            raise Error('/ipfs/ paths are read only')
+        if not os.path.isdir(os.path.dirname(fs_path)):
+            raise _not_found(os.path.dirname(path))
+        exists = os.path.isfile(fs_path)
+        if not exists and not create:
+            raise _not_found(path)
+        if truncate or not exists:
+            self._link(self._store_bytes(b'\0' * offset + data), fs_path)
+            self._changed(fs_path)
+            return
+
+        # Written in place, on a private copy if it's linked to an object
+        if os.stat(fs_path).st_nlink > 1:
+            tmp = self._tmp_path()
+            self._copy(fs_path, tmp)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, fs_path)
+        with open(fs_path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        self._changed(fs_path)
+
+    def _mkdir(self, path, parents=False):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if parents:
+            os.makedirs(fs_path, exist_ok=True)
+        else:
+            try:
+                os.mkdir(fs_path)
+            except FileNotFoundError:
+                raise _not_found(os.path.dirname(path))
+            except FileExistsError:
+                raise Error('file already exists')
+        self._changed(fs_path)
+
+    def _rm(self, path, recursive=False):
+        fs_path, ipfs_hash = self._fs_path(path)
+        if os.path.isdir(fs_path):
+            if not recursive:
+                raise Error('%s is a directory, use -r to remove directories' % path)
+            shutil.rmtree(fs_path)
+            with self._lock:
+                for p in [p for p in self._dir_hashes
+                          if p == fs_path or p.startswith(os.path.join(fs_path, ''))]:
+                    del self._dir_hashes[p]
+        elif os.path.lexists(fs_path):
+            os.remove(fs_path)
+        else:
+            raise _not_found(path)
+        self._changed(fs_path)
+
+    def _cp(self, src, dst):
+        dst_path, ipfs_hash = self._fs_path(dst)
+        if dst_path is None:
+            raise Error('/ipfs/ paths are read only')
+        if os.path.lexists(dst_path):
+            raise Error('directory already has entry by that name')
+        if not os.path.isdir(os.path.dirname(dst_path)):
+            raise _not_found(os.path.dirname(dst))
+
+        src_path, ipfs_hash = self._fs_path(src)
+        if src_path is not None:
+            # Pin down the source's contents by hash, then copy that
+            ipfs_hash = self._stat(src)['Hash']
+        kind, obj = self._resolve('/ipfs/%s' % ipfs_hash)
+        if kind == 'file':
+            self._link(obj, dst_path)
+        else:
+            tmp = self._tmp_path()
+            self._materialize(obj, tmp)
+            os.rename(tmp, dst_path)
+        self._changed(dst_path)
+
+    def _add(self, fs_path, recursive=False):
+        name = os.path.basename(fs_path.rstrip('/'))
+        if not os.path.isdir(fs_path):
+            return {'Name': name, 'Hash': self._store_file(fs_path)}
+        if not recursive:
+            raise Error('%s is a directory, use the \'-r\' flag' % fs_path)
+
+        # Build the folder in tmp/ out of the stored objects, and hash it
+        tmp = self._tmp_path()
+        os.mkdir(tmp)
+        try:
+            for root, dirs, files in os.walk(fs_path):
+                # Hidden files are skipped, like ipfs add does
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                rel_root = os.path.relpath(root, fs_path)
+                os.makedirs(os.path.join(tmp, rel_root), exist_ok=True)
+                for f in files:
+                    if f.startswith('.'):
+                        continue
+                    ipfs_hash = self._store_file(os.path.join(root, f))
+                    self._link(self._object_path(ipfs_hash),
+                               os.path.normpath(os.path.join(tmp, rel_root, f)))
+            return {'Name': name, 'Hash': self._dir_hash(tmp)}
+        finally:
+            shutil.rmtree(tmp)
+
+    def checkout_file(self, ipfs_hash, fs_path):
+        """Copies the file ipfs_hash to fs_path, where it can be modified"""
+        kind, obj = self._resolve('/ipfs/%s' % ipfs_hash)
+        if kind != 'file':
+            raise Error('%s is a directory' % ipfs_hash)
+        self._copy(obj, fs_path)
+        os.chmod(fs_path, 0o644)
+
+    def checkout_folder(self, ipfs_hash, fs_path, manifest=None, rel_root=''):
+        """Copies the folder ipfs_hash to fs_path, and returns a manifest of
+        the copy like ipfs._copy_with_manifest does"""
+        kind, entries = self._resolve('/ipfs/%s' % ipfs_hash)
+        if kind != 'dir':
+            raise Error('%s is not a directory' % ipfs_hash)
+        manifest = {} if manifest is None else manifest
+        os.makedirs(fs_path, exist_ok=True)
+        for name, (kind, entry_hash) in entries.items():
+            dst = os.path.join(fs_path, name)
+            rel = os.path.join(rel_root, name)
+            if kind == 'dir':
+                self.checkout_folder(entry_hash, dst, manifest, rel)
+                continue
+            self._copy(self._object(entry_hash), dst)
+            os.chmod(dst, 0o644)
+            st = os.stat(dst)
+            manifest[rel] = (st.st_size, st.st_mtime_ns, entry_hash)
+        return manifest
+
+    def collect_garbage(self, grace=None):
+        """Removes the objects that aren't in the mfs tree and the manifests
+        that weren't used for grace seconds, returns how many"""
+        deadline = time.time() - (GC_GRACE if grace is None else grace)
+        removed = 0
+        for name in ['objects', 'dirs', 'tmp']:
+            for root, dirs, files in os.walk(os.path.join(self.path, name)):
+                for f in files:
+                    path = os.path.join(root, f)
+                    try:
+                        with self._lock:
+                            st = os.stat(path)
+                            if st.st_mtime >= deadline or (
+                                    name == 'objects' and st.st_nlink > 1):
+                                continue
+                            os.remove(path)
+                            self._hashes.pop(_key(st), None)
+                        removed += 1
+                    except FileNotFoundError:
+                        # Another process got it first
+                        pass
+        self.stats['collected'] += removed
+        return removed
+
+    async def _run(self, func, *args, **kwargs):
+        return await executors.run_in(self.executor, func, *args, **kwargs)
+
+    # The ipfsapi_asyncio.Client api
+    async def version(self):
+        return {'Version': 'local'}
+
+    async def files_stat(self, path):
+        return await self._run(self._stat, path)
+
+    async def files_ls(self, path, l=False):
+        return await self._run(self._ls, path, l)
+
+    async def files_read(self, path, offset=0, count=None):
+        return await self._run(self._read, path, offset, count)
+
+    async def cat(self, ipfs_hash, offset=0, length=None):
+        return await self._run(self._read, '/ipfs/%s' % ipfs_hash, offset, length)
+
+    async def cat_iter(self, ipfs_hash, offset=0, length=None):
+        stop = None if length is None else offset + length
+        while stop is None or offset < stop:
+            count = CHUNK_SIZE if stop is None else min(CHUNK_SIZE, stop - offset)
+            chunk = await self.cat(ipfs_hash, offset, count)
+            if not chunk:
+                return
+            yield chunk
+            offset += len(chunk)
+
+    async def files_write(self, path, f, offset=0, create=False, truncate=False):
+        data = f.read() if hasattr(f, 'read') else f
+        await self._run(self._write, path, data, offset, create, truncate)
+
+    async def files_mkdir(self, path, parents=False):
+        await self._run(self._mkdir, path, parents)
+
+    async def files_rm(self, path, recursive=False):
+        await self._run(self._rm, path, recursive)
+
+    async def files_cp(self, src, dst):
+        await self._run(self._cp, src, dst)
+
+    async def add(self, fs_path, recursive=False, quieter=False):
+        return await self._run(self._add, fs_path, recursive)
+
+    def start_gc(self, interval=None):
+        """Collects garbage every interval seconds in the background"""
+        if self._gc_task is None:
+            self._gc_task = asyncio.ensure_future(self._gc_loop(interval or GC_INTERVAL))
+
+    async def _gc_loop(self, interval):
+        while True:
+            try:
+                removed = await self._run(self.collect_garbage)
+                if removed:
+                    logging.info('removed %i unused objects from %s' % (removed, self.path))
+            except:
+                logging.exception('collecting garbage in %s failed' % self.path)
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            self._gc_task = None
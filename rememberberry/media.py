@@ -0,0 +1,217 @@
+"""
+Serving the media files of anki collections over http
+
+The media that cards reference (e.g. <img src="cat.jpg">) are in the
+user's collection.media folder in mfs, which the server had no way to
+serve. When a collection is opened, the hashes of its media files are
+listed (see load_hashes()), and rewrite() points the references in the
+card html to /media/<hash>/<signature>/<name> urls, served by handler()
+from the storage backend by hash.
+
+The contents of a url can never change, so responses have a strong etag
+(the hash) and are cacheable forever, by clients and by any cdn in front
+of BASE_URL. Range requests are supported, for audio and video. Only
+hashes this server put in a card can be fetched, the signature is an hmac
+of the hash with SECRET, so the route isn't an open gateway to whatever
+is in the storage backend. SECRET is made once and kept in SECRET_FILE
+on the local disk (see init()), so the urls, and what's cached of them,
+stay the same across restarts. It must not be under DATA_ROOT, whose root
+is published. --media-secret overrides it
+"""
+import os
+import re
+import hmac
+import asyncio
+import binascii
+import hashlib
+import logging
+import mimetypes
+from html import unescape
+from urllib.parse import quote, unquote
+from aiohttp import web
+from rememberberry import ipfs, executors
+
+ROUTE = '/media/{hash:[A-Za-z0-9]+}/{sig:[0-9a-f]+}/{name}'
+# Prepended to the media urls, e.g. the url of a cdn, served from the root
+BASE_URL = ''
+# Key of the url signatures, loaded by init() unless set
+SECRET = None
+# Where the secret is kept, outside of the storage backend
+SECRET_FILE = os.path.join(os.path.expanduser('~'), '.rememberberry', 'media_secret')
+# Only the process that serves the media makes the secret, see workers.py
+CREATE_SECRET = True
+SECRET_WAIT = 30.0
+_loading = None
+MAX_AGE = 365 * 24 * 3600
+
+# Counters for all requests
+STATS = {'requests': 0, 'not_modified': 0, 'ranges': 0, 'rejected': 0, 'bytes': 0}
+
+# The src attribute of tags that load media, quoted or not
+_SRC_RE = re.compile(
+    r'''(<(?:img|audio|video|source)\b[^>]*?\ssrc=)(?:"([^"]*)"|'([^']*)'|([^\s>"']+))''',
+    re.IGNORECASE)
+
+
+def _read_secret():
+    with open(SECRET_FILE) as f:
+        return binascii.unhexlify(f.read().strip())
+
+
+def _create_secret():
+    """Writes a new secret to SECRET_FILE, unless there is one already"""
+    os.makedirs(os.path.dirname(SECRET_FILE), mode=0o700, exist_ok=True)
+    secret = os.urandom(32)
+    try:
+        fd = os.open(SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, 'w') as f:
+        f.write(binascii.hexlify(secret).decode('ascii'))
+
+
+async def _load_secret():
+    global SECRET
+    deadline = asyncio.get_event_loop().time() + SECRET_WAIT
+    while True:
+        try:
+            SECRET = await executors.run_in('fs', _read_secret)
+            return
+        except FileNotFoundError:
+            pass
+        if CREATE_SECRET:
+            logging.info('making a new media url secret in %s' % SECRET_FILE)
+            await executors.run_in('fs', _create_secret)
+            continue
+        if asyncio.get_event_loop().time() > deadline:
+            raise TimeoutError('no media url secret in %s' % SECRET_FILE)
+        await asyncio.sleep(0.5)
+
+
+async def init():
+    """Loads SECRET from SECRET_FILE, making it the first time"""
+    global _loading
+    if SECRET is not None:
+        return
+    if _loading is None or _loading.done():
+        _loading = asyncio.ensure_future(_load_secret())
+    await asyncio.shield(_loading)
+
+
+def _sign(ipfs_hash):
+    return hmac.new(SECRET, ipfs_hash.encode('utf-8'), hashlib.sha256).hexdigest()[:32]
+
+
+def url(ipfs_hash, name):
+    """The url of the media file ipfs_hash, name only sets the content type"""
+    return '%s/media/%s/%s/%s' % (BASE_URL, ipfs_hash, _sign(ipfs_hash), quote(name, safe=''))
+
+
+async def load_hashes(col, mfs_path):
+    """Lists the hashes of the media files in the folder mfs_path for
+    rewrite(), it's kept on the collection until it's closed"""
+    await init()
+    col.__media_hashes__ = await ipfs.mfs_ls(mfs_path)
+
+
+def rewrite(col, html):
+    """Points the media references in the html of a card of col to their urls.
+    Files that aren't in the collection's media (e.g. remote urls) are left
+    alone"""
+    hashes = getattr(col, '__media_hashes__', None)
+    if not hashes:
+        return html
+
+    def repl(m):
+        src = next(g for g in m.groups()[1:] if g is not None)
+        name = unescape(src)
+        if name not in hashes:
+            name = unquote(name)
+        if name not in hashes:
+            return m.group(0)
+        return '%s"%s"' % (m.group(1), url(hashes[name], name))
+    return _SRC_RE.sub(repl, html)
+
+
+def _range(request, size, etag):
+    """Returns (start, stop) of the requested range, or None for all of it"""
+    if 'Range' not in request.headers:
+        return None
+    if request.headers.get('If-Range', etag) != etag:
+        return None
+    try:
+        rng = request.http_range
+    except ValueError:
+        rng = None
+    if rng is None:
+        return None
+    start, stop = rng.start, rng.stop
+    if start is None:
+        start = 0
+    elif start < 0:
+        # The last -start bytes
+        start, stop = max(size + start, 0), size
+    stop = size if stop is None else min(stop, size)
+    if start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */%i' % size})
+    return start, stop
+
+
+async def handler(request):
+    """Serves /media/<hash>/<signature>/<name>"""
+    STATS['requests'] += 1
+    if ipfs.API is None:
+        await ipfs.init()
+    await init()
+    ipfs_hash = request.match_info['hash']
+    if not hmac.compare_digest(request.match_info['sig'], _sign(ipfs_hash)):
+        STATS['rejected'] += 1
+        raise web.HTTPNotFound()
+
+    etag = '"%s"' % ipfs_hash
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=%i, immutable' % MAX_AGE,
+        'Accept-Ranges': 'bytes',
+    }
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or etag in [t.strip() for t in if_none_match.split(',')]:
+        STATS['not_modified'] += 1
+        return web.Response(status=304, headers=headers)
+
+    try:
+        stat = await ipfs.API.files_stat('/ipfs/%s' % ipfs_hash)
+    except Exception:
+        logging.info('media %s not found' % ipfs_hash)
+        raise web.HTTPNotFound()
+    if stat['Type'] != 'file':
+        raise web.HTTPNotFound()
+    size = stat['Size']
+
+    start, stop = 0, size
+    rng = _range(request, size, etag)
+    status = 200
+    if rng is not None:
+        STATS['ranges'] += 1
+        start, stop = rng
+        status = 206
+        headers['Content-Range'] = 'bytes %i-%i/%i' % (start, stop - 1, size)
+
+    resp = web.StreamResponse(status=status, headers=headers)
+    resp.content_type = (mimetypes.guess_type(request.match_info['name'])[0] or
+                         'application/octet-stream')
+    resp.content_length = stop - start
+    await resp.prepare(request)
+    if request.method != 'HEAD':
+        # One request for the whole range, files/read only takes mfs paths,
+        # cat reads by hash
+        async for chunk in ipfs.API.cat_iter(ipfs_hash, start, stop - start):
+            await resp.write(chunk)
+            STATS['bytes'] += len(chunk)
+    await resp.write_eof()
+    return resp
+
+
+def add_routes(app):
+    app.router.add_route('GET', ROUTE, handler)
+    app.router.add_route('HEAD', ROUTE, handler)
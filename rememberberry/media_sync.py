@@ -0,0 +1,107 @@
+"""
+Parallel, resumable media download for anki syncing
+
+Anki's MediaSyncer fetches the changed media one zip at a time, and gives
+no progress until it's done. ParallelMediaSyncer fetches up to concurrency
+zips at once, while the zips are still applied one by one on the calling
+thread (the media database can only be used from the thread that opened it).
+
+The media database is committed after every applied zip, so if the
+connection drops, the next sync skips the files that were already
+downloaded instead of starting over
+"""
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from anki.sync import MediaSyncer
+
+BATCH_SIZE = 25
+
+
+class ParallelMediaSyncer:
+    """Downloads the media that changed on the server, progress is called
+    with (files done, files total, bytes done) after every zip"""
+    def __init__(self, col, server, concurrency=4, batch_size=BATCH_SIZE,
+                 retries=3, retry_delay=1.0, progress=None):
+        self.col = col
+        self.server = server
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.progress = progress
+        self.files_done = 0
+        self.files_total = 0
+        self.bytes_done = 0
+
+    def sync(self):
+        media = self.col.media
+        media.findChanges()
+        last_usn = media.lastUsn()
+        server_usn = self.server.begin()['usn']
+        if last_usn == server_usn and not media.haveDirty():
+            return 'noChanges'
+
+        while True:
+            changes = self.server.mediaChanges(lastUsn=last_usn)
+            if not changes:
+                break
+
+            need = []
+            for fname, rusn, rsum in changes:
+                lsum, ldirty = media.syncInfo(fname)
+                if rsum and lsum != rsum:
+                    # Added or changed on the server
+                    need.append(fname)
+                elif not rsum and lsum and not ldirty:
+                    # Deleted on the server
+                    media.syncDelete(fname)
+                else:
+                    media.markClean([fname])
+
+            self.files_total += len(need)
+            self._download(need)
+            last_usn = changes[-1][1]
+            media.setLastUsn(last_usn)
+            media.db.commit()
+
+        if media.haveDirty():
+            # Let anki upload the local changes
+            return MediaSyncer(self.col, self.server).sync()
+        return 'success'
+
+    def _fetch(self, fnames):
+        for attempt in range(self.retries + 1):
+            try:
+                return self.server.downloadFiles(files=fnames)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logging.info('media download failed, retrying')
+                time.sleep(self.retry_delay * 2**attempt)
+
+    def _download(self, fnames):
+        todo = [fnames[i:i+self.batch_size] for i in range(0, len(fnames), self.batch_size)]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            running = {}
+            while todo or running:
+                while todo and len(running) < self.concurrency:
+                    batch = todo.pop(0)
+                    running[executor.submit(self._fetch, batch)] = batch
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    batch = running.pop(fut)
+                    zip_data = fut.result()
+                    count = self.col.media.addFilesFromZip(zip_data)
+                    self.col.media.db.commit()
+                    if count == 0:
+                        raise Exception('media server sent no files for %s' % batch)
+                    if count < len(batch):
+                        # The server can send fewer files than asked for
+                        todo.append(batch[count:])
+
+                    self.files_done += count
+                    self.bytes_done += len(zip_data)
+                    if self.progress is not None:
+                        self.progress(self.files_done, self.files_total, self.bytes_done)
@@ -0,0 +1,208 @@
+"""
+Latency histograms and gauges, served at /metrics in the Prometheus text
+format
+
+The histograms are defined here and observed where the work happens.
+Gauges are read when the metrics are requested, from functions registered
+with gauge() or stats()
+"""
+import math
+import time
+import threading
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SLOW_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+REGISTRY = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, str(v).replace('"', '\\"'))
+                             for n, v in zip(names, values))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._series = {} # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+
+    def time(self, *label_values):
+        """Context manager that observes the time spent in it"""
+        return _Timer(self, label_values)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted(self._series.items())
+            for label_values, (counts, total) in series:
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    labels = _format_labels(
+                        self.labels + ('le',), label_values + (_format_value(bound),))
+                    lines.append('%s_bucket%s %i' % (self.name, labels, cumulative))
+                labels = _format_labels(self.labels, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+                lines.append('%s_count%s %i' % (self.name, labels, cumulative))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start, *self.label_values)
+
+
+class Gauge:
+    """A gauge whose value is func(), or with a label, one value per key of
+    the dict that func() returns"""
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s gauge' % self.name]
+        value = self.func()
+        if self.label is None:
+            lines.append('%s %s' % (self.name, _format_value(value)))
+        else:
+            for key, v in sorted(value.items()):
+                labels = _format_labels((self.label,), (key,))
+                lines.append('%s%s %s' % (self.name, labels, _format_value(v)))
+        return lines
+
+
+class _Stats:
+    """Every number in the dict returned by func(), as a gauge"""
+    def __init__(self, prefix, func):
+        self.prefix = prefix
+        self.func = func
+
+    def render(self):
+        lines = []
+        for key, value in sorted(self.func().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = '%s_%s' % (self.prefix, key)
+                lines += ['# TYPE %s gauge' % name, '%s %s' % (name, _format_value(value))]
+        return lines
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    h = Histogram(name, help, labels, buckets)
+    REGISTRY.append(h)
+    return h
+
+
+def gauge(name, help, func, label=None):
+    g = Gauge(name, help, func, label)
+    REGISTRY.append(g)
+    return g
+
+
+def stats(prefix, func):
+    REGISTRY.append(_Stats(prefix, func))
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def _add_label(sample, label):
+    name, sep, rest = sample.partition(' ')
+    if name.endswith('}'):
+        return '%s,%s} %s' % (name[:-1], label, rest)
+    return '%s{%s} %s' % (name, label, rest)
+
+
+def merge(texts, name):
+    """Merges the metrics texts of several processes, given as (label value,
+    text) pairs, labeling every sample with name=label value"""
+    families = {} # metric name -> [comment lines, samples]
+    order = []
+    for value, text in texts:
+        label = '%s="%s"' % (name, value)
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# '):
+                metric = line.split(' ')[2]
+                if metric not in families:
+                    families[metric] = [[], []]
+                    order.append(metric)
+                family = families[metric]
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and family is not None:
+                family[1].append(_add_label(line, label))
+    lines = []
+    for metric in order:
+        lines += families[metric][0] + families[metric][1]
+    return '\n'.join(lines) + '\n'
+
+
+async def handler(request):
+    return web.Response(text=render(), content_type='text/plain')
+
+
+REPLY = histogram(
+    'rememberberry_reply_seconds', 'Time taken to reply to a message')
+IPFS_REQUEST = histogram(
+    'rememberberry_ipfs_request_seconds', 'Duration of ipfs api requests', ('method',))
+EXECUTOR_WAIT = histogram(
+    'rememberberry_executor_wait_seconds',
+    'Time blocking jobs waited for a worker thread', ('pool',))
+ANKI_SYNC = histogram(
+    'rememberberry_anki_sync_seconds',
+    'Duration of anki syncs, by how the collection was synced, or failed or timeout',
+    ('status',), buckets=SLOW_BUCKETS)
+COLLECTION = histogram(
+    'rememberberry_collection_seconds',
+    'Time taken to open, write back and close anki collections', ('op',))
+TURN_FRAMES = histogram(
+    'rememberberry_turn_frames', 'Websocket frames sent per turn',
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+TURN_BYTES = histogram(
+    'rememberberry_turn_bytes', 'Bytes of websocket frames sent per turn',
+    buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+JOB_WAIT = histogram(
+    'rememberberry_job_wait_seconds',
+    'Time heavy operations waited in the job queue', ('kind',))
+IPNS_PUBLISH_LAG = histogram(
+    'rememberberry_ipns_publish_lag_seconds',
+    'Time from a change of the data root to its ipns publication', buckets=SLOW_BUCKETS)
@@ -0,0 +1,202 @@
+"""
+Outbound messages of a websocket session
+
+Replies used to be sent with one unawaited send_str each, so a turn made
+several small frames and a client that didn't keep up made the server
+buffer without limit. Each session now has a Writer that:
+
+- for clients that negotiate the BATCH_PROTOCOL subprotocol, sends the
+  replies of a turn as one frame, a json list of the replies. Replies are
+  coalesced until the end of the turn, or until the turn went quiet for
+  flush_delay seconds, so that progress messages of long turns (e.g.
+  syncs) still go out while they happen. Other clients get a frame per
+  reply, like before
+- sends the frames from a bounded queue. When a client falls more than
+  max_frames or max_bytes behind, it's disconnected, or with
+  on_overflow='drop' its oldest frames are dropped
+
+Clients that negotiate COMPACT_PROTOCOL get batches too, and cards in the
+compact format (see anki_integration._render_question). Frames are
+compressed with permessage-deflate when the client offers it.
+
+The frames and bytes of every turn are observed in metrics.TURN_FRAMES and
+metrics.TURN_BYTES, before compression
+"""
+import json
+import asyncio
+import logging
+import weakref
+from collections import deque
+from aiohttp import web, WSCloseCode
+from rememberberry import metrics
+
+BATCH_PROTOCOL = 'rememberberry.batch'
+COMPACT_PROTOCOL = 'rememberberry.compact'
+PROTOCOLS = (COMPACT_PROTOCOL, BATCH_PROTOCOL)
+# Whether to accept permessage-deflate
+COMPRESS = True
+FLUSH_DELAY = 0.05
+MAX_FRAMES = 256
+MAX_BYTES = 4 * 1024 * 1024
+OVERFLOW_POLICIES = ['disconnect', 'drop']
+ON_OVERFLOW = 'disconnect'
+
+# Counters for all sessions
+STATS = {'frames': 0, 'bytes': 0, 'dropped_frames': 0, 'disconnects': 0}
+
+_ACTIVE = weakref.WeakSet()
+
+
+def response():
+    """A WebSocketResponse that negotiates the protocols and compression"""
+    return web.WebSocketResponse(protocols=PROTOCOLS, compress=COMPRESS)
+
+
+def batched(protocol):
+    return protocol in (BATCH_PROTOCOL, COMPACT_PROTOCOL)
+
+
+class Writer:
+    def __init__(self, ws, batch=False, flush_delay=None, max_frames=None, max_bytes=None,
+                 on_overflow=None):
+        self.ws = ws
+        self.batch = batch
+        self.flush_delay = flush_delay or FLUSH_DELAY
+        self.max_frames = max_frames or MAX_FRAMES
+        self.max_bytes = max_bytes or MAX_BYTES
+        self.on_overflow = on_overflow or ON_OVERFLOW
+        self.closed = False
+        self._pending = [] # replies of the batch being collected
+        self._flush_handle = None
+        self._queue = deque() # (frame, size)
+        self.queued_bytes = 0
+        self._turn_frames = 0
+        self._turn_bytes = 0
+        self._after_turn = [] # futures of after_turn() callbacks
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._task = asyncio.ensure_future(self._run())
+        _ACTIVE.add(self)
+
+    def send(self, reply):
+        if self.closed:
+            return
+        if not self.batch:
+            self._enqueue(reply)
+            return
+        self._pending.append(reply)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(
+                self.flush_delay, self.flush)
+
+    def flush(self):
+        """Sends the replies collected for the batch"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._pending:
+            pending, self._pending = self._pending, []
+            self._enqueue(json.dumps(pending))
+
+    def end_turn(self):
+        """Call when the replies to a message are done"""
+        self.flush()
+        metrics.TURN_FRAMES.observe(self._turn_frames)
+        metrics.TURN_BYTES.observe(self._turn_bytes)
+        self._turn_frames = self._turn_bytes = 0
+        if self._after_turn:
+            after_turn, self._after_turn = self._after_turn, []
+            asyncio.ensure_future(self._call_after_drain(after_turn))
+
+    def after_turn(self, callback):
+        """Calls callback once the replies of this turn were sent, for work
+        that would otherwise hold them up. Returns a future, cancelling it
+        cancels the call"""
+        fut = asyncio.get_event_loop().create_future()
+        fut.add_done_callback(lambda fut: fut.cancelled() or callback())
+        self._after_turn.append(fut)
+        return fut
+
+    async def _call_after_drain(self, futs):
+        await self._drained.wait()
+        for fut in futs:
+            if not fut.done():
+                fut.set_result(None)
+
+    def _enqueue(self, frame):
+        if self.closed:
+            return
+        size = len(frame.encode('utf-8'))
+        self._turn_frames += 1
+        self._turn_bytes += size
+        if len(self._queue) >= self.max_frames or self.queued_bytes + size > self.max_bytes:
+            if self.on_overflow == 'disconnect':
+                logging.info('disconnecting a client %i frames behind' % len(self._queue))
+                STATS['disconnects'] += 1
+                self._disconnect()
+                return
+            while self._queue and (len(self._queue) >= self.max_frames or
+                                   self.queued_bytes + size > self.max_bytes):
+                self.queued_bytes -= self._queue.popleft()[1]
+                STATS['dropped_frames'] += 1
+        self._queue.append((frame, size))
+        self.queued_bytes += size
+        self._drained.clear()
+        self._wakeup.set()
+
+    def _disconnect(self):
+        self.closed = True
+        self._pending = []
+        self._queue.clear()
+        self.queued_bytes = 0
+        self._drained.set()
+        self._task.cancel()
+        asyncio.ensure_future(self.ws.close(
+            code=WSCloseCode.TRY_AGAIN_LATER, message=b'too far behind'))
+
+    async def _run(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self._queue:
+                    frame, size = self._queue.popleft()
+                    self.queued_bytes -= size
+                    # Waits for the transport to drain when the client is slow
+                    await self.ws.send_str(frame)
+                    STATS['frames'] += 1
+                    STATS['bytes'] += size
+                self._drained.set()
+        except ConnectionError:
+            logging.info('websocket closed with replies left to send')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('sending replies failed')
+        finally:
+            # Nothing is sent after this, so nobody should wait for it
+            self.closed = True
+            self._queue.clear()
+            self.queued_bytes = 0
+            self._drained.set()
+
+    async def close(self, timeout=5.0):
+        """Sends what's left, waiting at most timeout seconds"""
+        self.flush()
+        _ACTIVE.discard(self)
+        if not self.closed:
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                logging.info('gave up sending %i frames to a slow client' % len(self._queue))
+        self.closed = True
+        self._task.cancel()
+        for fut in self._after_turn:
+            fut.cancel()
+        self._after_turn = []
+
+
+def stats():
+    return dict(STATS, sessions=len(_ACTIVE),
+                queued_bytes_max=max([w.queued_bytes for w in _ACTIVE] + [0]))
@@ -0,0 +1,83 @@
+"""
+Per-collection cache of rendered card html
+
+Rendering a card runs anki's template engine over the note's fields, which
+is the slowest part of showing a card for notes with complex templates,
+and the same card is often shown more than once in a session (e.g. when
+it's relearned). The rendered front and back are cached on the collection,
+keyed by everything the rendering depends on: the card, its template and
+deck, and the modification times of the note and the model. Editing a note
+or a model, locally or through a sync, bumps its mod so stale renders are
+never used, they just fall out of the cache
+"""
+from collections import OrderedDict
+
+# Defaults for new caches
+MAX_ENTRIES = 2000
+MAX_BYTES = 8*1024*1024
+
+# Counters for all caches
+STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+class RenderCache:
+    def __init__(self, col, max_entries=None, max_bytes=None):
+        self.col = col
+        self.max_entries = max_entries or MAX_ENTRIES
+        self.max_bytes = max_bytes or MAX_BYTES
+        self.size_bytes = 0 # of the renders as utf-8
+        self._entries = OrderedDict() # key -> ((front, back), size in bytes)
+
+    def _key(self, card):
+        row = self.col.db.first('select mid, mod from notes where id = ?', card.nid)
+        if row is None:
+            return None
+        mid, note_mod = row
+        model = self.col.models.get(mid)
+        model_mod = model['mod'] if model is not None else None
+        return (card.id, card.ord, card.did, card.odid, note_mod, mid, model_mod)
+
+    def render(self, card):
+        """Returns (card.q(), card.a())"""
+        key = self._key(card)
+        if key is not None and key in self._entries:
+            self._entries.move_to_end(key)
+            STATS['hits'] += 1
+            return self._entries[key][0]
+
+        STATS['misses'] += 1
+        rendered = card.q(), card.a()
+        if key is not None:
+            self._put(key, rendered)
+        return rendered
+
+    def _put(self, key, rendered):
+        size = len(rendered[0].encode('utf-8')) + len(rendered[1].encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        self._entries[key] = rendered, size
+        self.size_bytes += size
+        while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+            old_key, (old, old_size) = self._entries.popitem(last=False)
+            self.size_bytes -= old_size
+            STATS['evictions'] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.size_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def for_collection(col):
+    """Returns the render cache of the collection, creating it if needed"""
+    cache = getattr(col, '__render_cache__', None)
+    if cache is None:
+        cache = RenderCache(col)
+        col.__render_cache__ = cache
+    return cache
+
+
+def stats():
+    return dict(STATS)
@@ -0,0 +1,137 @@
+"""
+Background re-syncing of active users' collections with ankiweb
+
+Without it a collection is only synced when the user logs in to ankiweb,
+so reviews and cards added elsewhere never show up. Users that have an
+anki_hkey are tracked while they're active (see seen()), and their
+collections are delta synced (see anki_integration.sync_anki) every
+interval seconds, spread out with random jitter, with at most concurrency
+syncs at a time. Collections that are in use are tried again later rather
+than synced under the user's feet. Users that weren't seen for active_time
+seconds are dropped
+"""
+import time
+import random
+import asyncio
+import logging
+
+INTERVAL = 30 * 60.0
+JITTER = 0.2 # fraction of the interval
+CONCURRENCY = 2
+ACTIVE_TIME = 24 * 3600.0
+BUSY_RETRY = 60.0
+
+
+class _User:
+    def __init__(self, username, anki_hkey, due):
+        self.username = username
+        self.anki_hkey = anki_hkey
+        self.last_seen = time.monotonic()
+        self.due = due
+
+
+class Resyncer:
+    """Calls the coroutine function sync(username, anki_hkey), which returns
+    (status, error) like anki_integration.sync_anki"""
+    def __init__(self, sync, interval=INTERVAL, jitter=JITTER, concurrency=CONCURRENCY,
+                 active_time=ACTIVE_TIME, busy_retry=BUSY_RETRY):
+        self.sync = sync
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.active_time = active_time
+        self.busy_retry = busy_retry
+        self.enabled = False
+        # Whether a user should be synced by this process
+        self.is_owner = None
+        self.stats_counts = {'syncs': 0, 'no_changes': 0, 'full': 0, 'failures': 0,
+                             'busy': 0, 'dropped': 0}
+        self._users = {}
+        self._running = set()
+        self._semaphore = None
+        self._wakeup = None
+        self._task = None
+
+    def _next_due(self, delay):
+        return time.monotonic() + delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def seen(self, username, anki_hkey):
+        """Call when a user is active, they're synced while they keep being
+        seen"""
+        if not username or not anki_hkey:
+            return
+        if self.is_owner is not None and not self.is_owner(username):
+            return
+        user = self._users.get(username)
+        if user is None:
+            self._users[username] = _User(username, anki_hkey, self._next_due(self.interval))
+            if self._wakeup is not None:
+                self._wakeup.set()
+            return
+        user.anki_hkey = anki_hkey
+        user.last_seen = time.monotonic()
+
+    def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            self._wakeup = None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            for username in [u.username for u in self._users.values()
+                             if now - u.last_seen > self.active_time]:
+                del self._users[username]
+                self.stats_counts['dropped'] += 1
+
+            due = [u for u in self._users.values()
+                   if u.due <= now and u.username not in self._running]
+            for user in sorted(due, key=lambda u: u.due):
+                self._running.add(user.username)
+                asyncio.ensure_future(self._resync(user))
+
+            waiting = [u.due for u in self._users.values() if u.username not in self._running]
+            timeout = max(min(waiting) - now, 0) if waiting else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _resync(self, user):
+        try:
+            async with self._semaphore:
+                status, err = await self.sync(user.username, user.anki_hkey)
+        except Exception:
+            logging.exception('re-syncing %s failed' % user.username)
+            status, err = None, 'exception'
+        finally:
+            self._running.discard(user.username)
+
+        if status is None and err is None:
+            self.stats_counts['busy'] += 1
+            user.due = self._next_due(self.busy_retry)
+        else:
+            user.due = self._next_due(self.interval)
+            if err is not None:
+                logging.warning('re-syncing %s failed: %s' % (user.username, err))
+                self.stats_counts['failures'] += 1
+            else:
+                self.stats_counts['syncs'] += 1
+                if status == 'noChanges':
+                    self.stats_counts['no_changes'] += 1
+                elif status == 'full':
+                    self.stats_counts['full'] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self):
+        return dict(self.stats_counts, users=len(self._users), running=len(self._running))
@@ -0,0 +1,113 @@
+"""
+Process-wide cache of the loaded conversation script
+
+Loading the scripts parses every yaml file in SCRIPTS_PATH, executes their
+python companions and validates the whole graph, which is too slow to do
+for every new connection. The script graph itself doesn't change between
+sessions, so it's loaded and validated once and shared, while the names
+defined by the python companions are copied into each session's storage.
+
+The cache is reloaded whenever a file under SCRIPTS_PATH changes
+"""
+import os
+import copy
+import time
+import asyncio
+import logging
+import rememberberry
+from rememberscript import load_scripts_dir, validate_script
+from rememberberry import ipfs, tracing
+
+
+def _scripts_signature(path):
+    """Returns a hashable snapshot of the (name, mtime, size) of all the
+    files under path"""
+    signature = []
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            st = os.stat(os.path.join(root, name))
+            signature.append((os.path.join(root, name), st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+
+def _fresh(value):
+    """Values bound from the companion namespace are shared between sessions,
+    so give each session its own copy of mutable containers"""
+    if isinstance(value, (list, dict, set)):
+        return copy.deepcopy(value)
+    return value
+
+
+class ScriptCache:
+    """Holds the validated script graph together with the namespace that
+    the python companions define, see get_script()"""
+    def __init__(self, path=None, check_interval=1.0):
+        self._path = path
+        self.check_interval = check_interval
+        self.hits = 0
+        self.reloads = 0
+
+        self._script = None
+        self._namespace = None
+        self._signature = None
+        self._last_check = 0
+        self._lock = None
+
+    @property
+    def path(self):
+        return self._path or rememberberry.SCRIPTS_PATH
+
+    def _is_stale(self):
+        if self._script is None:
+            return True
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return False
+        if _scripts_signature(self.path) != self._signature:
+            return True
+        self._last_check = now
+        return False
+
+    async def _reload(self):
+        signature = _scripts_signature(self.path)
+        scratch = ipfs.get_ipfs_storage()
+        script = load_scripts_dir(self.path, scratch)
+        await validate_script(script)
+
+        self._script = script
+        self._namespace = tracing.wrap_namespace(dict(scratch.items()))
+        self._signature = signature
+        self._last_check = time.monotonic()
+        self.reloads += 1
+        logging.info('loaded scripts from %s' % self.path)
+
+    async def get_script(self, storage):
+        """Returns the script graph, and binds the companion namespace
+        into storage"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        if self._is_stale():
+            async with self._lock:
+                # Another connection may have reloaded while we waited
+                if self._is_stale():
+                    await self._reload()
+                else:
+                    self.hits += 1
+        else:
+            self.hits += 1
+
+        for key, value in self._namespace.items():
+            storage[key] = _fresh(value)
+        return self._script
+
+    def stats(self):
+        return {'hits': self.hits, 'reloads': self.reloads}
+
+
+CACHE = ScriptCache()
+
+
+async def get_script(storage):
+    return await CACHE.get_script(storage)
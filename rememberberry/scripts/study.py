@@ -1,3 +1,4 @@
 from rememberberry.anki_integration import format_anki_question, answer_card, get_anki_col
+from rememberberry.anki_integration import release_anki_col, CardLookahead
 from rememberberry.misc import number_between
 from anki.sched import Scheduler
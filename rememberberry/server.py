@@ -1,5 +1,6 @@
 import os
 import sys
+import signal
 import json
 import ssl
 import asyncio
@@ -10,54 +11,115 @@ import traceback
 from aiohttp import web
 
 import rememberberry
-from rememberberry import ipfs
-from rememberscript import RememberMachine, load_scripts_dir, validate_script
+from rememberberry import ipfs, auth, script_cache, executors, render_cache, workers
+from rememberberry import write_behind, metrics, anki_integration, tracing, ipns, resync, jobs
+from rememberberry import outbound, media, fakes
+from rememberberry.collection_pool import POOL
+from rememberscript import RememberMachine
 from anki.storage import _Collection
 
 app = web.Application()
+SOCKETS = set()
+
+for executor in executors.EXECUTORS.values():
+    executor.wait_listeners.append(
+        lambda name, wait_time: metrics.EXECUTOR_WAIT.observe(wait_time, name))
+metrics.gauge('rememberberry_websockets', 'Open websocket connections',
+              lambda: len(SOCKETS))
+metrics.gauge('rememberberry_open_collections', 'Anki collections in the pool',
+              lambda: len(POOL))
+metrics.gauge('rememberberry_auth_tokens', 'Active auth tokens',
+              lambda: len(auth.ACTIVE_AUTH_TOKENS))
+metrics.stats('rememberberry_pool', POOL.stats)
+metrics.stats('rememberberry_mfs_cache', ipfs.HASH_CACHE.stats)
+metrics.stats('rememberberry_root_hash', ipfs.ROOT.stats)
+metrics.stats('rememberberry_ipns', ipfs.PUBLISHER.stats)
+metrics.stats('rememberberry_resync', anki_integration.RESYNC.stats)
+metrics.stats('rememberberry_jobs', jobs.JOBS.stats)
+metrics.stats('rememberberry_outbound', outbound.stats)
+metrics.stats('rememberberry_media', lambda: media.STATS)
+metrics.stats('rememberberry_render_cache', render_cache.stats)
+metrics.stats('rememberberry_lookahead', lambda: anki_integration.LOOKAHEAD_STATS)
+metrics.stats('rememberberry_write_behind', write_behind.stats)
+for name in executors.DEFAULT_SIZES:
+    metrics.stats('rememberberry_executor_%s' % name,
+                  lambda name=name: executors.get(name).stats())
+
 
 async def cleanup(storage):
     for key, value in storage.items():
         if isinstance(value, _Collection):
-            print('saving anki collection...')
-            value.close(save=True)
+            print('releasing anki collection...')
+            await POOL.release(value)
 
     print('syncing storage...')
     await storage.sync()
+    await storage.wait_compaction()
 
 
 async def message_websocket_handler(request):
     logging.info('client connected')
     await ipfs.init()
-    ws = web.WebSocketResponse()
+    await auth.init()
+    ws = outbound.response()
     await ws.prepare(request)
+    SOCKETS.add(ws)
+    out = outbound.Writer(ws, batch=outbound.batched(ws.ws_protocol))
 
     storage = ipfs.get_ipfs_storage()
-    script = load_scripts_dir(rememberberry.SCRIPTS_PATH, storage)
-    await validate_script(script)
+    storage.compact_cards = ws.ws_protocol == outbound.COMPACT_PROTOCOL
+    storage.outbound = out
+    script = await script_cache.get_script(storage)
     machine = RememberMachine(script, storage)
     machine.init()
+    writer = write_behind.WriteBehind(storage)
     try:
         async for msg in ws:
-            if msg.tp == aiohttp.WSMsgType.TEXT:
+            if msg.type == aiohttp.WSMsgType.TEXT:
                 text = msg.data
-                async for reply in machine.reply(text):
-                    ws.send_str(reply)
+                with tracing.turn() as trace, metrics.REPLY.time():
+                    async for reply in tracing.steps(machine.reply(text)):
+                        trace.event('reply')
+                        out.send(reply)
+                    out.end_turn()
+                writer.mark_dirty()
+                anki_integration.RESYNC.seen(storage.get('username'), storage.get('anki_hkey'))
 
-            elif msg.tp == aiohttp.WSMsgType.ERROR:
+            elif msg.type == aiohttp.WSMsgType.ERROR:
                 logging.info('ws connection closed with exception %s' %
                       ws.exception())
+        await writer.close()
         await cleanup(storage)
+        await out.close()
     except:
+        await writer.close()
         await cleanup(storage)
         traceback.print_exc()
-        ws.send_str(json.dumps({'msg': traceback.format_exc()}))
+        out.send(json.dumps({'msg': traceback.format_exc()}))
+        await out.close()
         raise
+    finally:
+        SOCKETS.discard(ws)
     logging.info('websocket connection closed')
 
     return ws
 
 
+async def on_startup(app):
+    # kill -USR2 <pid> toggles profiling
+    asyncio.get_event_loop().add_signal_handler(signal.SIGUSR2, tracing.toggle_profiling)
+    anki_integration.RESYNC.start()
+
+
+async def on_shutdown(app):
+    anki_integration.RESYNC.stop()
+    print('writing back anki collections...')
+    await POOL.close_all()
+    await auth.ACTIVE_AUTH_TOKENS.stop()
+    await ipfs.flush_root_hash()
+    await ipfs.PUBLISHER.close()
+
+
 if __name__ == '__main__':
     lvl_map = {
         'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING,
@@ -70,6 +132,101 @@ if __name__ == '__main__':
     parser.add_argument("--logfile", help="the optional output log file", type=str)
     parser.add_argument("--loglvl", help="the log level",
                         type=str, choices=list(lvl_map.keys()), default='INFO')
+    parser.add_argument("--workers",
+                        help="number of server processes, connections are passed on to one of them",
+                        type=int, default=0)
+    parser.add_argument("--pool-size", help="max number of open anki collections",
+                        type=int, default=32)
+    parser.add_argument("--writeback-delay",
+                        help="seconds before a modified anki collection is written back",
+                        type=float, default=30.0)
+    parser.add_argument("--root-hash-interval",
+                        help="min seconds between recomputing the data root hash",
+                        type=float, default=1.0)
+    parser.add_argument("--root-hash-batch",
+                        help="recompute the data root hash after this many changes",
+                        type=int, default=100)
+    parser.add_argument("--render-cache-size",
+                        help="max bytes of rendered card html to cache per collection",
+                        type=int, default=render_cache.MAX_BYTES)
+    parser.add_argument("--write-behind-interval",
+                        help="max seconds before a session's changes are written",
+                        type=float, default=write_behind.INTERVAL)
+    parser.add_argument("--slow-turn-threshold",
+                        help="seconds after which the trace of a turn is written",
+                        type=float, default=tracing.SLOW_THRESHOLD)
+    parser.add_argument("--slow-turn-log",
+                        help="file to append slow turn traces to, instead of the log",
+                        type=str)
+    parser.add_argument("--profile-rate",
+                        help="fraction of the turns to profile, when toggled on with SIGUSR2",
+                        type=float, default=tracing.PROFILE_RATE)
+    parser.add_argument("--profile-file", help="where to write the profile",
+                        type=str, default=tracing.PROFILE_FILE)
+    parser.add_argument("--storage", help="keep the data in an ipfs daemon, or on the local disk",
+                        type=str, choices=ipfs.BACKENDS, default=ipfs.BACKEND)
+    parser.add_argument("--storage-path", help="where to keep the data with --storage local",
+                        type=str, default=ipfs.LOCAL_PATH)
+    parser.add_argument("--ipns-window",
+                        help="min seconds between publishing the data root to ipns",
+                        type=float, default=ipns.WINDOW)
+    parser.add_argument("--ipns-key", help="the ipfs key to publish the data root under",
+                        type=str, default=ipfs.IPNS_KEY)
+    parser.add_argument("--no-ipns", help="don't publish the data root to ipns",
+                        action="store_true")
+    parser.add_argument("--ipfs-host", help="host of the ipfs api",
+                        type=str, default=ipfs.API_HOST)
+    parser.add_argument("--ipfs-port", help="port of the ipfs api",
+                        type=int, default=ipfs.API_PORT)
+    parser.add_argument("--ipfs-mount", help="where the readonly /ipfs/ tree is mounted",
+                        type=str, default=ipfs.IPFS_MOUNT)
+    parser.add_argument("--resync-interval",
+                        help="seconds between background ankiweb syncs of active users",
+                        type=float, default=resync.INTERVAL)
+    parser.add_argument("--resync-concurrency",
+                        help="max number of background ankiweb syncs at a time",
+                        type=int, default=resync.CONCURRENCY)
+    parser.add_argument("--no-resync", help="don't sync with ankiweb in the background",
+                        action="store_true")
+    parser.add_argument("--fake-ankiweb",
+                        help="sync with copies of this collection instead of ankiweb, "
+                             "for load tests",
+                        type=str)
+    parser.add_argument("--max-send-queue",
+                        help="max bytes of replies queued for a client before it's too slow",
+                        type=int, default=outbound.MAX_BYTES)
+    parser.add_argument("--slow-client", help="what to do with clients that are too slow",
+                        type=str, choices=outbound.OVERFLOW_POLICIES, default=outbound.ON_OVERFLOW)
+    parser.add_argument("--no-deflate", help="don't compress websocket messages",
+                        action="store_true")
+    parser.add_argument("--media-url",
+                        help="where the media urls in cards point to, e.g. a cdn in front "
+                             "of this server, by default this server",
+                        type=str, default=media.BASE_URL)
+    parser.add_argument("--media-secret",
+                        help="key of the media url signatures, by default one is made and "
+                             "kept in --media-secret-file",
+                        type=str)
+    parser.add_argument("--media-secret-file",
+                        help="local file to keep the media url secret in, not in the storage",
+                        type=str, default=media.SECRET_FILE)
+    parser.add_argument("--max-jobs",
+                        help="max number of heavy operations (syncs, checkouts) at a time",
+                        type=int, default=jobs.MAX_ACTIVE)
+    parser.add_argument("--sync-jobs", help="max number of ankiweb syncs at a time",
+                        type=int, default=jobs.CLASSES['sync'][1])
+    parser.add_argument("--mfs-cache-ttl",
+                        help="seconds to cache mfs path lookups for", type=float, default=30.0)
+    parser.add_argument("--mfs-cache-size",
+                        help="max number of cached mfs path lookups", type=int, default=10000)
+    parser.add_argument("--token-ttl", help="seconds until auth tokens expire",
+                        type=float, default=30*24*3600)
+    parser.add_argument("--max-tokens", help="max number of active auth tokens",
+                        type=int, default=100000)
+    for name, size in executors.DEFAULT_SIZES.items():
+        parser.add_argument("--%s-workers" % name,
+                            help="number of threads for blocking %s work" % name,
+                            type=int, default=size)
 
     args = parser.parse_args()
 
@@ -77,6 +234,46 @@ if __name__ == '__main__':
     logging.basicConfig(
         format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p', level=args.loglvl)
 
+    POOL.max_size = args.pool_size
+    POOL.writeback_delay = args.writeback_delay
+    render_cache.MAX_BYTES = args.render_cache_size
+    write_behind.INTERVAL = args.write_behind_interval
+    tracing.SLOW_THRESHOLD = args.slow_turn_threshold
+    tracing.SLOW_LOG = args.slow_turn_log
+    tracing.PROFILE_RATE = args.profile_rate
+    tracing.PROFILE_FILE = args.profile_file
+    ipfs.BACKEND = args.storage
+    ipfs.LOCAL_PATH = args.storage_path
+    ipfs.IPNS_KEY = args.ipns_key
+    ipfs.PUBLISHER.window = args.ipns_window
+    ipfs.PUBLISHER.enabled = args.storage == 'ipfs' and not args.no_ipns
+    anki_integration.RESYNC.interval = args.resync_interval
+    anki_integration.RESYNC.concurrency = args.resync_concurrency
+    jobs.JOBS.set_limit('resync', args.resync_concurrency)
+    anki_integration.RESYNC.enabled = not args.no_resync
+    if args.fake_ankiweb:
+        anki_integration.ANKIWEB = fakes.fake_ankiweb(args.fake_ankiweb)
+    outbound.MAX_BYTES = args.max_send_queue
+    outbound.ON_OVERFLOW = args.slow_client
+    outbound.COMPRESS = not args.no_deflate
+    media.BASE_URL = args.media_url.rstrip('/')
+    media.SECRET_FILE = args.media_secret_file
+    if args.media_secret:
+        media.SECRET = args.media_secret.encode('utf-8')
+    jobs.JOBS.max_active = args.max_jobs
+    jobs.JOBS.set_limit('sync', args.sync_jobs)
+    ipfs.API_HOST = args.ipfs_host
+    ipfs.API_PORT = args.ipfs_port
+    ipfs.IPFS_MOUNT = args.ipfs_mount
+    ipfs.ROOT.interval = args.root_hash_interval
+    ipfs.ROOT.batch_size = args.root_hash_batch
+    ipfs.HASH_CACHE.ttl = args.mfs_cache_ttl
+    ipfs.HASH_CACHE.max_size = args.mfs_cache_size
+    auth.ACTIVE_AUTH_TOKENS.ttl = args.token_ttl
+    auth.ACTIVE_AUTH_TOKENS.max_size = args.max_tokens
+    executors.configure(**{name: getattr(args, '%s_workers' % name)
+                           for name in executors.DEFAULT_SIZES})
+
     port = args.port
     ssl_cert_path = os.environ.get('REMEMBERBERRY_CERT_PATH', None)
     if args.ssl and (ssl_cert_path is None or not os.path.exists(ssl_cert_path)):
@@ -97,7 +294,11 @@ if __name__ == '__main__':
             raise ValueError()
 
     app.router.add_route('GET', '/', message_websocket_handler)
-    try:
+    app.router.add_route('GET', '/metrics', metrics.handler)
+    media.add_routes(app)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    if args.workers:
+        workers.serve(app, args.workers, host='0.0.0.0', ssl_context=ssl_context, port=port)
+    else:
         web.run_app(app, host='0.0.0.0', ssl_context=ssl_context, port=port)
-    except KeyboardInterrupt:
-        asyncio.get_event_loop().run_until_complete(cleanup())
@@ -1,12 +1,18 @@
 import os
 import json
+import socket
 import pytest
+import asyncio
 import logging
 import rememberberry
-from rememberberry import ipfs
+from rememberberry import ipfs, metrics
 from rememberscript import load_scripts_dir, validate_script
 from rememberscript import RememberMachine
 from rememberberry.auth import data_file
+from anki.storage import Collection
+from rememberberry import anki_integration
+from rememberberry.anki_integration import CardLookahead
+from rememberberry.fakes import FakeAnkiWeb
 from rememberberry.testing import tmp_data_path, assert_replies
 
 
@@ -64,3 +70,161 @@ async def test_decks():
                          check_card)
     await assert_replies(m.reply('decks'),
                          lambda x: x['replies'][0]['label'] == '1: Default [0 0 1]')
+
+
+class _Card:
+    def __init__(self, nid):
+        self.nid = nid
+        self.timer_started = 0
+
+    def startTimer(self):
+        self.timer_started += 1
+
+    def q(self):
+        return 'q%i' % self.nid
+
+    def a(self):
+        return 'a%i' % self.nid
+
+
+class _Scheduler:
+    """Minimal scheduler, answering a card with ease 1 puts it back first"""
+    class col:
+        conf = {'dueCounts': True, 'estTimes': True}
+        class db:
+            def first(sql, nid):
+                return None
+
+    def __init__(self, nids):
+        self.queue = [_Card(nid) for nid in nids]
+        self.answered = []
+        self.resets = 0
+
+    def getCard(self):
+        return self.queue.pop(0) if self.queue else None
+
+    def counts(self, card=None):
+        return (len(self.queue), 0, 0)
+
+    def countIdx(self, card):
+        return 0
+
+    def answerButtons(self, card):
+        return 2
+
+    def nextIvlStr(self, card, ease, short):
+        return '1d'
+
+    def answerCard(self, card, ease):
+        self.answered.append(card.nid)
+        if ease == 1:
+            self.queue.insert(0, card)
+
+    def reset(self):
+        self.resets += 1
+        # A real reset rebuilds the queues from the collection
+        self.queue = sorted(self.queue + [self.prefetched], key=lambda c: c.nid)
+
+
+@pytest.mark.asyncio
+async def test_card_lookahead():
+    scheduler = _Scheduler([1, 2, 3])
+    lookahead = CardLookahead(scheduler)
+    storage = {}
+
+    card = lookahead.get_card()
+    reply = lookahead.format_question(card, storage)
+    assert 'q1' in reply['content']['front']
+    assert storage['_num_answer_buttons'] == 2
+    await asyncio.sleep(0) # let the prefetch run
+    assert lookahead._next[0].nid == 2
+
+    # The prefetched card is used when the answer doesn't change the queues
+    lookahead.answer(card, '2')
+    card = lookahead.get_card()
+    assert card.nid == 2 and card.timer_started == 1
+    lookahead.format_question(card, storage)
+    await asyncio.sleep(0)
+
+    # Answering again changes the queues, so the prefetched card is dropped
+    scheduler.prefetched = lookahead._next[0]
+    lookahead.answer(card, '1')
+    assert lookahead._next is None and scheduler.resets == 1
+    assert lookahead.get_card().nid == 2
+
+
+def test_sync_anki_failures(monkeypatch):
+    def syncs(status):
+        series = metrics.ANKI_SYNC._series.get((status,))
+        return sum(series[0]) if series else 0
+    timeouts, failures = syncs('timeout'), syncs('failed')
+    for exc in [socket.timeout('timed out'), RuntimeError('ankiweb is down')]:
+        def web(hkey):
+            raise exc
+        monkeypatch.setattr(anki_integration, 'ANKIWEB', web)
+        status, err = anki_integration._sync_anki('/nonexistent', 'hkey')
+        assert status is None and type(exc).__name__ in err
+    assert syncs('timeout') == timeouts + 1
+    assert syncs('failed') == failures + 1
+
+
+def test_sync_anki(tmpdir):
+    server_col = Collection(str(tmpdir.mkdir('server').join('collection.anki2')))
+    web = FakeAnkiWeb(server_col, {'a.jpg': b'jpg'})
+    ankiweb, anki_integration.ANKIWEB = anki_integration.ANKIWEB, lambda hkey: web
+    col_path = str(tmpdir.mkdir('user').join('collection.anki2'))
+    Collection(col_path).close()
+    try:
+        # Unrelated collections can't be merged, so it falls back to a download
+        assert anki_integration._sync_anki(col_path, 'hkey', incremental=True) == ('full', None)
+        assert web.downloads == 1
+        assert os.path.exists(os.path.join(tmpdir.strpath, 'user', 'collection.media', 'a.jpg'))
+
+        note = server_col.newNote()
+        note['Front'], note['Back'] = 'q', 'a'
+        server_col.addNote(note)
+        server_col.save()
+        status, err = anki_integration._sync_anki(col_path, 'hkey', incremental=True, media=False)
+        assert (status, err) == ('incremental', None)
+        assert web.downloads == 1
+        col = Collection(col_path)
+        assert col.noteCount() == 1
+        col.close()
+
+        assert anki_integration._sync_anki(col_path, 'hkey', incremental=True) == (
+            'noChanges', None)
+    finally:
+        anki_integration.ANKIWEB = ankiweb
+        server_col.close()
+
+
+class _Storage(dict):
+    compact_cards = True
+
+
+class _FrontSideCard(_Card):
+    def q(self):
+        return '<style>.card {}</style>\U0001f600 q%i' % self.nid
+
+    def a(self):
+        return self.q() + '<hr id=answer>a%i' % self.nid
+
+
+def test_compact_cards():
+    scheduler = _Scheduler([])
+    scheduler.queue = [_FrontSideCard(1), _FrontSideCard(2)]
+    card = scheduler.getCard()
+    full = anki_integration.format_anki_question(scheduler, card, {})['content']
+    storage = _Storage()
+    content = anki_integration.format_anki_question(scheduler, card, storage)['content']
+    assert storage['_num_answer_buttons'] == 2
+
+    # The back is what follows the front, its offset counts utf-16 code units
+    assert content['back'] == '<hr id=answer>a1'
+    front = content['front']
+    assert content['back_prefix'] == len(front) + 1
+    assert content['progress'] == {'new': 1, 'learning': 0, 'review': 0, 'current': 0}
+    assert full['back'].endswith(front + content['back'])
+    assert len(json.dumps(content)) < len(json.dumps(full)) / 2
+
+    assert anki_integration._compact_back('abc', 'abd') == (2, 'd')
@@ -0,0 +1,120 @@
+import sqlite3
+import asyncio
+import pytest
+from rememberberry.collection_pool import CollectionPool, _Entry, _snapshot
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('collection.anki2'))
+    snapshot = str(tmpdir.join('collection.anki2.writeback'))
+    # Like an open anki collection: in wal mode, with a write transaction
+    # that isn't committed
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute('pragma journal_mode = wal')
+    db.execute('pragma wal_autocheckpoint = 0')
+    db.execute('create table cards (id integer)')
+    db.execute('insert into cards values (1)')
+    db.execute('begin')
+    db.execute('insert into cards values (2)')
+
+    _snapshot(path, snapshot)
+    copy = sqlite3.connect(snapshot)
+    assert copy.execute('select id from cards').fetchall() == [(1,)]
+    assert copy.execute('pragma journal_mode').fetchone() == ('delete',)
+    copy.close()
+
+    # The collection is still usable
+    db.execute('commit')
+    assert db.execute('select count(*) from cards').fetchone() == (2,)
+    db.close()
+
+
+class _Col:
+    def __init__(self):
+        self.mod = 0
+        class db:
+            mod = False
+        self.db = db
+
+    def save(self):
+        self.db.mod = False
+
+
+class _Ctx:
+    fs_path = '/nonexistent/collection.anki2'
+    mfs_path = '/users/user/collection.anki2'
+
+    def __init__(self):
+        self.fail = 0
+        self.synced = []
+
+    async def sync(self, snapshot):
+        await asyncio.sleep(0.05)
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('ipfs is down')
+        self.synced.append(snapshot)
+
+
+@pytest.mark.asyncio
+async def test_pool_waits_for_close():
+    pool = CollectionPool(max_size=1)
+    opened = []
+    async def _open(username, mfs_path):
+        # What it would check out of mfs
+        opened.append(closed[:])
+        return _Entry(username, _Ctx(), _Col())
+    closed = []
+    async def _close(entry):
+        await asyncio.sleep(0.05)
+        closed.append(entry.username)
+    pool._open, pool._close = _open, _close
+
+    await pool.release(await pool.acquire('a', '/a'))
+    # Evicting a is still writing it back when it's acquired again
+    evicting = asyncio.ensure_future(pool.acquire('b', '/b'))
+    await asyncio.sleep(0.01)
+    assert 'a' in pool._closing
+    col_a = await pool.acquire('a', '/a')
+    assert opened[-1] == ['a']
+    col_b = await evicting
+    assert not pool._closing
+
+    # Closing everything during an eviction closes each collection once
+    del closed[:]
+    pool.max_size = 2
+    await pool.release(col_a)
+    await pool.release(col_b)
+    closing = asyncio.ensure_future(pool.close_all())
+    await asyncio.sleep(0)
+    pool.max_size = 0
+    await pool._evict()
+    await closing
+    assert sorted(closed) == ['a', 'b'] and len(pool) == 0
+
+
+@pytest.mark.asyncio
+async def test_pool_flush_retry(monkeypatch):
+    async def run_in(name, func, *args):
+        pass
+    monkeypatch.setattr('rememberberry.executors.run_in', run_in)
+    pool = CollectionPool(writeback_delay=0.01)
+    ctx = _Ctx()
+    async def _open(username, mfs_path):
+        return _Entry(username, ctx, _Col())
+    pool._open = _open
+
+    col = await pool.acquire('user', '/users/user/collection.anki2')
+    col.mod += 1
+    ctx.fail = 1
+    await pool.release(col)
+    for _ in range(50):
+        await asyncio.sleep(0.02)
+        if ctx.synced:
+            break
+    # The first write back failed, and was tried again
+    assert pool.flush_failures == 1
+    assert pool.flushes == 1
+    assert len(ctx.synced) == 1
+    assert not pool._entries['user'].is_dirty()
+    assert pool._entries['user'].flush_task is None
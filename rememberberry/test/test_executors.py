@@ -0,0 +1,43 @@
+import time
+import asyncio
+import pytest
+from rememberberry.executors import NamedExecutor
+
+
+@pytest.mark.asyncio
+async def test_named_executor_stats():
+    executor = NamedExecutor('test', 2)
+    jobs = [asyncio.ensure_future(executor.run(time.sleep, 0.1)) for i in range(4)]
+    await asyncio.sleep(0.05)
+
+    stats = executor.stats()
+    assert stats['active'] == 2
+    assert stats['queue_depth'] == 2
+
+    await asyncio.gather(*jobs)
+    stats = executor.stats()
+    assert stats['active'] == 0
+    assert stats['queue_depth'] == 0
+    assert stats['completed'] == 4
+    # The last two had to wait for the first two
+    assert stats['wait_time_max'] >= 0.05
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_named_executor_cancel():
+    executor = NamedExecutor('test', 1)
+    running = asyncio.ensure_future(executor.run(time.sleep, 0.1))
+    queued = asyncio.ensure_future(executor.run(time.sleep, 0.1))
+    await asyncio.sleep(0.05)
+    assert executor.stats()['queue_depth'] == 1
+
+    # A job cancelled before it started leaves the queue
+    queued.cancel()
+    await asyncio.sleep(0)
+    assert executor.stats()['queue_depth'] == 0
+    await running
+    stats = executor.stats()
+    assert stats['queue_depth'] == 0
+    assert stats['completed'] == 1
+    executor.shutdown()
@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from aiohttp.test_utils import TestServer
+import rememberberry
+from rememberberry import ipfs, ipfsapi_asyncio
+from rememberberry.fakes import FakeIPFS
+from rememberberry.testing import tmp_data_path
+
+
+@pytest.mark.asyncio
+@tmp_data_path('/tmp/data', rm=True)
+async def test_root_hash_coalescing():
+    await ipfs.mfs_mkdirs(ipfs.DATA_ROOT)
+    await ipfs.flush_root_hash()
+    updates = ipfs.ROOT.updates
+
+    for i in range(10):
+        await ipfs.mfs_write('%s/file%i' % (ipfs.DATA_ROOT, i), 'data %i' % i)
+    assert ipfs.ROOT.updates == updates
+    assert ipfs.ROOT.pending == 10
+
+    root_hash = await ipfs.flush_root_hash()
+    assert ipfs.ROOT.updates == updates + 1
+    assert root_hash == await ipfs.mfs_hash(ipfs.DATA_ROOT)
+    assert ipfs.DATA_ROOT_HASH == root_hash
+
+    # Nothing changed, so no new stat
+    assert await ipfs.flush_root_hash() == root_hash
+    assert ipfs.ROOT.updates == updates + 1
+
+
+@pytest.mark.asyncio
+async def test_root_hash_failure(monkeypatch):
+    hashes = [None, 'QmNew']
+    async def mfs_hash(mfs_path, cached=True):
+        return hashes.pop(0)
+    notified = []
+    monkeypatch.setattr(ipfs, 'mfs_hash', mfs_hash)
+    monkeypatch.setattr(ipfs.PUBLISHER, 'notify', notified.append)
+    monkeypatch.setattr(ipfs, 'DATA_ROOT_HASH', 'QmOld')
+    root = ipfs.RootHashTracker(interval=0.01)
+
+    # A failed stat keeps the last hash, and is tried again
+    root.mark_dirty()
+    assert await root.flush() == 'QmOld'
+    assert ipfs.DATA_ROOT_HASH == 'QmOld' and notified == []
+    assert root.failures == 1 and root.pending == 1
+    await asyncio.sleep(0.05)
+    assert ipfs.DATA_ROOT_HASH == 'QmNew' and notified == ['QmNew']
+    assert root.pending == 0 and root.updates == 1
+
+
+@pytest.mark.asyncio
+async def test_hash_cache():
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api, ipfs.API = ipfs.API, await ipfsapi_asyncio.connect(server.host, server.port)
+    cache, ipfs.HASH_CACHE = ipfs.HASH_CACHE, ipfs.HashCache()
+    try:
+        await ipfs.mfs_mkdirs('/data/users/a')
+        stats = fake.calls.get('files_stat', 0)
+
+        # Negative entries are cached too
+        for i in range(5):
+            assert await ipfs.mfs_hash('/data/users/a/data.pickle') is None
+        assert fake.calls['files_stat'] == stats + 1
+
+        await ipfs.mfs_write('/data/users/a/data.pickle', 'data')
+        file_hash = await ipfs.mfs_hash('/data/users/a/data.pickle')
+        dir_hash = await ipfs.mfs_hash('/data/users/a')
+        assert file_hash is not None
+        assert fake.calls['files_stat'] == stats + 3
+        assert await ipfs.mfs_hash('/data/users/a/') == dir_hash
+        assert fake.calls['files_stat'] == stats + 3
+
+        # Writing below a folder invalidates the folder's hash
+        await ipfs.mfs_write('/data/users/a/other', 'other')
+        assert await ipfs.mfs_hash('/data/users/a') != dir_hash
+
+        # Removing a folder invalidates everything below it
+        await ipfs.mfs_rm('/data/users', r=True)
+        assert await ipfs.mfs_hash('/data/users/a/data.pickle') is None
+        assert ipfs.HASH_CACHE.stats()['hits'] == 5
+    finally:
+        await ipfs.API.close()
+        await server.close()
+        ipfs.API, ipfs.HASH_CACHE = api, cache
@@ -0,0 +1,90 @@
+import io
+import os
+import asyncio
+import pytest
+from aiohttp.test_utils import TestServer
+from rememberberry import ipfsapi_asyncio
+from rememberberry.fakes import FakeIPFS
+
+
+async def _connect(fake, **kwargs):
+    server = TestServer(fake.app)
+    await server.start_server()
+    api = await ipfsapi_asyncio.connect(server.host, server.port, **kwargs)
+    return server, api
+
+
+@pytest.mark.asyncio
+async def test_files_api():
+    fake = FakeIPFS()
+    server, api = await _connect(fake, limit=2)
+    try:
+        await api.files_mkdir('/data/users', parents=True)
+        await api.files_write('/data/users/a', io.BytesIO(b'hello world'), create=True)
+        assert await api.files_read('/data/users/a') == b'hello world'
+        assert await api.files_read('/data/users/a', offset=6, count=3) == b'wor'
+
+        # Many concurrent calls share the two pooled connections
+        stats = await asyncio.gather(*[api.files_stat('/data/users/a') for i in range(20)])
+        assert len(set(s['Hash'] for s in stats)) == 1
+        assert stats[0]['Type'] == 'file'
+
+        await api.files_cp('/ipfs/%s' % stats[0]['Hash'], '/data/users/b')
+        assert await api.files_read('/data/users/b') == b'hello world'
+
+        chunks = [c async for c in api.files_read_iter('/data/users/b')]
+        assert b''.join(chunks) == b'hello world'
+
+        await api.files_rm('/data/users', recursive=True)
+        with pytest.raises(ipfsapi_asyncio.Error):
+            await api.files_stat('/data/users/a')
+    finally:
+        await api.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_add_and_cat(tmpdir):
+    fake = FakeIPFS()
+    server, api = await _connect(fake)
+    try:
+        folder = tmpdir.mkdir('folder')
+        folder.join('a.txt').write_binary(b'a' * 100000)
+        folder.mkdir('sub').join('b.txt').write_binary(b'b')
+        folder.join('.hidden').write_binary(b'skipped, like ipfs add does')
+
+        single = await api.add(str(folder.join('a.txt')))
+        assert single['Name'] == 'a.txt'
+        assert await api.cat(single['Hash']) == b'a' * 100000
+        assert await api.cat(single['Hash'], offset=10, length=5) == b'aaaaa'
+
+        ret = await api.add(str(folder), recursive=True)
+        assert ret[-1]['Name'] == 'folder'
+        await api.files_cp('/ipfs/%s' % ret[-1]['Hash'], '/folder')
+        assert await api.files_read('/folder/sub/b.txt') == b'b'
+        entries = (await api.files_ls('/folder'))['Entries']
+        assert [e['Name'] for e in entries] == ['a.txt', 'sub']
+
+        quiet = await api.add(str(folder), recursive=True, quieter=True)
+        assert quiet['Hash'] == ret[-1]['Hash']
+        with pytest.raises(ipfsapi_asyncio.Error):
+            await api.add(str(folder))
+    finally:
+        await api.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_fake_mount(tmpdir):
+    fake = FakeIPFS(mount_path=str(tmpdir))
+    server, api = await _connect(fake)
+    try:
+        await api.files_mkdir('/data/sub', parents=True)
+        await api.files_write('/data/sub/a', io.BytesIO(b'hello'), create=True)
+        file_hash = (await api.files_stat('/data/sub/a'))['Hash']
+        dir_hash = (await api.files_stat('/data'))['Hash']
+        assert tmpdir.join(file_hash).read_binary() == b'hello'
+        assert tmpdir.join(dir_hash, 'sub', 'a').read_binary() == b'hello'
+    finally:
+        await api.close()
+        await server.close()
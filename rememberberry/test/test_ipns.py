@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+from aiohttp.test_utils import TestServer
+from rememberberry import ipns, ipfsapi_asyncio, metrics
+from rememberberry.fakes import FakeIPFS
+
+
+@pytest.mark.asyncio
+async def test_publisher():
+    fake = FakeIPFS()
+    fake.publish_delay = 0.05
+    server = TestServer(fake.app)
+    await server.start_server()
+    api = await ipfsapi_asyncio.connect(server.host, server.port)
+
+    async def publish(root_hash):
+        await api.name_publish('/ipfs/%s' % root_hash)
+
+    await api.files_mkdir('/data')
+    hashes = []
+    for i in range(6):
+        await api.files_write('/data/%i' % i, b'data', create=True)
+        hashes.append((await api.files_stat('/data'))['Hash'])
+
+    publisher = ipns.Publisher(publish, window=0.3, min_backoff=0.05, max_backoff=0.1)
+    publisher.enabled = True
+    lags = sum(s[1] for s in metrics.IPNS_PUBLISH_LAG._series.values())
+    try:
+        publisher.notify(hashes[0])
+        publisher.start()
+        await asyncio.sleep(0.01)
+
+        # A burst of changes while publishing, only the last is published
+        for h in hashes[1:4]:
+            publisher.notify(h)
+        await asyncio.sleep(0.1)
+        assert fake.published == [('self', '/ipfs/%s' % hashes[0])]
+        await asyncio.sleep(0.35)
+        assert [p for k, p in fake.published] == ['/ipfs/%s' % h for h in [hashes[0], hashes[3]]]
+        assert publisher.skipped == 2
+
+        # Failures are retried with the latest hash
+        fake.publish_failures = 2
+        publisher.notify(hashes[4])
+        await asyncio.sleep(0.35)
+        publisher.notify(hashes[5])
+        await asyncio.sleep(0.4)
+        assert publisher.failures == 2
+        assert fake.published[-1][1] == '/ipfs/%s' % hashes[5]
+        assert len(fake.published) == 3
+        assert publisher.stats()['pending'] == 0
+        assert sum(s[1] for s in metrics.IPNS_PUBLISH_LAG._series.values()) > lags
+    finally:
+        publisher.stop()
+        await api.close()
+        await server.close()
+
+
+@pytest.mark.asyncio
+async def test_publisher_close():
+    published = []
+    async def publish(root_hash):
+        if root_hash == 'slow':
+            await asyncio.sleep(1)
+        published.append(root_hash)
+
+    publisher = ipns.Publisher(publish, window=60)
+    publisher.enabled = True
+    publisher.notify('a')
+    publisher.start()
+    await asyncio.sleep(0.01)
+    assert published == ['a']
+
+    # The last change isn't left waiting for the window at shutdown
+    publisher.notify('b')
+    await publisher.close()
+    assert published == ['a', 'b']
+    assert publisher.stats()['pending'] == 0
+    await publisher.close()
+    assert published == ['a', 'b']
+
+    # ...but the shutdown doesn't wait for a slow publish
+    publisher.notify('slow')
+    await publisher.close(timeout=0.05)
+    assert published == ['a', 'b']
+    assert publisher.failures == 1
@@ -0,0 +1,55 @@
+import asyncio
+import pytest
+from rememberberry import jobs, metrics
+
+
+@pytest.mark.asyncio
+async def test_job_queue():
+    classes = {'study': (0, 4), 'sync': (1, 2), 'resync': (2, 1)}
+    queue = jobs.JobQueue(classes, max_active=4, reserved=1)
+    waits = sum(s[1] for s in metrics.JOB_WAIT._series.values())
+
+    # Bulk jobs are held to their class limit, and can't take the reserved slot
+    syncs = [queue.job('sync', u) for u in ['a', 'a', 'b']]
+    resync = queue.job('resync', 'c')
+    assert [j.admitted.done() for j in syncs] == [True, True, False]
+    assert resync.admitted.done()
+    assert syncs[2].position() == 1
+
+    # ...so study jobs still get in
+    study = queue.job('study', 'd')
+    assert study.admitted.done()
+    assert queue.stats()['active'] == 4
+
+    # Users with fewer running jobs go first
+    more = queue.job('sync', 'a')
+    assert more.position() == 2 and syncs[2].position() == 1
+    late_study = queue.job('study', 'e')
+    assert late_study.position() == 1
+
+    # Study jobs go before waiting bulk jobs
+    study.done()
+    assert late_study.admitted.done() and not syncs[2].admitted.done()
+    late_study.done()
+    syncs[0].done()
+    assert syncs[2].admitted.done() and not more.admitted.done()
+
+    # Waiting jobs can leave the queue
+    more.done()
+    assert more.admitted.cancelled()
+    assert queue.stats()['sync_cancelled'] == 1
+
+    # Positions are reported while waiting
+    another = queue.job('resync', 'f')
+    positions = []
+    async def wait():
+        async for position in another.positions(interval=0.01):
+            positions.append(position)
+    waiter = asyncio.ensure_future(wait())
+    await asyncio.sleep(0.05)
+    resync.done()
+    await asyncio.wait_for(waiter, 1)
+    assert positions == [1]
+    async with queue.job('study', 'g') as job:
+        assert job.position() == 0
+    assert sum(s[1] for s in metrics.JOB_WAIT._series.values()) > waits
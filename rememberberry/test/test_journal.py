@@ -0,0 +1,126 @@
+import pickle
+import pytest
+from aiohttp.test_utils import TestServer
+from rememberberry import ipfs, ipfsapi_asyncio
+from rememberberry.fakes import FakeIPFS
+from rememberberry.journal import JournaledStorage
+
+
+async def _load(path):
+    storage = JournaledStorage(path)
+    await storage.load()
+    return dict(storage.items())
+
+
+class _Unpicklable:
+    def __reduce__(self):
+        raise TypeError('can\'t pickle')
+
+
+@pytest.mark.asyncio
+async def test_journaled_storage():
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api, ipfs.API = ipfs.API, await ipfsapi_asyncio.connect(server.host, server.port)
+    try:
+        await ipfs.mfs_mkdirs('/data/users/a')
+        path = '/data/users/a/data.pickle'
+        storage = JournaledStorage(path, compact_records=5)
+
+        # The first write is a snapshot, then only the changed keys are written
+        storage['big'] = 'x' * 10000
+        storage['count'] = 0
+        storage['col'] = _Unpicklable()
+        await storage.sync()
+        assert storage.snapshots == 1
+        for i in range(1, 4):
+            storage['count'] = i
+            await storage.sync()
+        del storage['big']
+        await storage.sync()
+        assert storage.snapshots == 1
+        assert storage.bytes_written < 10000 + 1000
+        assert await _load(path) == {'count': 3}
+
+        # Unchanged state isn't written at all
+        writes = fake.calls['files_write']
+        await storage.sync()
+        assert fake.calls['files_write'] == writes
+
+        # Values changed in place are written once they're looked up
+        storage['list'] = []
+        await storage.sync()
+        storage['list'].append(1)
+        storage.get('list').append(2)
+        await storage.sync()
+        assert await _load(path) == {'count': 3, 'list': [1, 2]}
+
+        # Past compact_records the journal is compacted in the background
+        storage['count'] = 6
+        await storage.sync()
+        await storage.wait_compaction()
+        assert storage.snapshots == 2
+        assert pickle.loads(await ipfs.mfs_read(path, 'b')) == {'count': 6, 'list': [1, 2]}
+        assert await _load(path) == {'count': 6, 'list': [1, 2]}
+
+        # A new storage continues the journal after loading
+        other = JournaledStorage(path)
+        await other.load()
+        other['count'] = 7
+        await other.sync()
+        assert other.snapshots == 0
+        assert await _load(path) == {'count': 7, 'list': [1, 2]}
+
+        # Turns that only read the values append nothing, even for values
+        # that can't be pickled
+        other['module'] = pickle
+        other['dict'] = {'a': [1]}
+        await other.sync()
+        records = other._journal.records
+        writes = fake.calls['files_write']
+        for i in range(3):
+            assert other['list'] == [1, 2]
+            assert other.get('dict')['a'] == [1]
+            assert other['module'] is pickle
+            await other.sync()
+        assert other._journal.records == records
+        assert fake.calls['files_write'] == writes
+        other['dict']['a'].append(2)
+        await other.sync()
+        assert other._journal.records == records + 1
+        assert (await _load(path))['dict'] == {'a': [1, 2]}
+    finally:
+        await ipfs.API.close()
+        await server.close()
+        ipfs.API = api
+
+
+@pytest.mark.asyncio
+async def test_journal_torn_record():
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api, ipfs.API = ipfs.API, await ipfsapi_asyncio.connect(server.host, server.port)
+    try:
+        await ipfs.mfs_mkdirs('/data')
+        storage = JournaledStorage('/data/data.pickle')
+        storage['a'] = 1
+        await storage.sync()
+        storage['a'] = 2
+        await storage.sync()
+        journal = await ipfs.mfs_read('/data/data.pickle.journal', 'b')
+        await ipfs.mfs_write('/data/data.pickle.journal', journal + journal[:5], 'b')
+        assert await _load('/data/data.pickle') == {'a': 2}
+
+        # Records written after loading a torn journal are replayed
+        storage = JournaledStorage('/data/data.pickle')
+        await storage.load()
+        storage['a'] = 3
+        await storage.sync()
+        assert await ipfs.mfs_read('/data/data.pickle.journal', 'b') != journal + journal[:5]
+        assert await _load('/data/data.pickle') == {'a': 3}
+    finally:
+        await ipfs.API.close()
+        await server.close()
+        ipfs.API = api
@@ -0,0 +1,193 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from rememberberry import ipfs, local_store
+from rememberberry.local_store import LocalStore
+
+
+def _objects(store):
+    return sum(len(files) for root, dirs, files in os.walk(os.path.join(store.path, 'objects')))
+
+
+@pytest.mark.asyncio
+async def test_local_store(tmpdir):
+    store = LocalStore(str(tmpdir.join('store')))
+    api, ipfs.API = ipfs.API, store
+    cache, ipfs.HASH_CACHE = ipfs.HASH_CACHE, ipfs.HashCache()
+    try:
+        await ipfs.mfs_mkdirs('/data/users/a')
+        await ipfs.mfs_write('/data/users/a/data.pickle', 'data')
+        await ipfs.mfs_append('/data/users/a/data.pickle', b' more', 4)
+        assert await ipfs.mfs_read('/data/users/a/data.pickle') == 'data more'
+        # Appends write in place, without storing a new object each time
+        objects = _objects(store)
+        await ipfs.mfs_append('/data/users/a/data.pickle', b'!', 9)
+        assert _objects(store) == objects
+        await ipfs.mfs_write('/data/users/a/data.pickle', b'data more', 'b')
+        with pytest.raises(FileNotFoundError):
+            await ipfs.mfs_read('/data/users/a/missing')
+        assert await ipfs.mfs_hash('/data/users/a/missing') is None
+
+        # Same contents, same object
+        await ipfs.mfs_write('/data/users/a/copy', 'data more')
+        file_hash = await ipfs.mfs_hash('/data/users/a/data.pickle')
+        assert file_hash == await ipfs.mfs_hash('/data/users/a/copy')
+        assert os.stat(store._object_path(file_hash)).st_nlink == 3
+
+        # The hash of a file written in place can be resolved
+        await ipfs.mfs_append('/data/users/a/copy', b'!', 9)
+        appended_hash = await ipfs.mfs_hash('/data/users/a/copy')
+        assert not os.path.exists(store._object_path(appended_hash))
+        await ipfs.cp_ipfs_to_mfs('/ipfs/%s' % appended_hash, '/data/users/a/copy2')
+        assert await ipfs.mfs_read('/data/users/a/copy2') == 'data more!'
+        await ipfs.mfs_rm('/data/users/a/copy2')
+        await ipfs.mfs_write('/data/users/a/copy', 'data more')
+
+        # Folders are checked out from their hash
+        dir_hash = await ipfs.mfs_hash('/data/users/a')
+        await ipfs.cp_ipfs_to_mfs('/ipfs/%s' % dir_hash, '/data/users/b')
+        assert await ipfs.mfs_read('/data/users/b/copy') == 'data more'
+        ctx = ipfs.MutableFolderContext('/data/users/b')
+        async with ctx:
+            assert sorted(os.listdir(ctx.fs_path)) == ['copy', 'data.pickle']
+            os.remove(os.path.join(ctx.fs_path, 'copy'))
+            with open(os.path.join(ctx.fs_path, 'data.pickle'), 'a') as f:
+                f.write(' changed')
+        assert await ipfs.mfs_read('/data/users/b/data.pickle') == 'data more changed'
+        assert await ipfs.mfs_hash('/data/users/b/copy') is None
+        # The checkout didn't modify the stored object
+        assert await ipfs.mfs_read('/data/users/a/data.pickle') == 'data more'
+
+        ctx = ipfs.MutableFileContext(mfs_path='/data/users/a/copy')
+        async with ctx:
+            with open(ctx.fs_path, 'a') as f:
+                f.write('!')
+        assert await ipfs.mfs_read('/data/users/a/copy') == 'data more!'
+        assert await ipfs.mfs_read('/data/users/a/data.pickle') == 'data more'
+
+        # Only unlinked objects are collected
+        await ipfs.mfs_rm('/data/users/b', r=True)
+        assert store.collect_garbage(grace=0) > 0
+        assert await ipfs.mfs_read('/data/users/a/data.pickle') == 'data more'
+        assert await ipfs.mfs_read('/data/users/a/copy') == 'data more!'
+        assert os.listdir(os.path.join(store.path, 'tmp')) == []
+    finally:
+        ipfs.API, ipfs.HASH_CACHE = api, cache
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_local_store_dir_hashes(tmpdir, monkeypatch):
+    store = LocalStore(str(tmpdir.join('store')))
+    monkeypatch.setattr(local_store, 'MTIME_SLACK', -1.0)
+    try:
+        for user in ['a', 'b']:
+            store._mkdir('/data/users/%s' % user, parents=True)
+            store._write('/data/users/%s/data.pickle' % user, b'data', create=True)
+        root_hash = store._stat('/data')['Hash']
+
+        # Unchanged folders aren't scanned again
+        scanned = []
+        scandir = os.scandir
+        def _scandir(path):
+            scanned.append(os.path.relpath(path, os.path.join(store.path, 'mfs')))
+            return scandir(path)
+        monkeypatch.setattr(os, 'scandir', _scandir)
+        assert store._stat('/data')['Hash'] == root_hash
+        assert scanned == []
+
+        # Only the folders on the changed path are
+        store._write('/data/users/a/data.pickle', b'!', 4)
+        new_hash = store._stat('/data')['Hash']
+        assert new_hash != root_hash
+        assert sorted(scanned) == ['data', 'data/users', 'data/users/a']
+
+        # Changes made by another process are seen too
+        other = LocalStore(store.path)
+        other._rm('/data/users/b/data.pickle')
+        assert store._stat('/data')['Hash'] != new_hash
+    finally:
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_folder_context_many_changes(tmpdir, monkeypatch):
+    store = LocalStore(str(tmpdir.join('store')))
+    api, ipfs.API = ipfs.API, store
+    cache, ipfs.HASH_CACHE = ipfs.HASH_CACHE, ipfs.HashCache()
+    try:
+        await ipfs.mfs_mkdirs('/data/users/a/media')
+        for name in ['a.jpg', 'b.jpg', 'media/c.jpg']:
+            await ipfs.mfs_write('/data/users/a/%s' % name, name)
+
+        # Past MAX_FOLDER_CHANGES the whole folder is added at once
+        monkeypatch.setattr(ipfs, 'MAX_FOLDER_CHANGES', 1)
+        calls = []
+        cp_fs_to_mfs = ipfs.cp_fs_to_mfs
+        async def _cp_fs_to_mfs(fs_path, mfs_path, **kwargs):
+            calls.append(mfs_path)
+            await cp_fs_to_mfs(fs_path, mfs_path, **kwargs)
+        monkeypatch.setattr(ipfs, 'cp_fs_to_mfs', _cp_fs_to_mfs)
+        ctx = ipfs.MutableFolderContext('/data/users/a')
+        async with ctx:
+            os.remove(os.path.join(ctx.fs_path, 'a.jpg'))
+            for name in ['b.jpg', 'media/c.jpg', 'media/d.jpg']:
+                with open(os.path.join(ctx.fs_path, name), 'w') as f:
+                    f.write('new ' + name)
+        assert calls == ['/data/users/a']
+        assert ctx.stats['files_added'] == 3 and ctx.stats['files_removed'] == 1
+        assert await ipfs.mfs_hash('/data/users/a/a.jpg') is None
+        for name in ['b.jpg', 'media/c.jpg', 'media/d.jpg']:
+            assert await ipfs.mfs_read('/data/users/a/%s' % name) == 'new ' + name
+
+        # A few changes are still copied one by one
+        monkeypatch.setattr(ipfs, 'MAX_FOLDER_CHANGES', 100)
+        del calls[:]
+        ctx = ipfs.MutableFolderContext('/data/users/a')
+        async with ctx:
+            with open(os.path.join(ctx.fs_path, 'b.jpg'), 'w') as f:
+                f.write('b again')
+        assert calls == ['/data/users/a/b.jpg']
+        assert await ipfs.mfs_read('/data/users/a/b.jpg') == 'b again'
+    finally:
+        ipfs.API, ipfs.HASH_CACHE = api, cache
+        await store.close()
+
+
+def test_local_store_threads(tmpdir, monkeypatch):
+    store = LocalStore(str(tmpdir.join('store')))
+    # Cache every folder hash
+    monkeypatch.setattr(local_store, 'MTIME_SLACK', -1.0)
+    store._mkdir('/data/users', parents=True)
+    stop = threading.Event()
+
+    def collect():
+        while not stop.is_set():
+            store.collect_garbage(grace=0.2)
+            time.sleep(0.01)
+
+    def user(i):
+        path = '/data/users/%i' % i
+        for j in range(20):
+            for k in range(5):
+                store._mkdir(path + '/media/%i' % k, parents=True)
+                store._stat(path + '/media/%i' % k)
+            store._write(path + '/data', b'%i %i' % (i, j), create=True, truncate=True)
+            store._write(path + '/data', b'!', offset=1)
+            store._stat('/data')
+            store._cp(path + '/data', path + '/media/copy')
+            assert store._read(path + '/media/copy') == b'%i!%i' % (i, j)
+            store._rm(path + '/media', recursive=True)
+        return store._stat(path + '/data')['Hash']
+
+    with ThreadPoolExecutor(8) as pool:
+        gc = pool.submit(collect)
+        try:
+            hashes = list(pool.map(user, range(6)))
+        finally:
+            stop.set()
+        gc.result()
+    for i, ipfs_hash in enumerate(hashes):
+        assert store._read('/ipfs/%s' % ipfs_hash) == b'%i!19' % i
@@ -0,0 +1,100 @@
+import os
+import pytest
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from rememberberry import ipfs, ipfsapi_asyncio, media
+from rememberberry.fakes import FakeIPFS
+from rememberberry.local_store import LocalStore
+
+
+class _Col:
+    pass
+
+
+async def _check_media(api, secret_file):
+    api_, ipfs.API = ipfs.API, api
+    cache, ipfs.HASH_CACHE = ipfs.HASH_CACHE, ipfs.HashCache()
+    secret, media.SECRET = media.SECRET, None
+    secret_file_, media.SECRET_FILE = media.SECRET_FILE, secret_file
+    app = web.Application()
+    media.add_routes(app)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        # Bigger than the chunks that are read at once
+        data = bytes(range(256)) * 2000
+        await ipfs.mfs_mkdirs('/data/users/a/collection.media')
+        await ipfs.mfs_write('/data/users/a/collection.media/cat 1.jpg', data, 'b')
+        col = _Col()
+        await media.load_hashes(col, '/data/users/a/collection.media')
+        ipfs_hash = await ipfs.mfs_hash('/data/users/a/collection.media/cat 1.jpg')
+        assert col.__media_hashes__ == {'cat 1.jpg': ipfs_hash}
+
+        html = media.rewrite(
+            col, '<img src="cat 1.jpg"><IMG class=x src=cat%201.jpg><img src="dog.jpg">')
+        url = media.url(ipfs_hash, 'cat 1.jpg')
+        assert html == '<img src="%s"><IMG class=x src="%s"><img src="dog.jpg">' % (url, url)
+
+        # The secret is kept, so the urls are the same after a restart
+        media.SECRET = None
+        await media.init()
+        assert media.url(ipfs_hash, 'cat 1.jpg') == url
+        # ...but not in the storage, whose root is published
+        assert os.path.exists(secret_file)
+        assert await ipfs.mfs_ls(ipfs.DATA_ROOT) == {}
+
+        base = 'http://%s:%i' % (server.host, server.port)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(base + url) as resp:
+                assert resp.status == 200
+                assert await resp.read() == data
+                assert resp.headers['ETag'] == '"%s"' % ipfs_hash
+                assert 'immutable' in resp.headers['Cache-Control']
+                assert resp.headers['Content-Type'] == 'image/jpeg'
+
+            async with session.get(base + url, headers={'Range': 'bytes=10-19'}) as resp:
+                assert resp.status == 206
+                assert await resp.read() == data[10:20]
+                assert resp.headers['Content-Range'] == 'bytes 10-19/%i' % len(data)
+            async with session.get(base + url, headers={'Range': 'bytes=-5'}) as resp:
+                assert await resp.read() == data[-5:]
+            async with session.get(base + url, headers={'Range': 'bytes=600000-'}) as resp:
+                assert resp.status == 416
+
+            async with session.get(base + url, headers={
+                    'If-None-Match': '"%s"' % ipfs_hash}) as resp:
+                assert resp.status == 304
+
+            # Only hashes signed by the server are served
+            async with session.get(base + url.replace(media._sign(ipfs_hash), '0' * 32)) as resp:
+                assert resp.status == 404
+            assert media.STATS['rejected'] >= 1
+    finally:
+        await server.close()
+        ipfs.API, ipfs.HASH_CACHE, media.SECRET = api_, cache, secret
+        media.SECRET_FILE = secret_file_
+
+
+@pytest.mark.asyncio
+async def test_media_local(tmpdir):
+    store = LocalStore(str(tmpdir.join('store')))
+    try:
+        await _check_media(store, str(tmpdir.join('media_secret')))
+    finally:
+        await store.close()
+
+
+@pytest.mark.asyncio
+async def test_media_ipfs(tmpdir):
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api = await ipfsapi_asyncio.connect(server.host, server.port)
+    try:
+        await _check_media(api, str(tmpdir.join('media_secret')))
+        # One request per response, not one per chunk
+        assert fake.calls['cat'] == 3
+    finally:
+        await api.close()
+        await server.close()
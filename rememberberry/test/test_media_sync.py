@@ -0,0 +1,34 @@
+import os
+import pytest
+from anki.storage import Collection
+from rememberberry.fakes import FakeMediaServer
+from rememberberry.media_sync import ParallelMediaSyncer
+
+
+def test_parallel_media_sync_resumes(tmpdir):
+    col = Collection(str(tmpdir.join('collection.anki2')))
+    files = {'%i.jpg' % i: os.urandom(1000) for i in range(60)}
+
+    # The connection drops after the first batch
+    server = FakeMediaServer(files, fail_after=1)
+    syncer = ParallelMediaSyncer(col, server, concurrency=1, batch_size=10, retries=0)
+    with pytest.raises(ConnectionError):
+        syncer.sync()
+    assert syncer.files_done == 10
+
+    # Resuming only downloads what's missing
+    server.fail_after = None
+    server.requested = []
+    progress = []
+    syncer = ParallelMediaSyncer(col, server, concurrency=4, batch_size=10,
+                                 progress=lambda *args: progress.append(args))
+    assert syncer.sync() == 'success'
+    assert len(server.requested) == 50
+    assert progress[-1][:2] == (50, 50)
+
+    for name, data in files.items():
+        with open(os.path.join(col.media.dir(), name), 'rb') as f:
+            assert f.read() == data
+
+    assert ParallelMediaSyncer(col, server).sync() == 'noChanges'
+    col.close()
@@ -0,0 +1,53 @@
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+from rememberberry import metrics
+from rememberberry.metrics import Histogram, Gauge
+
+
+def test_histogram():
+    h = Histogram('test_seconds', 'A test', ('method',), buckets=(0.1, 1.0))
+    h.observe(0.05, 'a')
+    h.observe(0.5, 'a')
+    h.observe(5.0, 'a')
+    with h.time('b'):
+        pass
+    lines = h.render()
+    assert lines[:2] == ['# HELP test_seconds A test', '# TYPE test_seconds histogram']
+    assert 'test_seconds_bucket{method="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{method="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{method="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{method="a"} 5.55' in lines
+    assert 'test_seconds_count{method="a"} 3' in lines
+    assert 'test_seconds_count{method="b"} 1' in lines
+
+
+def test_gauge_and_merge():
+    g = Gauge('test_open', 'Open things', lambda: 3)
+    assert g.render()[-1] == 'test_open 3.0'
+    g = Gauge('test_pool', 'Per pool', lambda: {'a': 1, 'b': 2}, label='pool')
+    assert g.render()[-2:] == ['test_pool{pool="a"} 1.0', 'test_pool{pool="b"} 2.0']
+
+    text = '\n'.join(g.render()) + '\n'
+    merged = metrics.merge([(0, text), (1, text)], 'worker').splitlines()
+    assert merged == [
+        '# HELP test_pool Per pool', '# TYPE test_pool gauge',
+        'test_pool{pool="a",worker="0"} 1.0', 'test_pool{pool="b",worker="0"} 2.0',
+        'test_pool{pool="a",worker="1"} 1.0', 'test_pool{pool="b",worker="1"} 2.0']
+
+
+@pytest.mark.asyncio
+async def test_metrics_route():
+    app = web.Application()
+    app.router.add_route('GET', '/metrics', metrics.handler)
+    metrics.REPLY.observe(0.2)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    try:
+        resp = await client.get('/metrics')
+        assert resp.status == 200
+        text = await resp.text()
+        assert '# TYPE rememberberry_reply_seconds histogram' in text
+        assert 'rememberberry_reply_seconds_count' in text
+    finally:
+        await client.close()
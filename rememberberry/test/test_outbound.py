@@ -0,0 +1,131 @@
+import json
+import asyncio
+import pytest
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from rememberberry import outbound
+
+
+async def _handler(request):
+    ws = outbound.response()
+    await ws.prepare(request)
+    out = outbound.Writer(ws, batch=outbound.batched(ws.ws_protocol), flush_delay=0.05)
+    async for msg in ws:
+        for i in range(3):
+            out.send('%s %i' % (msg.data, i))
+        if msg.data == 'slow':
+            await asyncio.sleep(0.2)
+            out.send('slow 3')
+        out.end_turn()
+    await out.close()
+    return ws
+
+
+async def _receive(ws, n):
+    return [(await ws.receive()).data for i in range(n)]
+
+
+@pytest.mark.asyncio
+async def test_batching():
+    app = web.Application()
+    app.router.add_route('GET', '/', _handler)
+    server = TestServer(app)
+    await server.start_server()
+    url = 'http://%s:%i/' % (server.host, server.port)
+    try:
+        async with aiohttp.ClientSession() as session:
+            # Old clients get a frame per reply
+            async with session.ws_connect(url) as ws:
+                assert ws.protocol is None
+                await ws.send_str('a')
+                assert await _receive(ws, 3) == ['a 0', 'a 1', 'a 2']
+
+            async with session.ws_connect(url, protocols=[outbound.BATCH_PROTOCOL]) as ws:
+                assert ws.protocol == outbound.BATCH_PROTOCOL
+                await ws.send_str('a')
+                assert json.loads((await ws.receive()).data) == ['a 0', 'a 1', 'a 2']
+                # Replies don't wait for a turn that went quiet
+                await ws.send_str('slow')
+                frames = [json.loads(f) for f in await _receive(ws, 2)]
+                assert frames == [['slow 0', 'slow 1', 'slow 2'], ['slow 3']]
+    finally:
+        await server.close()
+
+
+class _StalledSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+        self.gate = asyncio.Event()
+
+    async def send_str(self, data):
+        await self.gate.wait()
+        self.sent.append(data)
+
+    async def close(self, code, message):
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+async def test_slow_clients():
+    ws = _StalledSocket()
+    out = outbound.Writer(ws, max_frames=4, on_overflow='drop')
+    dropped = outbound.STATS['dropped_frames']
+    for i in range(8):
+        out.send(str(i))
+        await asyncio.sleep(0)
+    out.end_turn()
+    # One frame is being sent, the oldest of the others were dropped
+    assert outbound.STATS['dropped_frames'] - dropped == 3
+    ws.gate.set()
+    await out.close()
+    assert ws.sent == ['0', '4', '5', '6', '7']
+
+    ws = _StalledSocket()
+    out = outbound.Writer(ws, max_bytes=10)
+    disconnects = outbound.STATS['disconnects']
+    for i in range(5):
+        out.send('%i' % (i * 1000))
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert outbound.STATS['disconnects'] == disconnects + 1
+    assert ws.closed_with == aiohttp.WSCloseCode.TRY_AGAIN_LATER
+    assert out.closed
+    out.send('ignored')
+    await out.close()
+    assert ws.sent == []
+
+
+@pytest.mark.asyncio
+async def test_after_turn():
+    ws = _StalledSocket()
+    out = outbound.Writer(ws)
+    called = []
+    out.send('card')
+    out.after_turn(lambda: called.append(list(ws.sent)))
+    out.after_turn(lambda: called.append('cancelled')).cancel()
+    out.end_turn()
+    # Not before the card was sent
+    await asyncio.sleep(0.05)
+    assert called == []
+    ws.gate.set()
+    await asyncio.sleep(0.05)
+    assert called == [['card']]
+    await out.close()
+
+
+class _BrokenSocket(_StalledSocket):
+    async def send_str(self, data):
+        raise RuntimeError('not a ConnectionError')
+
+
+@pytest.mark.asyncio
+async def test_send_failure():
+    out = outbound.Writer(_BrokenSocket())
+    out.send('a')
+    out.send('b')
+    await asyncio.sleep(0.01)
+    assert out.closed and out.queued_bytes == 0
+    # Doesn't wait for the frames that won't be sent
+    await asyncio.wait_for(out.close(), 1)
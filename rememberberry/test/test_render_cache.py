@@ -0,0 +1,94 @@
+from rememberberry import render_cache
+from rememberberry.render_cache import RenderCache
+
+
+class _DB:
+    def __init__(self, notes):
+        self.notes = notes
+
+    def first(self, sql, nid):
+        return self.notes.get(nid)
+
+
+class _Models:
+    def __init__(self, models):
+        self.models = models
+
+    def get(self, mid):
+        return self.models.get(mid)
+
+
+class _Col:
+    def __init__(self):
+        self.db = _DB({1: (10, 100), 2: (10, 100)})
+        self.models = _Models({10: {'mod': 1000}})
+
+
+class _Card:
+    def __init__(self, id, nid, ord=0):
+        self.id = id
+        self.nid = nid
+        self.ord = ord
+        self.did = 1
+        self.odid = 0
+        self.renders = 0
+
+    def q(self):
+        self.renders += 1
+        return 'front %i' % self.id
+
+    def a(self):
+        return 'back %i' % self.id
+
+
+def test_render_cache():
+    col = _Col()
+    cache = render_cache.for_collection(col)
+    assert render_cache.for_collection(col) is cache
+
+    card = _Card(1, 1)
+    assert cache.render(card) == ('front 1', 'back 1')
+    assert cache.render(card) == ('front 1', 'back 1')
+    assert card.renders == 1
+
+    # Editing the note or its model makes the card render again
+    col.db.notes[1] = (10, 101)
+    cache.render(card)
+    assert card.renders == 2
+    col.models.models[10]['mod'] = 1001
+    cache.render(card)
+    assert card.renders == 3
+
+    # Cards of deleted notes aren't cached
+    gone = _Card(3, 3)
+    cache.render(gone)
+    cache.render(gone)
+    assert gone.renders == 2
+
+
+def test_render_cache_limits():
+    col = _Col()
+    cache = RenderCache(col, max_entries=2, max_bytes=1000)
+    cards = [_Card(i, 1, ord=i) for i in range(3)]
+    for card in cards:
+        cache.render(card)
+    assert len(cache) == 2
+    cache.render(cards[0])
+    assert cards[0].renders == 2
+
+    cache = RenderCache(col, max_entries=100, max_bytes=len('front 1back 1') * 2)
+    for card in cards:
+        cache.render(card)
+    assert len(cache) == 2
+    assert cache.size_bytes <= cache.max_bytes
+
+    # The size is in bytes, not characters
+    class _CjkCard(_Card):
+        def q(self):
+            self.renders += 1
+            return '漢' * 100
+    cache = RenderCache(col, max_entries=100, max_bytes=1000)
+    for card in [_CjkCard(i, 1, ord=i) for i in range(5)]:
+        cache.render(card)
+    assert cache.size_bytes == 3 * (300 + len('back 0'))
+    assert len(cache) == 3
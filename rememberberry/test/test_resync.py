@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from rememberberry import resync
+
+
+@pytest.mark.asyncio
+async def test_resyncer():
+    synced = []
+    running = []
+    busy = {'b': 2}
+
+    async def sync(username, anki_hkey):
+        running.append(username)
+        peak[0] = max(peak[0], len(running))
+        await asyncio.sleep(0.05)
+        running.remove(username)
+        if busy.get(username):
+            busy[username] -= 1
+            return None, None
+        synced.append((username, anki_hkey))
+        return ('full' if username == 'c' else 'incremental'), None
+
+    peak = [0]
+    resyncer = resync.Resyncer(sync, interval=0.2, jitter=0.1, concurrency=2,
+                               active_time=0.5, busy_retry=0.05)
+    resyncer.enabled = True
+    resyncer.is_owner = lambda username: username != 'other'
+    try:
+        resyncer.start()
+        for username in ['a', 'b', 'c', 'd', 'other']:
+            resyncer.seen(username, 'hkey-%s' % username)
+        resyncer.seen('e', None)
+        assert resyncer.stats()['users'] == 4
+
+        # The first syncs are an interval after the users were seen
+        await asyncio.sleep(0.15)
+        assert synced == []
+        await asyncio.sleep(0.2)
+        assert sorted(u for u, h in synced) == ['a', 'c', 'd']
+        assert peak[0] == 2
+
+        # Busy collections are tried again soon
+        await asyncio.sleep(0.3)
+        assert ('b', 'hkey-b') in synced
+        stats = resyncer.stats()
+        assert stats['busy'] == 2
+        assert stats['full'] >= 1
+
+        # Users that are no longer seen are dropped
+        await asyncio.sleep(0.6)
+        assert resyncer.stats()['users'] == 0
+        assert resyncer.stats()['dropped'] == 4
+        num_synced = len(synced)
+        await asyncio.sleep(0.3)
+        assert len(synced) == num_synced
+    finally:
+        resyncer.stop()
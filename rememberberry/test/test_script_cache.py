@@ -0,0 +1,68 @@
+import os
+import shutil
+import pytest
+import rememberberry
+from rememberberry import ipfs
+from rememberberry.script_cache import ScriptCache
+
+
+@pytest.mark.asyncio
+async def test_script_cache_reload(tmpdir):
+    path = str(tmpdir.join('scripts'))
+    shutil.copytree(rememberberry.SCRIPTS_PATH, path)
+    cache = ScriptCache(path, check_interval=0)
+
+    storage = ipfs.get_ipfs_storage()
+    script = await cache.get_script(storage)
+    assert storage['name'] == 'Meatbag'
+    assert cache.stats() == {'hits': 0, 'reloads': 1}
+
+    # The graph is shared, but each session gets its own bindings
+    storage2 = ipfs.get_ipfs_storage()
+    assert await cache.get_script(storage2) is script
+    assert storage2['yes'] == storage['yes']
+    assert storage2['yes'] is not storage['yes']
+    assert cache.stats() == {'hits': 1, 'reloads': 1}
+
+    # Touching a script file triggers a reload
+    init_path = os.path.join(path, 'init.py')
+    st = os.stat(init_path)
+    os.utime(init_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert await cache.get_script(ipfs.get_ipfs_storage()) is not script
+    assert cache.stats() == {'hits': 1, 'reloads': 2}
+
+
+def _write_scripts(path, greeting):
+    with open(os.path.join(path, 'init.yaml'), 'w') as f:
+        f.write('- name: init\n  =>+: "{{greeting}}"\n')
+    with open(os.path.join(path, 'init.py'), 'w') as f:
+        f.write('greeting = %r\nseen = []\n' % greeting)
+
+
+@pytest.mark.asyncio
+async def test_script_cache_own_scripts(tmpdir):
+    path = str(tmpdir.mkdir('scripts'))
+    _write_scripts(path, 'Hello')
+    cache = ScriptCache(path, check_interval=0)
+
+    storage = ipfs.get_ipfs_storage()
+    script = await cache.get_script(storage)
+    assert storage['greeting'] == 'Hello'
+    storage2 = ipfs.get_ipfs_storage()
+    assert await cache.get_script(storage2) is script
+    assert cache.reloads == 1
+
+    # Sessions don't share the companions' mutable values
+    storage['seen'].append('hi')
+    assert storage2['seen'] == []
+
+    # Changing a companion reloads it, for new sessions
+    _write_scripts(path, 'Hi')
+    init_path = os.path.join(path, 'init.py')
+    st = os.stat(init_path)
+    os.utime(init_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    storage3 = ipfs.get_ipfs_storage()
+    assert await cache.get_script(storage3) is not script
+    assert cache.reloads == 2
+    assert storage3['greeting'] == 'Hi' and storage3['seen'] == []
+    assert storage['greeting'] == 'Hello'
@@ -0,0 +1,81 @@
+import json
+import time
+import asyncio
+import pytest
+from aiohttp.test_utils import TestServer
+from rememberberry import ipfs, ipfsapi_asyncio
+from rememberberry.fakes import FakeIPFS
+from rememberberry.tokens import TokenStore
+
+
+def test_token_expiry_and_cap():
+    store = TokenStore(ttl=60, max_size=3)
+    for i in range(4):
+        store.add('token%i' % i, 'account%i' % i, 'pw%i' % i)
+
+    # The oldest token is dropped
+    assert len(store) == 3
+    assert 'token0' not in store
+    assert store.get('token3') == ('account3', 'pw3')
+
+    store.ttl = -1
+    store.add('expired', 'account', 'pw')
+    assert store.sweep() == 1
+    assert 'expired' not in store
+    assert len(store) == 2
+
+
+@pytest.mark.asyncio
+async def test_token_persistence():
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api, ipfs.API = ipfs.API, await ipfsapi_asyncio.connect(server.host, server.port)
+    try:
+        await ipfs.mfs_mkdirs('/data')
+        store = TokenStore()
+        await store.load('/data/auth_tokens.json')
+        store.add('secret', 'account', 'pw')
+        await store.stop()
+
+        # Only hashes of the tokens are persisted
+        assert b'secret' not in await ipfs.mfs_read('/data/auth_tokens.json', 'b')
+
+        store = TokenStore()
+        await store.load('/data/auth_tokens.json')
+        assert store.get('secret') == ('account', 'pw')
+    finally:
+        await ipfs.API.close()
+        await server.close()
+        ipfs.API = api
+
+
+@pytest.mark.asyncio
+async def test_token_peers():
+    fake = FakeIPFS()
+    server = TestServer(fake.app)
+    await server.start_server()
+    api, ipfs.API = ipfs.API, await ipfsapi_asyncio.connect(server.host, server.port)
+    try:
+        await ipfs.mfs_mkdirs('/data')
+        first, second = TokenStore(save_delay=0), TokenStore(refresh_interval=0)
+        await first.load('/data/tokens.0.json', ['/data/tokens.1.json'])
+        await second.load('/data/tokens.1.json', ['/data/tokens.0.json'])
+        first.start()
+
+        # New tokens are saved right away, and picked up by the other store
+        first.add('secret', 'account', 'pw')
+        await asyncio.sleep(0.1)
+        assert second.get('secret') is None
+        assert await second.refresh()
+        assert second.get('secret') == ('account', 'pw')
+
+        second.add('other', 'account', 'pw')
+        await second.stop()
+        await first.stop()
+        assert len(json.loads(await ipfs.mfs_read('/data/tokens.0.json'))) == 1
+        assert len(json.loads(await ipfs.mfs_read('/data/tokens.1.json'))) == 2
+    finally:
+        await ipfs.API.close()
+        await server.close()
+        ipfs.API = api
@@ -0,0 +1,107 @@
+import json
+import pickle
+import asyncio
+import pstats
+import pytest
+from rememberberry import tracing
+
+
+async def _slow_action():
+    await asyncio.sleep(0.02)
+    return True
+
+
+async def _replies():
+    yield 'one'
+    await asyncio.sleep(0.01)
+    yield 'two'
+
+
+def _check(x):
+    return x > 1
+
+
+@pytest.mark.asyncio
+async def test_turn_spans(tmpdir, monkeypatch):
+    log = str(tmpdir.join('slow.jsonl'))
+    monkeypatch.setattr(tracing, 'SLOW_LOG', log)
+    monkeypatch.setattr(tracing, 'SLOW_THRESHOLD', 0.01)
+    ns = tracing.wrap_namespace({
+        'slow_action': _slow_action, 'replies': _replies, 'check': _check, 'x': 3})
+    assert ns['x'] == 3
+
+    # Outside of a turn the functions are called as is
+    assert ns['check'](2) and await ns['slow_action']()
+
+    with tracing.turn() as trace:
+        assert ns['check'](2)
+        assert await ns['slow_action']()
+        async for reply in ns['replies']():
+            trace.event('reply')
+
+    root = trace.to_dict()
+    assert [c['name'] for c in root['children']] == ['check', 'slow_action', 'replies']
+    assert root['children'][1]['duration'] >= 0.02
+    assert [c['name'] for c in root['children'][2]['children']] == ['reply', 'reply']
+    assert tracing.current() is None
+
+    with open(log) as f:
+        assert json.loads(f.readline())['name'] == 'turn'
+
+    # Wrapped functions pickle as the originals
+    assert pickle.loads(pickle.dumps(ns['check'])) is _check
+
+
+@pytest.mark.asyncio
+async def test_script_steps():
+    ns = tracing.wrap_namespace({'slow_action': _slow_action, 'check': _check})
+    async def reply(msg):
+        # Like rememberscript evaluating the script's expressions
+        if ns['check'](3):
+            yield 'first'
+        await ns['slow_action']()
+        yield 'second'
+        await asyncio.sleep(0.01)
+
+    with tracing.turn() as trace:
+        replies = []
+        async for r in tracing.steps(reply('hi')):
+            trace.event('reply')
+            replies.append(r)
+    assert replies == ['first', 'second']
+
+    children = trace.to_dict()['children']
+    assert [c['name'] for c in children] == ['script', 'reply', 'script', 'reply', 'script']
+    assert [c['name'] for c in children[0]['children']] == ['check']
+    assert [c['name'] for c in children[2]['children']] == ['slow_action']
+    assert children[4]['duration'] >= 0.01
+
+    # Outside of a turn it's only the generator
+    assert [r async for r in tracing.steps(reply('hi'))] == ['first', 'second']
+
+
+@pytest.mark.asyncio
+async def test_traces_are_per_task():
+    ns = tracing.wrap_namespace({'slow_action': _slow_action})
+
+    async def session():
+        with tracing.turn() as trace:
+            await ns['slow_action']()
+        return trace
+
+    traces = await asyncio.gather(session(), session())
+    assert [len(t.root.children) for t in traces] == [1, 1]
+
+
+@pytest.mark.asyncio
+async def test_profiling(tmpdir, monkeypatch):
+    monkeypatch.setattr(tracing, 'PROFILE_FILE', str(tmpdir.join('prof')))
+    monkeypatch.setattr(tracing, 'PROFILE_RATE', 1.0)
+    tracing.toggle_profiling()
+    for i in range(3):
+        with tracing.turn():
+            sum(range(1000))
+    assert tracing.PROFILER.sampled == 3
+    tracing.toggle_profiling()
+    assert not tracing.PROFILER.enabled
+    pstats.Stats(str(tmpdir.join('prof')))
@@ -0,0 +1,170 @@
+import os
+import socket
+import asyncio
+import pytest
+import aiohttp
+from aiohttp import web
+from rememberberry import auth
+from rememberberry.collection_pool import CollectionPool, _Entry
+from rememberberry.workers import HashRing, LeaseManager, Dispatcher, receive_connections
+
+
+def test_hash_ring():
+    ring = HashRing(range(4))
+    accounts = [auth.account_hex('user%i' % i) for i in range(1000)]
+    owners = [ring.get(a) for a in accounts]
+    assert owners == [ring.get(a) for a in accounts]
+    # Roughly balanced
+    assert all(owners.count(i) > 150 for i in range(4))
+
+    # Adding a worker only moves users to the new worker
+    bigger = HashRing(range(5))
+    moved = [(old, bigger.get(a)) for old, a in zip(owners, accounts) if bigger.get(a) != old]
+    assert all(new == 4 for old, new in moved)
+    assert len(moved) < 350
+
+
+@pytest.mark.asyncio
+async def test_leases(tmpdir):
+    # flocks on separate open files exclude each other even in one process
+    a = LeaseManager(str(tmpdir), poll_interval=0.01, timeout=1.0)
+    b = LeaseManager(str(tmpdir), poll_interval=0.01, timeout=1.0)
+
+    acquired = []
+    async def on_acquire():
+        acquired.append('a')
+    assert await a.acquire('user', on_acquire)
+    assert not await a.acquire('user', on_acquire)
+    assert acquired == ['a']
+
+    waiting = asyncio.ensure_future(b.acquire('user'))
+    await asyncio.sleep(0.05)
+    assert not waiting.done() and b.waits == 1
+    a.release('user')
+    assert await waiting
+    assert b.holds('user') and not a.holds('user')
+
+    b.timeout = 0.05
+    a.timeout = 0.05
+    with pytest.raises(TimeoutError):
+        await a.acquire('user')
+    assert await a.acquire('other')
+
+
+@pytest.mark.asyncio
+async def test_lease_request(tmpdir):
+    released = []
+    async def on_request(username):
+        released.append(username)
+        a.release(username)
+    a = LeaseManager(str(tmpdir), name=0, on_request=on_request)
+    b = LeaseManager(str(tmpdir), name=1, poll_interval=0.01, timeout=1.0)
+    a.listen()
+    try:
+        assert await a.acquire('user')
+        # b asks a to let go, rather than waiting for it
+        assert await asyncio.wait_for(b.acquire('user'), 0.5)
+        assert released == ['user'] and a.requests == 1
+        assert b.holds('user')
+    finally:
+        a.close()
+
+
+def test_dispatcher_pick():
+    dispatcher = Dispatcher(None, [None] * 3, None)
+    account = auth.account_hex('someone')
+    worker = dispatcher.pick(b'GET /?account=%s HTTP/1.1' % account.encode())
+    assert worker == dispatcher.ring.get(account)
+    assert dispatcher.pick(b'GET /?x=1&account=%s HTTP/1.1' % account.encode()) == worker
+    assert dispatcher.pick(b'GET /metrics HTTP/1.1') is None
+
+    # Without an account, they're spread round robin
+    lines = [b'GET / HTTP/1.1', b'GET /?account=1234 HTTP/1.1', None, b'garbage']
+    assert [dispatcher.pick(l) for l in lines] == [0, 1, 2, 0]
+
+
+@pytest.mark.asyncio
+async def test_dispatcher():
+    async def echo(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            await ws.send_str('%s: %s' % (request.app['name'], msg.data))
+        return ws
+
+    runners, channels = [], []
+    for name in ['worker0', 'worker1', 'main']:
+        app = web.Application()
+        app['name'] = name
+        app.router.add_route('GET', '/', echo)
+        app.router.add_route('GET', '/metrics', echo)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        runners.append(runner)
+        if name != 'main':
+            channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            receive_connections(worker_channel, runner.server, socket.AF_INET)
+            channel.setblocking(False)
+            channels.append(channel)
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    sock.setblocking(False)
+    dispatcher = Dispatcher(sock, channels, runners[2].server)
+    dispatcher.start()
+    url = 'http://127.0.0.1:%i' % sock.getsockname()[1]
+    try:
+        async with aiohttp.ClientSession() as session:
+            account = auth.account_hex('someone')
+            owner = dispatcher.ring.get(account)
+            for i in range(3):
+                async with session.ws_connect('%s/?account=%s' % (url, account)) as ws:
+                    await ws.send_str('hello')
+                    assert (await ws.receive()).data == 'worker%i: hello' % owner
+            assert dispatcher.routed[owner] == 3
+
+            names = []
+            for i in range(2):
+                async with session.ws_connect(url + '/') as ws:
+                    await ws.send_str('hi')
+                    names.append((await ws.receive()).data)
+            assert sorted(names) == ['worker0: hi', 'worker1: hi']
+
+            async with session.ws_connect(url + '/metrics') as ws:
+                await ws.send_str('hi')
+                assert (await ws.receive()).data == 'main: hi'
+    finally:
+        dispatcher.close()
+        for r in runners:
+            await r.cleanup()
+
+
+class _Col:
+    mod = 0
+    class db:
+        mod = False
+
+
+@pytest.mark.asyncio
+async def test_pool_lease(tmpdir):
+    pool = CollectionPool()
+    pool.leases = LeaseManager(str(tmpdir), poll_interval=0.01, timeout=1.0)
+    other = LeaseManager(str(tmpdir), poll_interval=0.01, timeout=1.0)
+    async def _open(username, mfs_path):
+        return _Entry(username, None, _Col())
+    pool._open = _open
+
+    # Another process holds the collection, acquire() waits for it
+    assert await other.acquire('user')
+    acquiring = asyncio.ensure_future(pool.acquire('user', '/users/user/collection.anki2'))
+    await asyncio.sleep(0.05)
+    assert not acquiring.done()
+    other.release('user')
+    col = await asyncio.wait_for(acquiring, 1)
+    assert pool.leases.holds('user')
+
+    # ...and lets go of it once the collection is unused and written back
+    await pool.release(col)
+    assert not pool.leases.holds('user')
+    assert await other.acquire('user')
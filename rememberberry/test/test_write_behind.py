@@ -0,0 +1,81 @@
+import asyncio
+import pytest
+from rememberberry import write_behind
+from rememberberry.write_behind import WriteBehind
+
+
+class _Storage:
+    def __init__(self, fail=False):
+        self.syncs = 0
+        self.fail = fail
+
+    async def sync(self):
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise IOError('ipfs is down')
+        self.syncs += 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind():
+    storage = _Storage()
+    writer = WriteBehind(storage, interval=0.05)
+    try:
+        # Turns within the interval are written together
+        for i in range(3):
+            writer.mark_dirty()
+            await asyncio.sleep(0.01)
+        assert storage.syncs == 0
+        assert writer.dirty_age() > 0
+        assert write_behind.stats()['dirty_sessions'] >= 1
+
+        await asyncio.sleep(0.1)
+        assert storage.syncs == 1
+        assert writer.dirty_age() == 0.0
+        assert writer.last_flush_time > 0
+
+        # Nothing changed, nothing written
+        await asyncio.sleep(0.1)
+        assert storage.syncs == 1
+
+        # Closing waits for the flush in progress
+        writer.mark_dirty()
+        await asyncio.sleep(0.055)
+        await writer.close()
+        assert storage.syncs == 2
+    finally:
+        await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_no_delay():
+    storage = _Storage()
+    writer = WriteBehind(storage, interval=0)
+    try:
+        assert writer.interval == 0
+        writer.mark_dirty()
+        await asyncio.sleep(0.02)
+        assert storage.syncs == 1
+    finally:
+        await writer.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_failure():
+    storage = _Storage(fail=True)
+    writer = WriteBehind(storage, interval=0.01)
+    try:
+        failures = write_behind.STATS['failures']
+        writer.mark_dirty()
+        await asyncio.sleep(0.05)
+        assert write_behind.STATS['failures'] > failures
+        # Still dirty, also while the retry is in progress
+        assert writer.is_dirty() and writer.dirty_age() > 0.04
+        assert write_behind.stats()['dirty_sessions'] >= 1
+
+        # And it's retried
+        storage.fail = False
+        await asyncio.sleep(0.05)
+        assert storage.syncs == 1 and not writer.is_dirty()
+    finally:
+        await writer.close()
@@ -4,6 +4,7 @@ import functools
 import pytest
 import rememberberry
 from rememberberry import ipfs
+from rememberberry.collection_pool import POOL
 from rememberscript import load_scripts_dir, validate_script, load_script
 from rememberscript import RememberMachine
 from rememberscript.testing import assert_replies
@@ -22,6 +23,8 @@ def tmp_data_path(data_path, rm=False):
                 except:
                     pass
             await func(*args)
+            # Don't leak open collections into the next test
+            await POOL.close_all()
             rememberberry.ipfs.DATA_ROOT = tmp
         return _wrapped_f
     return _wrap
@@ -0,0 +1,164 @@
+"""
+Store for the auth tokens that clients use to log in again
+
+Tokens expire after ttl seconds, expired tokens are swept periodically and
+the number of tokens is capped, dropping the oldest first. The store is
+persisted to mfs so that tokens survive restarts, keyed by the sha256 of
+the token so the persisted file can't be used to log in.
+
+With several server processes each one persists its own tokens, and
+merges in the files of the others (peer_paths) when it's asked about a
+token it doesn't know
+"""
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from rememberberry import ipfs
+
+
+def _token_key(token):
+    return hashlib.sha256(bytes(token, 'utf-8')).hexdigest()
+
+
+class TokenStore:
+    def __init__(self, ttl=30*24*3600, max_size=100000, sweep_interval=60.0,
+                 save_delay=1.0, refresh_interval=1.0):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self.save_delay = save_delay
+        self.refresh_interval = refresh_interval
+        self.path = None
+        self.peer_paths = []
+        self._tokens = OrderedDict() # token key -> (account, password hex, expires)
+        self._dirty = False
+        self._sweeper = None
+        self._save_handle = None
+        self._last_refresh = 0.0
+
+    def add(self, token, account, password_hex):
+        self._tokens[_token_key(token)] = (account, password_hex, time.time() + self.ttl)
+        while len(self._tokens) > self.max_size:
+            self._tokens.popitem(last=False)
+        self._dirty = True
+        self._schedule_save()
+
+    def _schedule_save(self):
+        """Saves new tokens soon, so that other processes (and this one
+        after a restart) know about them"""
+        if self._sweeper is None or self._save_handle is not None:
+            return
+        def _save():
+            self._save_handle = None
+            asyncio.ensure_future(self._save_logged())
+        self._save_handle = asyncio.get_event_loop().call_later(self.save_delay, _save)
+
+    def get(self, token):
+        """Returns (account, password hex) for an active token, or None"""
+        entry = self._tokens.get(_token_key(token))
+        if entry is None:
+            return None
+        account, password_hex, expires = entry
+        if time.time() > expires:
+            del self._tokens[_token_key(token)]
+            self._dirty = True
+            return None
+        return account, password_hex
+
+    def remove(self, token):
+        if self._tokens.pop(_token_key(token), None) is not None:
+            self._dirty = True
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self._tokens)
+
+    def sweep(self):
+        """Drops the expired tokens"""
+        now = time.time()
+        expired = [key for key, (a, p, expires) in self._tokens.items() if now > expires]
+        for key in expired:
+            del self._tokens[key]
+        if expired:
+            self._dirty = True
+        return len(expired)
+
+    async def _read(self, path):
+        """Returns the unexpired (expires, key, account, password hex) in the
+        persisted file at path, oldest first"""
+        try:
+            data = json.loads(await ipfs.mfs_read(path))
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logging.warning('couldn\'t parse the auth tokens in %s' % path)
+            return []
+
+        now = time.time()
+        return sorted((expires, key, account, password_hex)
+                      for key, (account, password_hex, expires) in data.items()
+                      if expires > now)
+
+    async def load(self, path, peer_paths=()):
+        """Loads the persisted tokens from the mfs path, and persists to it
+        from now on. Tokens persisted by other processes at peer_paths are
+        merged in"""
+        self.path = path
+        self.peer_paths = list(peer_paths)
+        for p in [path] + self.peer_paths:
+            entries = await self._read(p)
+            for expires, key, account, password_hex in entries:
+                self._tokens.setdefault(key, (account, password_hex, expires))
+            logging.info('loaded %i auth tokens from %s' % (len(entries), p))
+        self._last_refresh = time.monotonic()
+
+    async def refresh(self):
+        """Merges in the tokens persisted by other processes since the last
+        refresh, at most once per refresh_interval. Returns True if it did"""
+        now = time.monotonic()
+        if not self.peer_paths or now - self._last_refresh < self.refresh_interval:
+            return False
+        self._last_refresh = now
+        for path in self.peer_paths:
+            for expires, key, account, password_hex in await self._read(path):
+                if key not in self._tokens:
+                    self._tokens[key] = (account, password_hex, expires)
+        return True
+
+    async def save(self):
+        if self.path is None or not self._dirty:
+            return
+        self._dirty = False
+        data = json.dumps(self._tokens, separators=(',', ':'))
+        await ipfs.mfs_write(self.path, data)
+
+    async def _save_logged(self):
+        try:
+            await self.save()
+        except:
+            logging.exception('saving auth tokens failed')
+            self._dirty = True
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self.sweep()
+            await self._save_logged()
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        await self.save()
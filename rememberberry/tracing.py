@@ -0,0 +1,257 @@
+"""
+Per-turn tracing and sampled profiling
+
+Every message a session handles is traced: the steps of the script (the
+work rememberscript does to get to each reply, i.e. its transitions and
+expression evaluation, see steps()), the functions that the scripts call
+from [[...]] and {{...}} (the python companions' namespace, see
+script_cache), the ipfs helpers and the replies are recorded as a tree of
+spans with their durations. The time of a step that isn't in its children
+was spent in rememberscript itself. Turns slower than SLOW_THRESHOLD seconds are
+written as json lines to SLOW_LOG (or logged, if it's None). Neither the
+message text nor call arguments are recorded, they can contain passwords.
+
+Spans are tracked per asyncio task, so work that a turn hands off to other
+tasks (e.g. the write-behind) isn't part of its trace.
+
+Profiling is off by default. When enabled (e.g. with SIGUSR2, see
+toggle_profiling), a PROFILE_RATE fraction of the turns are run under
+cProfile, and the accumulated stats are written to PROFILE_FILE when it's
+disabled again
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import cProfile
+import inspect
+import logging
+import functools
+import weakref
+
+# Turns slower than this many seconds are written to SLOW_LOG
+SLOW_THRESHOLD = 1.0
+SLOW_LOG = None
+
+PROFILE_RATE = 0.1
+PROFILE_FILE = 'rememberberry.prof'
+
+# Traces by the task that runs them
+_TRACES = weakref.WeakKeyDictionary()
+
+
+if hasattr(asyncio, 'current_task'):
+    _current_task = asyncio.current_task
+else:
+    _current_task = asyncio.Task.current_task
+
+
+class _Span:
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.children = []
+
+    def to_dict(self, origin):
+        d = {'name': self.name, 'start': round(self.start - origin, 6),
+             'duration': round(self.duration, 6)}
+        if self.children:
+            d['children'] = [c.to_dict(origin) for c in self.children]
+        return d
+
+
+class Trace:
+    def __init__(self, name):
+        self.root = _Span(name, time.monotonic())
+        self._stack = [self.root]
+
+    def span(self, name):
+        return _SpanContext(self, name)
+
+    def event(self, name):
+        """A span without a duration, e.g. a reply being sent"""
+        span = _Span(name, time.monotonic())
+        span.duration = 0.0
+        self._stack[-1].children.append(span)
+
+    def finish(self):
+        self.root.duration = time.monotonic() - self.root.start
+        return self.root.duration
+
+    def to_dict(self):
+        return self.root.to_dict(self.root.start)
+
+
+class _SpanContext:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.span = _Span(self.name, time.monotonic())
+        self.trace._stack[-1].children.append(self.span)
+        self.trace._stack.append(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.duration = time.monotonic() - self.span.start
+        # Pop up to our span, in case an inner span was left open
+        while self.trace._stack.pop() is not self.span:
+            pass
+
+
+def current():
+    """Returns the trace of the running task, or None"""
+    try:
+        task = _current_task()
+    except RuntimeError:
+        # No running loop
+        return None
+    return _TRACES.get(task) if task is not None else None
+
+
+def _write_slow(trace):
+    line = json.dumps(trace.to_dict(), separators=(',', ':'))
+    if SLOW_LOG is None:
+        logging.warning('slow turn: %s' % line)
+        return
+    with open(SLOW_LOG, 'a') as f:
+        f.write(line + '\n')
+
+
+class _Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.profile = None
+        self.running = False
+        self.sampled = 0
+
+    def start(self):
+        """Returns whether this turn is profiled"""
+        if not self.enabled or self.running or random.random() >= PROFILE_RATE:
+            return False
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+        self.running = True
+        self.sampled += 1
+        self.profile.enable()
+        return True
+
+    def stop(self):
+        self.profile.disable()
+        self.running = False
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        if self.enabled:
+            logging.info('profiling %.0f%% of the turns' % (PROFILE_RATE * 100))
+            return
+        if self.profile is not None:
+            self.profile.dump_stats(PROFILE_FILE)
+            logging.info('wrote the profile of %i turns to %s' % (self.sampled, PROFILE_FILE))
+        self.profile = None
+        self.sampled = 0
+
+
+PROFILER = _Profiler()
+
+
+def toggle_profiling():
+    PROFILER.toggle()
+
+
+class turn:
+    """Context manager that traces (and maybe profiles) a turn of the
+    running task"""
+    def __init__(self, name='turn'):
+        self.name = name
+
+    def __enter__(self):
+        self.task = _current_task()
+        self.trace = Trace(self.name)
+        _TRACES[self.task] = self.trace
+        self.profiled = PROFILER.start()
+        return self.trace
+
+    def __exit__(self, *exc):
+        if self.profiled:
+            PROFILER.stop()
+        _TRACES.pop(self.task, None)
+        if self.trace.finish() > SLOW_THRESHOLD:
+            _write_slow(self.trace)
+
+
+class _Traced:
+    """Wraps a function so that its calls are spans in the current trace.
+    Pickles as the wrapped function"""
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        functools.update_wrapper(self, func)
+        if inspect.isasyncgenfunction(func):
+            self._call = self._call_asyncgen
+        elif asyncio.iscoroutinefunction(func):
+            self._call = self._call_coroutine
+        else:
+            self._call = self._call_function
+
+    def __call__(self, *args, **kwargs):
+        trace = current()
+        if trace is None:
+            return self.func(*args, **kwargs)
+        return self._call(trace, *args, **kwargs)
+
+    def _call_function(self, trace, *args, **kwargs):
+        with trace.span(self.name):
+            return self.func(*args, **kwargs)
+
+    async def _call_coroutine(self, trace, *args, **kwargs):
+        with trace.span(self.name):
+            return await self.func(*args, **kwargs)
+
+    async def _call_asyncgen(self, trace, *args, **kwargs):
+        with trace.span(self.name):
+            async for value in self.func(*args, **kwargs):
+                yield value
+
+    def __reduce__(self):
+        module = sys.modules.get(self.func.__module__)
+        if getattr(module, self.func.__name__, None) is self:
+            # Decorated, so it's the module's global
+            return self.func.__name__
+        return _untraced, (self.func,)
+
+
+def _untraced(func):
+    return func
+
+
+def traced(func=None, name=None):
+    """Decorator for functions whose calls should be traced"""
+    if func is None:
+        return functools.partial(traced, name=name)
+    return _Traced(name or '%s.%s' % (func.__module__.split('.')[-1], func.__name__), func)
+
+
+async def steps(agen, name='script'):
+    """Yields what the async generator agen yields, with the work up to each
+    value (and to the end) as a span of the current trace"""
+    while True:
+        trace = current()
+        try:
+            if trace is None:
+                value = await agen.__anext__()
+            else:
+                with trace.span(name):
+                    value = await agen.__anext__()
+        except StopAsyncIteration:
+            return
+        yield value
+
+
+def wrap_namespace(namespace):
+    """Returns the namespace with its functions traced"""
+    return {key: _Traced(key, value) if inspect.isfunction(value) else value
+            for key, value in namespace.items()}
@@ -0,0 +1,501 @@
+"""
+Running the server as several processes
+
+The anki work runs on the event loop, so a single server process only ever
+uses one core. With --workers N the server forks N worker processes that
+each run the usual app. The main process accepts the connections and
+passes each socket on to a worker (over a unix socket, with SCM_RIGHTS),
+which serves it as if it had accepted it, so none of the traffic goes
+through the main process.
+
+Connections are routed by their request line, which the main process peeks
+at without reading it: clients that know their account (the part of their
+auth token before the dot) connect to /?account=<account hex>, and go to
+the worker that owns the account on a consistent hash ring, so a user's
+collection stays open in the pool of one process. Other connections (old
+clients, logging in with a password, or signing up) are spread round
+robin, and so are all connections with --ssl, since the request line is
+encrypted. /metrics is served by the main process, for all the workers
+(with --ssl, each worker serves its own).
+
+A user can still end up in two workers at once (e.g. right after a
+password login), so workers take a per-user lease (an flock) before using
+a collection, and hold it until it's written back. A worker waiting for a
+lease asks the holder to write the collection back now, rather than after
+its writeback delay.
+
+All the workers share the same ipfs daemon, so the data root is a single
+tree that they all update. The main process polls its hash, rather than
+every worker tracking it separately
+"""
+import os
+import time
+import array
+import signal
+import socket
+import fcntl
+import bisect
+import shutil
+import asyncio
+import hashlib
+import logging
+import tempfile
+import multiprocessing
+import urllib.parse
+import aiohttp
+from aiohttp import web
+from rememberberry import ipfs, auth, metrics, tracing, anki_integration, media
+from rememberberry import executors
+from rememberberry.collection_pool import POOL
+
+
+def _hash(key):
+    return int(hashlib.md5(bytes(key, 'utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes"""
+    def __init__(self, nodes, replicas=100):
+        self._ring = sorted((_hash('%s:%i' % (node, i)), node)
+                            for node in nodes for i in range(replicas))
+        self._hashes = [h for h, node in self._ring]
+
+    def get(self, key):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class LeaseManager:
+    """Exclusive per-user leases between processes, as flocks on files in
+    path. The lock is dropped by the os if the process dies.
+
+    With a name, the holder writes it into the lock file, and listen()s on
+    a unix datagram socket for others asking it to let go of a lease, see
+    on_request"""
+    def __init__(self, path, is_owner=None, poll_interval=0.05, timeout=60.0,
+                 name=None, on_request=None, request_interval=1.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.name = name
+        # Awaited with the username when another process waits for its lease
+        self.on_request = on_request
+        self.request_interval = request_interval
+        self.waits = 0
+        self.requests = 0
+        self._is_owner = is_owner
+        self._held = {} # username -> fd
+        self._locks = {}
+        self._wanted = set() # held leases that others wait for
+        self._sock = None
+
+    def _lock_path(self, username):
+        return os.path.join(self.path, '%s.lock' % auth.account_hex(username))
+
+    def _request_path(self, name):
+        return os.path.join(self.path, 'requests-%s.sock' % name)
+
+    def _try_lock(self, username):
+        fd = os.open(self._lock_path(username), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        if self.name is not None:
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(self.name).encode('utf-8'), 0)
+        return fd
+
+    def _request(self, username):
+        """Asks the holder of the lease of username to let go of it"""
+        try:
+            with open(self._lock_path(username)) as f:
+                holder = f.read()
+        except OSError:
+            return
+        if not holder or holder == str(self.name):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            try:
+                sock.sendto(username.encode('utf-8'), self._request_path(holder))
+            except OSError:
+                # It isn't listening, or is busy, the next request may get through
+                pass
+
+    def listen(self):
+        """Starts taking requests from other processes to let go of leases"""
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        path = self._request_path(self.name)
+        if os.path.exists(path):
+            os.remove(path)
+        self._sock.bind(path)
+        self._sock.setblocking(False)
+        asyncio.get_event_loop().add_reader(self._sock.fileno(), self._on_request)
+
+    def _on_request(self):
+        while True:
+            try:
+                username = self._sock.recv(1024).decode('utf-8')
+            except BlockingIOError:
+                return
+            if username not in self._held:
+                continue
+            self.requests += 1
+            self._wanted.add(username)
+            if self.on_request is not None:
+                asyncio.ensure_future(self.on_request(username))
+
+    def close(self):
+        if self._sock is not None:
+            asyncio.get_event_loop().remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
+
+    async def acquire(self, username, on_acquire=None):
+        """Takes the lease of username, waiting for other processes to let go
+        of it. If this process didn't already hold it, on_acquire() is
+        awaited before anyone else in this process gets past acquire()"""
+        lock = self._locks.setdefault(username, asyncio.Lock())
+        async with lock:
+            if username in self._held:
+                return False
+
+            fd = self._try_lock(username)
+            if fd is None:
+                self.waits += 1
+                logging.info('waiting for another worker to release %s' % username)
+                deadline = time.monotonic() + self.timeout
+                next_request = time.monotonic()
+            while fd is None:
+                now = time.monotonic()
+                if now > deadline:
+                    raise TimeoutError('timed out waiting for the lease of %s' % username)
+                if now >= next_request:
+                    self._request(username)
+                    next_request = now + self.request_interval
+                await asyncio.sleep(self.poll_interval)
+                fd = self._try_lock(username)
+
+            self._held[username] = fd
+            if on_acquire is not None:
+                await on_acquire()
+            return True
+
+    def release(self, username):
+        self._wanted.discard(username)
+        fd = self._held.pop(username, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        lock = self._locks.get(username)
+        if lock is not None and not lock.locked():
+            del self._locks[username]
+
+    def holds(self, username):
+        return username in self._held
+
+    def wanted(self, username):
+        """Whether another process waits for the lease of username"""
+        return username in self._wanted
+
+    def is_owner(self, username):
+        """Whether this is the worker that username is routed to"""
+        return self._is_owner is None or self._is_owner(username)
+
+
+def _parse_request_line(request_line):
+    """The path and account of a request line like
+    GET /?account=<account hex> HTTP/1.1"""
+    parts = request_line.split(b' ')
+    if len(parts) != 3:
+        return None, None
+    url = urllib.parse.urlsplit(parts[1].decode('latin-1'))
+    account = urllib.parse.parse_qs(url.query).get('account', [None])[0]
+    if account is not None and len(account) != 64:
+        account = None
+    return url.path, account
+
+
+async def _wait_fd(loop, sock, writable=False, timeout=None):
+    fut = loop.create_future()
+    def ready():
+        if not fut.done():
+            fut.set_result(None)
+    if writable:
+        loop.add_writer(sock.fileno(), ready)
+    else:
+        loop.add_reader(sock.fileno(), ready)
+    try:
+        await asyncio.wait_for(fut, timeout)
+    finally:
+        if writable:
+            loop.remove_writer(sock.fileno())
+        else:
+            loop.remove_reader(sock.fileno())
+
+
+class Dispatcher:
+    """Accepts the connections to sock, and passes each one on to a worker
+    over its channel (the main process' end of a unix socketpair), or to
+    the local aiohttp server for /metrics"""
+    def __init__(self, sock, channels, server, peek=True, peek_timeout=5.0):
+        self.sock = sock
+        self.channels = channels
+        self.server = server
+        # Whether the request lines can be read, i.e. it isn't ssl
+        self.peek = peek
+        self.peek_timeout = peek_timeout
+        self.ring = HashRing(range(len(channels)))
+        self.routed = [0] * len(channels)
+        self._next = 0
+        self._task = None
+
+    def pick(self, request_line):
+        """Returns the index of the worker for a connection, or None for the
+        main process"""
+        path, account = None, None
+        if request_line is not None:
+            path, account = _parse_request_line(request_line)
+        if path == '/metrics':
+            return None
+        if account is not None:
+            return self.ring.get(account)
+        worker = self._next
+        self._next = (self._next + 1) % len(self.channels)
+        return worker
+
+    async def _peek(self, conn):
+        """The request line, left in the socket for the worker to read"""
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.peek_timeout
+        data = b''
+        while b'\r\n' not in data and len(data) < 8192:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                return None
+            try:
+                peeked = conn.recv(8192, socket.MSG_PEEK)
+            except BlockingIOError:
+                try:
+                    await _wait_fd(loop, conn, timeout=timeout)
+                except asyncio.TimeoutError:
+                    return None
+                continue
+            if not peeked or peeked == data:
+                if not peeked:
+                    # Closed before sending a request
+                    return None
+                # Still readable, the rest of the line is on the way
+                await asyncio.sleep(0.005)
+            data = peeked
+        return data.partition(b'\r\n')[0]
+
+    async def _send(self, channel, conn):
+        loop = asyncio.get_event_loop()
+        fds = array.array('i', [conn.fileno()])
+        while True:
+            try:
+                channel.sendmsg([b'c'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+                return
+            except BlockingIOError:
+                await _wait_fd(loop, channel, writable=True)
+
+    async def _dispatch(self, conn):
+        try:
+            request_line = None
+            if self.peek:
+                request_line = await self._peek(conn)
+            worker = self.pick(request_line)
+            if worker is None:
+                await asyncio.get_event_loop().connect_accepted_socket(self.server, conn)
+                return
+            self.routed[worker] += 1
+            await self._send(self.channels[worker], conn)
+        except OSError:
+            logging.info('couldn\'t dispatch a connection', exc_info=True)
+        conn.close()
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            conn, addr = await loop.sock_accept(self.sock)
+            conn.setblocking(False)
+            asyncio.ensure_future(self._dispatch(conn))
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.sock.close()
+
+
+def receive_connections(channel, server, family, ssl_context=None):
+    """Serves the connections that the Dispatcher passes over channel (a
+    worker's end of the socketpair) with server, an aiohttp protocol factory"""
+    loop = asyncio.get_event_loop()
+    fd_size = array.array('i').itemsize
+    async def adopt(conn):
+        try:
+            await loop.connect_accepted_socket(server, conn, ssl=ssl_context)
+        except Exception:
+            logging.info('couldn\'t serve a passed connection', exc_info=True)
+            conn.close()
+    def on_readable():
+        while True:
+            try:
+                msg, ancdata, flags, addr = channel.recvmsg(1, socket.CMSG_SPACE(fd_size))
+            except BlockingIOError:
+                return
+            if not msg:
+                # The main process is gone
+                loop.remove_reader(channel.fileno())
+                return
+            for level, kind, data in ancdata:
+                if level != socket.SOL_SOCKET or kind != socket.SCM_RIGHTS:
+                    continue
+                fds = array.array('i')
+                fds.frombytes(data[:len(data) - len(data) % fd_size])
+                for fd in fds:
+                    conn = socket.socket(family, socket.SOCK_STREAM, fileno=fd)
+                    conn.setblocking(False)
+                    asyncio.ensure_future(adopt(conn))
+    channel.setblocking(False)
+    loop.add_reader(channel.fileno(), on_readable)
+
+
+async def metrics_handler(request):
+    """The metrics of the main process and all the workers, labeled by
+    worker (main for the main process)"""
+    texts = [('main', metrics.render())]
+    for worker, session in enumerate(request.app['worker_sessions']):
+        try:
+            async with session.get('http://worker/metrics') as resp:
+                text = await resp.text()
+        except aiohttp.ClientError:
+            logging.info('couldn\'t get the metrics of worker %i' % worker)
+            continue
+        texts.append((worker, text))
+    return web.Response(text=metrics.merge(texts, 'worker'), content_type='text/plain')
+
+
+def _run(app, start):
+    """Runs app like web.run_app(), with start(runner) awaited to serve it,
+    until SIGINT or SIGTERM"""
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    runner = web.AppRunner(app)
+    try:
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(start(runner))
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(runner.cleanup())
+
+
+def _run_worker(app, index, num_workers, socket_path, lease_path, channel, family,
+                ssl_context):
+    auth.WORKER = index
+    auth.NUM_WORKERS = num_workers
+    ring = HashRing(range(num_workers))
+    def is_owner(username):
+        return ring.get(auth.account_hex(username)) == index
+    POOL.leases = LeaseManager(lease_path, is_owner, name=index,
+                               on_request=POOL.on_lease_request)
+    anki_integration.RESYNC.is_owner = is_owner
+    # The main process keeps track of the root hash, and publishes it
+    ipfs.ROOT.enabled = False
+    ipfs.PUBLISHER.enabled = False
+    # The main process makes the media url secret
+    media.CREATE_SECRET = False
+    tracing.PROFILE_FILE = '%s.%i' % (tracing.PROFILE_FILE, index)
+
+    async def start(runner):
+        # For the metrics of the main process
+        await web.UnixSite(runner, socket_path).start()
+        POOL.leases.listen()
+        receive_connections(channel, runner.server, family, ssl_context)
+        logging.info('worker %i started' % index)
+    _run(app, start)
+
+
+def serve(app, num_workers, host, port, ssl_context=None):
+    """Forks num_workers processes running app, and passes the connections
+    to host:port on to them"""
+    run_path = tempfile.mkdtemp(prefix='rememberberry-')
+    lease_path = os.path.join(run_path, 'leases')
+    os.mkdir(lease_path)
+    socket_paths = [os.path.join(run_path, 'worker-%i.sock' % i) for i in range(num_workers)]
+
+    processes, channels = [], []
+    for i, socket_path in enumerate(socket_paths):
+        channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        p = multiprocessing.Process(
+            target=_run_worker,
+            args=(app, i, num_workers, socket_path, lease_path, worker_channel,
+                  socket.AF_INET, ssl_context),
+            name='rememberberry-worker-%i' % i)
+        p.start()
+        worker_channel.close()
+        channel.setblocking(False)
+        processes.append(p)
+        channels.append(channel)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    main = web.Application()
+    main.router.add_route('GET', '/metrics', metrics_handler)
+
+    def forward_signal():
+        for p in processes:
+            os.kill(p.pid, signal.SIGUSR2)
+
+    async def start(runner):
+        sock.bind((host, port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        main['dispatcher'] = Dispatcher(sock, channels, runner.server, peek=ssl_context is None)
+        main['dispatcher'].start()
+        logging.info('dispatching connections to port %i to %i workers' % (port, num_workers))
+
+    async def on_startup(main):
+        main['worker_sessions'] = [
+            aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=path))
+            for path in socket_paths]
+        await ipfs.init()
+        await media.init()
+        main['root_watch'] = asyncio.ensure_future(ipfs.ROOT.watch())
+        asyncio.get_event_loop().add_signal_handler(signal.SIGUSR2, forward_signal)
+    async def on_shutdown(main):
+        main['root_watch'].cancel()
+        if 'dispatcher' in main:
+            main['dispatcher'].close()
+        for session in main['worker_sessions']:
+            await session.close()
+        # The workers write back what they have open, then the root with
+        # their changes is published
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            await executors.run_in('fs', p.join, 60)
+        try:
+            await ipfs.ROOT.poll()
+        except:
+            logging.exception('polling the root hash failed')
+        await ipfs.PUBLISHER.close()
+    main.on_startup.append(on_startup)
+    main.on_shutdown.append(on_shutdown)
+
+    try:
+        _run(main, start)
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+        sock.close()
+        shutil.rmtree(run_path, ignore_errors=True)
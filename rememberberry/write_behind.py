@@ -0,0 +1,111 @@
+"""
+Write-behind persistence of session storage
+
+Without it a session's storage was only synced when the websocket closed,
+so a crash lost the whole session. Each session now has a WriteBehind that
+syncs its storage in the background at most interval seconds after a turn
+changed it, while the session goes on with the next message. Syncing the
+storage also runs the sync hooks of the anki collections in it, which
+schedules their write back in the pool. On disconnect only the changes
+since the last flush are left to write
+"""
+import time
+import asyncio
+import logging
+import weakref
+
+# Default seconds between a change and it being written
+INTERVAL = 5.0
+
+# Counters for all sessions
+STATS = {'flushes': 0, 'failures': 0, 'flush_time_total': 0.0, 'flush_time_max': 0.0}
+
+_ACTIVE = weakref.WeakSet()
+
+
+class WriteBehind:
+    def __init__(self, storage, interval=None):
+        self.storage = storage
+        self.interval = INTERVAL if interval is None else interval
+        self.dirty_since = None
+        # Age of the changes that the flush in progress is writing
+        self.flushing_since = None
+        self.flushes = 0
+        self.last_flush_time = None
+        self._wakeup = asyncio.Event()
+        self._flushing = None
+        self._task = asyncio.ensure_future(self._run())
+        _ACTIVE.add(self)
+
+    def mark_dirty(self):
+        """Call after every turn that might have changed the storage"""
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+            self._wakeup.set()
+
+    def is_dirty(self):
+        return self.dirty_since is not None or self.flushing_since is not None
+
+    def dirty_age(self):
+        """Seconds that the oldest unwritten change has been waiting,
+        including the changes that are being written"""
+        since = [t for t in (self.dirty_since, self.flushing_since) if t is not None]
+        if not since:
+            return 0.0
+        return time.monotonic() - min(since)
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            while self.dirty_since is not None:
+                await asyncio.sleep(max(self.dirty_since + self.interval - time.monotonic(), 0))
+                self._flushing = asyncio.ensure_future(self._flush())
+                if not await asyncio.shield(self._flushing):
+                    await asyncio.sleep(self.interval)
+
+    async def _flush(self):
+        dirty_since, self.dirty_since = self.dirty_since, None
+        self.flushing_since = dirty_since
+        start = time.monotonic()
+        try:
+            await self.storage.sync()
+        except:
+            logging.exception('write-behind of session storage failed')
+            STATS['failures'] += 1
+            # Retry later, keeping the age of the oldest change
+            if self.dirty_since is None:
+                self.dirty_since = dirty_since
+            return False
+        finally:
+            self._flushing = None
+            self.flushing_since = None
+
+        elapsed = time.monotonic() - start
+        self.flushes += 1
+        self.last_flush_time = elapsed
+        STATS['flushes'] += 1
+        STATS['flush_time_total'] += elapsed
+        STATS['flush_time_max'] = max(STATS['flush_time_max'], elapsed)
+        return True
+
+    async def close(self):
+        """Stops writing behind, after the flush in progress if any. What's
+        left is written by the final storage sync"""
+        self._task.cancel()
+        _ACTIVE.discard(self)
+        if self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+
+def stats():
+    flushes = STATS['flushes']
+    return {
+        'sessions': len(_ACTIVE),
+        'dirty_sessions': sum(1 for w in _ACTIVE if w.is_dirty()),
+        'dirty_age_max': max([w.dirty_age() for w in _ACTIVE] + [0.0]),
+        'flushes': flushes,
+        'failures': STATS['failures'],
+        'flush_time_avg': STATS['flush_time_total'] / flushes if flushes else 0.0,
+        'flush_time_max': STATS['flush_time_max'],
+    }
@@ -0,0 +1,23 @@
+import os
+import pytest
+import subprocess
+from rememberberry import ipfs
+
+
+@pytest.mark.asyncio
+async def test_add_matches_goipfs(tmpdir):
+    await ipfs.init()
+    folder = tmpdir.mkdir('media')
+    for i in range(50):
+        folder.join('%i.jpg' % i).write_binary(os.urandom(1000 * i))
+    folder.join('big.bin').write_binary(os.urandom(3 * 1024 * 1024))
+    folder.mkdir('sub').join('note.txt').write_binary(b'hello')
+    folder.join('.hidden').write_binary(b'not added')
+
+    expected = subprocess.check_output(
+        ['ipfs', 'add', '-r', '-Q', str(folder)]).decode('utf-8').strip()
+    assert await ipfs.add_files(str(folder) + '/', r=True) == expected
+
+    expected = subprocess.check_output(
+        ['ipfs', 'add', '-Q', str(folder.join('big.bin'))]).decode('utf-8').strip()
+    assert await ipfs.add_files(str(folder.join('big.bin'))) == expected